@@ -0,0 +1,662 @@
+'''Clustering and nearest-center classification of local atomic environments (LAEs), used by LER.
+'''
+from collections.abc import Mapping
+import copy
+import numpy as np
+import os
+
+
+class GrowableArray:
+    """2D array that rows can be appended to in amortized constant time, by over-allocating its storage.
+
+    Parameters:
+        dim (int): number of columns.
+        capacity (int): number of rows allocated initially.
+        path (str): optional file backing the storage as a raw memory-mapped array (np.memmap), to keep large arrays
+        out of memory. The file is overwritten, and grown in place as the array grows.
+    """
+
+    def __init__(self, dim, capacity=1024, path=None):
+        self.path = path
+        self._size = 0
+        capacity = max(capacity, 1)
+        if path is None:
+            self._data = np.empty((capacity, dim))
+        else:
+            self._data = np.memmap(path, dtype=float, mode='w+', shape=(capacity, dim))
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def array(self):
+        """View of the rows filled so far (memory-mapped if the array is backed by a file)."""
+        return self._data[:self._size]
+
+    def extend(self, rows):
+        """Append rows, doubling the allocated storage when it is full."""
+        rows = np.asarray(rows, dtype=float).reshape(-1, self._data.shape[1])
+        if self._size + len(rows) > len(self._data):
+            self._grow(max(2 * len(self._data), self._size + len(rows)))
+        self._data[self._size:self._size + len(rows)] = rows
+        self._size += len(rows)
+
+    def _grow(self, capacity):
+        shape = (capacity, self._data.shape[1])
+        if self.path is None:
+            data = np.empty(shape)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        else:
+            # the file is extended and mapped again, without reading the rows already in it
+            self._data.flush()
+            with open(self.path, 'r+b') as f:
+                f.truncate(shape[0] * shape[1] * self._data.itemsize)
+            self._data = np.memmap(self.path, dtype=float, mode='r+', shape=shape)
+
+
+class ClusterCenters(Mapping):
+    """Cluster centers of an LER result and where each one was found, held as a single (N_centers x dim) array with
+    the provenance in parallel arrays, instead of one array per center.
+
+    Behaves as a read-only dictionary keyed by (aid, lae_num) tuples, in the order the centers were found, so it can
+    be used wherever `info['cluster_centers']` used to be an OrderedDict. Use `vectors` to get all centers at once.
+
+    Parameters:
+        vectors (np.ndarray): (N_centers x dim) matrix of cluster centers.
+        aids (list of str): table of the aids the centers were found in.
+        aid_index (np.ndarray): index in `aids` of the aid of each center.
+        lae_num (np.ndarray): row of each center in the description of its aid.
+    """
+
+    def __init__(self, vectors, aids, aid_index, lae_num):
+        self.vectors = np.asarray(vectors, dtype=float).reshape(len(lae_num), -1)
+        self.aids = list(aids)
+        self.aid_index = np.asarray(aid_index, dtype=np.intp)
+        self.lae_num = np.asarray(lae_num, dtype=np.intp)
+        self.path = None
+        self._rows = None
+
+    @classmethod
+    def from_items(cls, items):
+        """Build from ((aid, lae_num), vector) pairs."""
+        items = list(items)
+        table = {}
+        aid_index = [table.setdefault(aid, len(table)) for (aid, _), _ in items]
+        vectors = np.array([vector for _, vector in items], dtype=float)
+        return cls(vectors, list(table), aid_index, [lae_num for (_, lae_num), _ in items])
+
+    @classmethod
+    def from_dict(cls, centers):
+        """Convert the cluster centers of an LER result, which are dictionaries in results computed before this class
+        existed. ClusterCenters are returned as is."""
+        if isinstance(centers, cls):
+            return centers
+        return cls.from_items(centers.items())
+
+    def extend(self, keys, vectors, appended=False):
+        """New ClusterCenters with the centers (keys as (aid, lae_num), and their vectors) appended.
+
+        With `appended`, `vectors` already holds the current centers followed by the new ones (e.g. the rows of a
+        `GrowableArray` the new centers were appended to), and is used as is rather than copied, so memory-mapped
+        centers stay out of memory.
+        """
+        table = {aid: i for i, aid in enumerate(self.aids)}
+        aid_index = [table.setdefault(aid, len(table)) for aid, _ in keys]
+        if appended:
+            vectors = np.asarray(vectors, dtype=float).reshape(len(self) + len(keys), self.vectors.shape[1])
+        else:
+            vectors = np.concatenate((self.vectors, np.asarray(vectors, dtype=float).reshape(len(keys), self.vectors.shape[1])))
+        return ClusterCenters(vectors, list(table),
+                              np.concatenate((self.aid_index, np.asarray(aid_index, dtype=np.intp))),
+                              np.concatenate((self.lae_num, np.asarray([lae_num for _, lae_num in keys], dtype=np.intp))))
+
+    def copy(self):
+        """In-memory copy, not tied to any file in the Store."""
+        return ClusterCenters(np.array(self.vectors), self.aids, self.aid_index, self.lae_num)
+
+    def __len__(self):
+        return len(self.lae_num)
+
+    def __iter__(self):
+        for i, lae_num in zip(self.aid_index, self.lae_num):
+            yield (self.aids[i], int(lae_num))
+
+    def __getitem__(self, key):
+        if self._rows is None:
+            self._rows = {k: row for row, k in enumerate(self)}
+        return self.vectors[self._rows[key]]
+
+    def save_attachment(self, store, collection_name, method):
+        """Save the center vectors as a .npy attachment in the Store, unless they already are. The Store then pickles
+        the `detached` centers with the result, and the vectors are memory-mapped from that file when the result is
+        loaded (see `load_attachment`).
+
+        Returns:
+            Path of the attachment relative to the store root.
+        """
+        if self.path is None:
+            path = store.new_attachment(collection_name, method, "npy")
+            np.save(store.attachment_path(path), self.vectors)
+            self.path = path
+        return self.path
+
+    def detached(self):
+        """Copy without the center vectors, to be pickled by the Store once they are saved with `save_attachment`."""
+        if self.path is None:
+            raise RuntimeError("The cluster centers must be saved with save_attachment before they are detached.")
+        centers = copy.copy(self)
+        centers.vectors = None
+        centers._rows = None
+        return centers
+
+    def load_attachment(self, store):
+        """Memory-map the center vectors from the Store, if they were saved with `save_attachment`."""
+        if self.path is not None:
+            self.vectors = np.load(store.attachment_path(self.path), mmap_mode='r')
+        elif self.vectors is None:
+            raise RuntimeError("The cluster centers were pickled without their vectors.")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_rows"] = None
+        return state
+
+
+def block_size_for(n_centers, max_memory=None, default=256):
+    """Number of LAEs that can be compared to `n_centers` centers at once, keeping the temporary distance matrices
+    (a few float64 values per pair) within `max_memory` bytes. Returns `default` if `max_memory` is None."""
+    if max_memory is None:
+        return default
+    return int(max(1, min(default, max_memory // (32 * max(n_centers, 1)))))
+
+
+def _within_eps(block, centers, eps):
+    """For every row of `block`, whether any center is closer than eps (euclidean).
+
+    Distances are first estimated for all pairs at once with a matrix product, then the few pairs near or below eps
+    are checked exactly with `np.linalg.norm`, so the result matches comparing each pair one by one.
+    """
+    if len(centers) == 0 or len(block) == 0:
+        return np.zeros(len(block), dtype=bool)
+    sq_block = np.einsum('ij,ij->i', block, block)
+    sq_centers = np.einsum('ij,ij->i', centers, centers)
+    d2 = sq_block[:, None] + sq_centers[None, :] - 2 * block @ centers.T
+    # generous margin for the rounding error of the expansion above
+    margin = 1e-8 * (sq_block[:, None] + sq_centers[None, :]) + 1e-12
+    rows, cols = np.nonzero(d2 < eps**2 + margin)
+    close = np.linalg.norm(block[rows] - centers[cols], axis=1) < eps
+    within = np.zeros(len(block), dtype=bool)
+    within[rows[close]] = True
+    return within
+
+
+def euclidean(block, centers):
+    """Euclidean distance between every row of `block` and every row of `centers`, as a (len(block) x len(centers))
+    matrix computed with a single matrix product."""
+    sq_block = np.einsum('ij,ij->i', block, block)
+    sq_centers = np.einsum('ij,ij->i', centers, centers)
+    return np.sqrt(np.maximum(sq_block[:, None] + sq_centers[None, :] - 2 * block @ centers.T, 0))
+
+
+def cosine(block, centers):
+    """Cosine distance :math:`1 - x \\cdot x' / (||x|| ||x'||)` between every row of `block` and every row of `centers`,
+    varying between 0 and 2."""
+    norm_block = np.linalg.norm(block, axis=1)
+    norm_centers = np.linalg.norm(centers, axis=1)
+    norm_block[norm_block == 0] = 1
+    norm_centers[norm_centers == 0] = 1
+    return 1 - (block @ centers.T) / norm_block[:, None] / norm_centers[None, :]
+
+
+def gaussian(block, centers, gamma=1.0):
+    """Gaussian (RBF) dissimilarity :math:`1 - \\exp{(-\\gamma*||x - x'||^2)}` between every row of `block` and every
+    row of `centers`, varying between 0 and 1. A value closer to 0 means the LAEs are more similar."""
+    return 1 - np.exp(-gamma * euclidean(block, centers)**2)
+
+
+metrics = {
+    "euclidean": euclidean,
+    "cosine": cosine,
+    "gaussian": gaussian,
+}
+"""dict: built-in dissimilarity metrics by name. A metric takes (block, centers), two matrices of LAEs, and returns
+the (len(block) x len(centers)) matrix of dissimilarities, plus any keyword arguments (e.g. `gamma`)."""
+
+annoy_metrics = {
+    "euclidean": "euclidean",
+    "gaussian": "euclidean",  # monotonic in the euclidean distance, so the nearest center is the same
+    "cosine": "angular",
+}
+"""dict: Annoy metric finding the same nearest center as each built-in dissimilarity metric."""
+
+
+def get_metric(dissimilarity="euclidean", **dissim_args):
+    """Resolve a dissimilarity metric given by name (see `metrics`) or as a function, binding its keyword arguments.
+
+    Returns:
+        Function taking (block, centers) and returning the matrix of dissimilarities.
+    """
+    if isinstance(dissimilarity, str):
+        if dissimilarity not in metrics:
+            raise ValueError(f"Unknown dissimilarity metric '{dissimilarity}', expected one of {list(metrics)} or a function.")
+        dissimilarity = metrics[dissimilarity]
+    if dissim_args:
+        from functools import partial
+        return partial(dissimilarity, **dissim_args)
+    return dissimilarity
+
+
+def _within_eps_metric(block, centers, eps, dissimilarity):
+    """For every row of `block`, whether any center is closer than eps according to `dissimilarity`."""
+    if len(centers) == 0 or len(block) == 0:
+        return np.zeros(len(block), dtype=bool)
+    return np.any(dissimilarity(block, centers) < eps, axis=1)
+
+
+def leader(laes, centers, eps, block_size=256, max_memory=None, dissimilarity=None):
+    """Greedy (leader) clustering: in order, every LAE farther than eps from all centers found so far becomes a new
+    center. The result depends on the order of the LAEs.
+
+    Parameters:
+        laes (np.ndarray): (N_laes x dim) matrix of local atomic environments, in the order they are considered.
+        centers (GrowableArray or np.ndarray): centers found so far (e.g. holding only the seed). New centers are
+        appended in place when a GrowableArray is given.
+        eps (float): LAEs closer than eps (euclidean) to a center belong to its cluster.
+        block_size (int): maximum number of LAEs compared to all centers at once.
+        max_memory (int): optional bound in bytes on the temporary distance matrices, reducing the block size as the
+        number of centers grows.
+        dissimilarity (function): metric taking (block, centers) and returning their dissimilarity matrix, see
+        `get_metric`. Defaults to None, the euclidean distance (checked exactly for every pair close to eps).
+
+    Returns:
+        List of the row indices in `laes` of the LAEs that became new centers, in order.
+    """
+    laes = np.asarray(laes, dtype=float)
+    if not isinstance(centers, GrowableArray):
+        initial = np.asarray(centers, dtype=float).reshape(-1, laes.shape[1])
+        centers = GrowableArray(laes.shape[1], len(initial) + 1024)
+        centers.extend(initial)
+    exact = dissimilarity is None or dissimilarity is euclidean
+    new = []
+    start = 0
+    while start < len(laes):
+        block = laes[start:start + block_size_for(len(centers), max_memory, block_size)]
+        if exact:
+            within = _within_eps(block, centers.array, eps)
+        else:
+            within = _within_eps_metric(block, centers.array, eps, dissimilarity)
+        # the LAEs left over are compared one by one to the centers found in this block
+        block_new = []
+        for i in np.nonzero(~within)[0]:
+            if len(block_new) == 0:
+                block_new.append(i)
+            elif exact and not np.any(np.linalg.norm(block[block_new] - block[i], axis=1) < eps):
+                block_new.append(i)
+            elif not exact and not np.any(dissimilarity(block[i:i + 1], block[block_new]) < eps):
+                block_new.append(i)
+        centers.extend(block[block_new])
+        new.extend(start + i for i in block_new)
+        start += len(block)
+    return new
+
+
+def _digest(key):
+    """Short digest of a row key, to keep sets of keys small."""
+    import hashlib
+    return hashlib.blake2b(key.tobytes(), digest_size=16).digest()
+
+
+def grid(read, aids, initial, eps, cell=None, path=None):
+    """Grid (hash-based) clustering: LAEs are binned into the cells of a regular grid, and the first LAE found in each
+    cell not holding an initial center becomes a new center. With the default cell size of eps / sqrt(dim), all LAEs
+    of a cell are within eps of each other. A single pass with no distance computations, at the cost of more centers
+    than `leader`. The aids are visited in sorted order, so the result does not depend on the order they are given in.
+
+    Parameters:
+        read (function): returns the (N_laes x dim) matrix of LAEs of an aid.
+        aids (list): aids to cluster.
+        initial (np.ndarray or GrowableArray): (N x dim) matrix of the centers found so far (e.g. holding only the
+        seed). New centers are appended in place when a GrowableArray is given.
+        eps (float): euclidean distance within which LAEs are considered similar.
+        cell (float): edge length of the grid cells. Defaults to eps / sqrt(dim).
+        path (str): optional file to memory-map the centers to while clustering, see `GrowableArray`. Not used when
+        `initial` is a GrowableArray.
+
+    Returns:
+        Tuple (keys, vectors) of the new centers, with keys (aid, lae_num) giving where each center was found. The
+        vectors are a view of the rows of the growable array holding the centers.
+    """
+    if isinstance(initial, GrowableArray):
+        centers = initial
+        initial = centers.array
+    else:
+        initial = np.asarray(initial, dtype=float)
+        centers = GrowableArray(initial.shape[1], len(initial) + 1024, path=path)
+        centers.extend(initial)
+    n_initial = len(initial)
+    if cell is None:
+        cell = eps / np.sqrt(initial.shape[1])
+    taken = set(_digest(key) for key in row_keys(initial, cell))
+    keys = []
+    for aid in sorted(aids):
+        laes = np.asarray(read(aid), dtype=float).reshape(-1, initial.shape[1])
+        cell_keys = row_keys(laes, cell)
+        _, first = np.unique(cell_keys, return_index=True)
+        first = np.sort(first)
+        new = []
+        for lae_num in first:
+            key = _digest(cell_keys[lae_num])
+            if key not in taken:
+                taken.add(key)
+                new.append(lae_num)
+        keys.extend((aid, int(lae_num)) for lae_num in new)
+        centers.extend(laes[new])
+    return keys, centers.array[n_initial:]
+
+
+def kmeans(read, aids, initial, n_clusters, batch_size=1024, n_iter=5, init_size=None, random_state=None, max_memory=None):
+    """Streaming mini-batch k-means: `n_clusters` centers are added to the initial ones (which stay fixed), chosen with
+    k-means++ among a uniform random sample of the LAEs, and moved to the mean of the LAEs assigned to them over
+    `n_iter` passes through the aids in random order, a batch of about `batch_size` LAEs at a time. Only one batch is
+    in memory at once. The result depends on `random_state`, not on the order of the aids.
+
+    Parameters:
+        read (function): returns the (N_laes x dim) matrix of LAEs of an aid.
+        aids (list): aids to cluster.
+        initial (np.ndarray): (N x dim) matrix of fixed centers (e.g. holding only the seed).
+        n_clusters (int): number of centers to add.
+        batch_size (int): number of LAEs per mini-batch.
+        n_iter (int): number of passes through the LAEs.
+        init_size (int): number of LAEs sampled to choose the starting centers from. Defaults to
+        max(3 * n_clusters, batch_size).
+        random_state (int): seed of the random number generator.
+        max_memory (int): optional bound in bytes on the temporary distance matrices, see `block_size_for`.
+
+    Returns:
+        Tuple (keys, vectors) of the new centers, with keys (aid, lae_num) giving the LAE each center started from
+        (the final center is the mean of the LAEs assigned to it, not that LAE).
+    """
+    initial = np.asarray(initial, dtype=float)
+    rng = np.random.default_rng(random_state)
+    aids = sorted(aids)
+
+    if init_size is None:
+        init_size = max(3 * n_clusters, batch_size)
+
+    # bottom-k sampling: keep the LAEs with the smallest random priorities
+    priorities = np.zeros(0)
+    keys = []
+    sample = initial[:0]
+    for aid in aids:
+        laes = np.asarray(read(aid), dtype=float).reshape(-1, initial.shape[1])
+        priorities = np.concatenate((priorities, rng.random(len(laes))))
+        keys.extend((aid, lae_num) for lae_num in range(len(laes)))
+        sample = np.concatenate((sample, laes))
+        keep = np.argsort(priorities, kind="stable")[:init_size]
+        priorities, sample = priorities[keep], sample[keep]
+        keys = [keys[i] for i in keep]
+    if len(keys) < n_clusters:
+        raise ValueError(f"Cannot find {n_clusters} clusters among {len(keys)} LAEs.")
+
+    # k-means++: pick each center with probability proportional to the squared distance to the closest center so far
+    closest = np.min(euclidean(sample, initial), axis=1)**2 if len(initial) else np.ones(len(sample))
+    chosen = []
+    for _ in range(n_clusters):
+        total = closest.sum()
+        i = rng.choice(len(sample), p=closest / total) if total > 0 else rng.choice(np.setdiff1d(np.arange(len(sample)), chosen))
+        chosen.append(i)
+        closest = np.minimum(closest, euclidean(sample, sample[i:i + 1])[:, 0]**2)
+    keys = [keys[i] for i in chosen]
+
+    centers = np.concatenate((initial, sample[chosen]))
+    counts = np.zeros(len(centers))
+    for _ in range(n_iter):
+        batch = []
+        for i, aid in enumerate(rng.permutation(len(aids))):
+            batch.append(np.asarray(read(aids[aid]), dtype=float).reshape(-1, initial.shape[1]))
+            if sum(len(laes) for laes in batch) >= batch_size or i == len(aids) - 1:
+                batch = np.concatenate(batch)
+                labels = _classify_brute(batch, centers, max_memory=max_memory)
+                batch_counts = np.bincount(labels, minlength=len(centers)).astype(float)
+                sums = np.zeros_like(centers)
+                np.add.at(sums, labels, batch)
+                # per-center learning rate 1 / (number of LAEs assigned so far), the initial centers stay fixed
+                update = np.nonzero(batch_counts)[0]
+                update = update[update >= len(initial)]
+                counts[update] += batch_counts[update]
+                centers[update] += (sums[update] - batch_counts[update, None] * centers[update]) / counts[update, None]
+                batch = []
+    return keys, centers[len(initial):]
+
+
+engines = {
+    "grid": grid,
+    "kmeans": kmeans,
+}
+"""dict: clustering engines usable by LER in place of the greedy leader clustering. An engine takes (read, aids,
+initial) followed by its own arguments, and returns the keys and vectors of the new centers."""
+
+
+def build_index(centers, metric='euclidean', n_trees=10, path=None):
+    """Build an Annoy index over the cluster centers.
+
+    Parameters:
+        centers (np.ndarray): (N_centers x dim) matrix of cluster centers.
+        metric (str): Annoy metric. See Annoy's documentation for more details.
+        n_trees (int): number of trees in the index. See Annoy's documentation for more details.
+        path (str): optional file to save the index to. Once saved, the index is memory-mapped from that file.
+    """
+    from annoy import AnnoyIndex
+    index = AnnoyIndex(centers.shape[1], metric)
+    for i, center in enumerate(centers):
+        index.add_item(i, center)
+    index.build(n_trees)
+    if path is not None:
+        index.save(path)
+    return index
+
+
+def load_index(path, dim, metric='euclidean'):
+    """Load an Annoy index saved with `build_index`. The file is memory-mapped rather than read into memory, so
+    loading is nearly instantaneous regardless of the index size.
+
+    Parameters:
+        path (str): file the index was saved to.
+        dim (int): length of the center vectors.
+        metric (str): Annoy metric the index was built with.
+    """
+    from annoy import AnnoyIndex
+    index = AnnoyIndex(dim, metric)
+    index.load(path)
+    return index
+
+
+class CenterIndex:
+    """Annoy index over the cluster centers of an LER result, kept in a file from which it is memory-mapped (also by
+    worker processes) rather than loaded.
+
+    The index is built into a temporary file, which is moved into the Store as an attachment when the result it
+    belongs to is stored (see `save_attachment`), and removed with the object if it never is.
+
+    Parameters:
+        centers (np.ndarray): (N_centers x dim) matrix of cluster centers.
+        metric (str): Annoy metric. See Annoy's documentation for more details.
+        n_trees (int): number of trees in the index. See Annoy's documentation for more details.
+    """
+
+    def __init__(self, centers, metric='euclidean', n_trees=10):
+        import tempfile
+        import weakref
+        fd, self.file = tempfile.mkstemp(suffix=".ann")
+        os.close(fd)
+        self._cleanup = weakref.finalize(self, _remove_file, self.file)
+        build_index(centers, metric, n_trees, self.file)
+        self.metric = metric
+        self.path = None
+
+    def save_attachment(self, store, collection_name, method):
+        """Move the index into the Store, unless it is already there.
+
+        Returns:
+            Path of the attachment relative to the store root.
+        """
+        if self.path is None:
+            import shutil
+            path = store.new_attachment(collection_name, method, "ann")
+            shutil.move(self.file, store.attachment_path(path))
+            self._cleanup.detach()
+            self.path = path
+            self.file = store.attachment_path(path)
+        return self.path
+
+    def load_attachment(self, store):
+        """Point to the index file in the Store, once loaded with the result it belongs to."""
+        self.file = store.attachment_path(self.path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_cleanup", None)
+        return state
+
+
+def _remove_file(fname):
+    if os.path.exists(fname):
+        os.remove(fname)
+
+
+def _classify_annoy(laes, centers, metric='euclidean', n_trees=10, search_k=-1, index=None, chunk_size=4096, n_threads=None):
+    """Nearest center for each LAE using an Annoy index (approximate), built in memory unless `index` is given, either
+    as an AnnoyIndex or as the path of a saved one (which is then memory-mapped).
+
+    Annoy has no batched query, so the LAEs are queried in chunks of `chunk_size`, each converted to Python lists at
+    once, and with `n_threads` the chunks are queried by a pool of threads (Annoy releases the GIL while querying).
+    """
+    if index is None:
+        index = build_index(centers, metric, n_trees)
+    elif isinstance(index, str):
+        index = load_index(index, centers.shape[1], metric)
+
+    def query(start):
+        nearest = index.get_nns_by_vector
+        return [nearest(lae, 1, search_k)[0] for lae in laes[start:start + chunk_size].tolist()]
+
+    starts = range(0, len(laes), chunk_size)
+    if n_threads is not None and n_threads > 1 and len(starts) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            chunks = list(pool.map(query, starts))
+    else:
+        chunks = [query(start) for start in starts]
+    labels = np.empty(len(laes), dtype=np.intp)
+    for start, chunk in zip(starts, chunks):
+        labels[start:start + len(chunk)] = chunk
+    return labels
+
+
+def _classify_kdtree(laes, centers, workers=-1, tree=None):
+    """Nearest center for each LAE using scipy's cKDTree (exact, euclidean), built unless a prebuilt `tree` over the
+    centers is given."""
+    if tree is None:
+        from scipy.spatial import cKDTree
+        tree = cKDTree(centers)
+    return tree.query(laes, k=1, workers=workers)[1].astype(np.intp)
+
+
+def _classify_brute(laes, centers, dissimilarity=euclidean, block_size=256, max_memory=None):
+    """Nearest center for each LAE by computing the dissimilarity to all centers (exact, any metric), a block of LAEs
+    at a time."""
+    labels = np.empty(len(laes), dtype=np.intp)
+    step = block_size_for(len(centers), max_memory, block_size)
+    for start in range(0, len(laes), step):
+        labels[start:start + step] = np.argmin(dissimilarity(laes[start:start + step], centers), axis=1)
+    return labels
+
+
+backends = {
+    "annoy": _classify_annoy,
+    "kdtree": _classify_kdtree,
+    "brute": _classify_brute,
+}
+"""dict: keys are the names accepted for `nn_backend`, values are functions taking (laes, centers, \*\*kwargs) and returning the index of the nearest center for every LAE."""
+
+
+def classify(laes, centers, nn_backend="annoy", **kwargs):
+    """Find the nearest cluster center for every row of an LAE matrix in a single call.
+
+    Parameters:
+        laes (np.ndarray): (N_laes x dim) matrix of local atomic environments.
+        centers (np.ndarray): (N_centers x dim) matrix of cluster centers.
+        nn_backend (str): nearest neighbor backend, either "annoy" (approximate), "kdtree" (exact, euclidean) or
+        "brute" (exact, any dissimilarity metric). See `backends`.
+        kwargs (dict): additional arguments passed to the backend (e.g. `metric`, `n_trees`, `search_k` or a prebuilt
+        `index`, or the path it was saved to, and `n_threads` for Annoy, or `dissimilarity` for "brute").
+
+    Returns:
+        np.ndarray of ints holding the row index in `centers` of the nearest center for each LAE.
+    """
+    if nn_backend not in backends:
+        raise ValueError(f"Unknown nearest neighbor backend '{nn_backend}', expected one of {list(backends)}.")
+    laes = np.asarray(laes, dtype=float)
+    if len(laes) == 0:
+        return np.zeros(0, dtype=np.intp)
+    return backends[nn_backend](laes, np.asarray(centers, dtype=float), **kwargs)
+
+
+def row_keys(laes, tol):
+    """Hashable key of every LAE after rounding it to a grid of spacing `tol`, or of the LAE itself if `tol` is 0. LAEs
+    with the same key are treated as duplicates. Returns a 1D array of opaque (np.void) values, one per row."""
+    laes = np.asarray(laes, dtype=float)
+    if tol == 0:
+        # adding 0.0 turns -0.0 into 0.0, so that equal rows have the same bytes
+        keys = np.ascontiguousarray((laes + 0.0).reshape(len(laes), -1))
+    else:
+        keys = np.ascontiguousarray(np.round(laes / tol).astype(np.int64).reshape(len(laes), -1))
+    # view whole rows as single values, which is much faster to compare than np.unique(axis=0)
+    return keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+
+
+def unique_rows(laes, tol):
+    """Collapse LAEs that are equal up to the tolerance `tol`, by rounding them to a grid of spacing `tol`.
+
+    Parameters:
+        laes (np.ndarray): (N_laes x dim) matrix of local atomic environments.
+        tol (float): quantization step, should be well below the eps used for clustering. With 0, only exactly equal
+        LAEs are collapsed. Otherwise LAEs up to tol * sqrt(dim) apart can be collapsed.
+
+    Returns:
+        Tuple (first, inverse, multiplicity): `first` holds the row index of the first occurrence of each unique LAE
+        (in order of first occurrence), `inverse` maps every row to its unique LAE and `multiplicity` counts the rows
+        collapsed onto each unique LAE.
+    """
+    if len(laes) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    _, first, inverse, multiplicity = np.unique(row_keys(laes, tol), return_index=True, return_inverse=True, return_counts=True)
+    # renumber the unique LAEs by first occurrence, so they keep the order of the original rows
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.ravel()], multiplicity[order]
+
+
+def count(labels, rows, n_rows, n_centers, weights=None, sparse=False):
+    """Count how many LAEs of each row (aid) were assigned to each center.
+
+    Parameters:
+        labels (np.ndarray): center index for each LAE, as returned by `classify`.
+        rows (np.ndarray): row (aid) index for each LAE.
+        n_rows (int): number of rows in the output.
+        n_centers (int): number of columns in the output.
+        weights (np.ndarray): optional multiplicity of each LAE, when duplicates were collapsed with `unique_rows`.
+        sparse (bool): return a scipy.sparse CSR matrix instead of a dense array.
+
+    Returns:
+        (n_rows x n_centers) np.ndarray (or scipy.sparse.csr_matrix) of counts.
+    """
+    if sparse:
+        from scipy.sparse import csr_matrix
+        data = np.ones(len(labels)) if weights is None else np.asarray(weights, dtype=float)
+        # duplicate (row, label) entries are summed
+        return csr_matrix((data, (rows, labels)), shape=(n_rows, n_centers))
+    flat = np.bincount(rows * n_centers + labels, weights=weights, minlength=n_rows * n_centers)
+    return flat.reshape(n_rows, n_centers).astype(float)
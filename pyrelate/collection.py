@@ -3,6 +3,7 @@ import numpy as np
 from tqdm import tqdm
 from os import path
 import os
+from collections import namedtuple, OrderedDict
 from ase import io
 from pyrelate.store import Store
 
@@ -14,12 +15,18 @@ class AtomsCollection(dict):
         - self (dict): inherits from dictionary
         - name (str) : identifier for this collection
         - store (Store) : store to hold all the results and other information. Defaults to None, which creates a store in the current directory named 'Store'
+        - sources (dict) : (absolute file path, size, modification time in ns) of the file each aid was read from, used by `refresh`
+        - max_loaded (int) : None for a collection holding every Atoms object in memory (default). Otherwise the
+          collection is lazy: `read` only records the files, each Atoms object is parsed (or loaded from the parse cache)
+          when it is accessed, and at most `max_loaded` of them are kept, least recently used first out. Changes made
+          to a loaded Atoms object are lost when it is dropped, apart from those made through `trim`. A collection
+          initialized with a lazy collection as `data` is lazy too, with its `max_loaded` unless given.
 
     .. WARNING:: Make sure to have unique collection names, will be used for LER
 
     """
 
-    def __init__(self, name, store=None, data=None):
+    def __init__(self, name, store=None, data=None, max_loaded=None):
         """Initializer which calls dict's and Store's initializers."""
         super(AtomsCollection, self).__init__()
         try:
@@ -39,6 +46,14 @@ class AtomsCollection(dict):
         elif type(store) == str:
             self.store = Store(store)
 
+        self.sources = {}
+        self._loaded = OrderedDict()
+        if isinstance(data, AtomsCollection):
+            # the Atoms objects of a lazy collection are not loaded, the copy is lazy too
+            if max_loaded is None:
+                max_loaded = data.max_loaded
+            self.sources = dict(data.sources)
+        self.max_loaded = max_loaded
         if data is not None:
             self.update(data)  # allows you to initialize a collection beginning with another collection (dictionary)
 
@@ -46,6 +61,44 @@ class AtomsCollection(dict):
         """String representation of the AtomsCollection object (name of collection)."""
         return self.name
 
+    def __getitem__(self, aid):
+        """Atoms object of an aid, loaded from its file if the collection is lazy (see `max_loaded`)."""
+        value = super(AtomsCollection, self).__getitem__(aid)
+        if not isinstance(value, (_Unloaded, _SnapshotRow)):
+            return value
+        entry = self._loaded.pop(aid, None)
+        # an entry loaded from a placeholder that was replaced since (e.g. by trim or refresh) is outdated
+        if entry is None or entry[0] is not value:
+            entry = (value, _load_unloaded(value))
+        self._remember(aid, *entry)
+        return entry[1]
+
+    def _remember(self, aid, value, atoms):
+        """Keep the Atoms object loaded for the unloaded value of an aid, dropping the least recently used ones."""
+        self._loaded[aid] = (value, atoms)
+        while len(self._loaded) > self.max_loaded:
+            try:
+                self._loaded.popitem(last=False)
+            except KeyError:
+                break
+
+    def get(self, aid, default=None):
+        """Atoms object of an aid, or `default` if it is not in the collection."""
+        return self[aid] if aid in self else default
+
+    def values(self):
+        """Atoms objects of the collection. For a lazy collection, a generator loading them one at a time."""
+        if self.max_loaded is None:
+            return super(AtomsCollection, self).values()
+        return (self[aid] for aid in self)
+
+    def items(self):
+        """(aid, Atoms object) pairs of the collection. For a lazy collection, a generator loading them one at a
+        time."""
+        if self.max_loaded is None:
+            return super(AtomsCollection, self).items()
+        return ((aid, self[aid]) for aid in self)
+
     def subset(self, aids, name=None, store=None):
         """Return an AtomsCollection containing the specified subset of the original collection.
 
@@ -62,8 +115,105 @@ class AtomsCollection(dict):
             name = self.name
         if store is None:
             store = self.store
-        data = {aid: self[aid] for aid in aids}
-        return AtomsCollection(name, store=store, data=data)
+        # the Atoms objects of a lazy collection are not loaded
+        data = {aid: super(AtomsCollection, self).__getitem__(aid) for aid in aids}
+        new = AtomsCollection(name, store=store, data=data, max_loaded=self.max_loaded)
+        new.sources = {aid: self.sources[aid] for aid in aids if aid in self.sources}
+        return new
+
+    def save(self, path):
+        """Save the collection as a snapshot, to be restored with `load` without reading and trimming files again.
+
+        The snapshot is a directory of .npy files in a structure-of-arrays layout: each array of the Atoms objects
+        (positions, numbers, type, mask, ...) is concatenated over all aids (sorted), with the offset of each aid, and
+        the cells, cell displacements and periodic boundary conditions are stacked. The `info` dictionary of each Atoms
+        object is pickled with the snapshot, while calculators and constraints are not saved. All Atoms objects must
+        have the same arrays. The Atoms objects of a lazy collection are loaded (and written) one at a time.
+
+        Parameters:
+            path (str): directory of the snapshot, created if needed. Existing snapshot files are overwritten.
+
+        Example:
+            .. code-block:: python
+
+                my_col.read("/Ni/", 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out')
+                my_col.trim(4, 0)
+                my_col.save("ni_trimmed")
+                my_col = AtomsCollection.load("ni_trimmed")
+        """
+        import pickle
+        os.makedirs(os.path.join(path, "arrays"), exist_ok=True)
+        aids = self.aids()
+        offsets = np.zeros(len(aids) + 1, dtype=np.int64)
+        cells = np.zeros((len(aids), 3, 3))
+        celldisp = np.zeros((len(aids), 3))
+        pbc = np.zeros((len(aids), 3), dtype=bool)
+        infos = []
+        layout = []
+        raw = {}
+        try:
+            # arrays are streamed to raw files, which become .npy files once their lengths are known
+            for i, aid in enumerate(tqdm(aids)):
+                atoms = self[aid]
+                atoms_layout = [(name, arr.dtype.str, arr.shape[1:]) for name, arr in atoms.arrays.items()]
+                if i == 0:
+                    layout = atoms_layout
+                    raw = {name: open(os.path.join(path, "arrays", name + ".raw"), "wb") for name, _, _ in layout}
+                elif atoms_layout != layout:
+                    raise ValueError(f"{aid} does not have the same arrays as the other Atoms objects, the collection "
+                                     "cannot be saved.")
+                for name, arr in atoms.arrays.items():
+                    raw[name].write(np.ascontiguousarray(arr).tobytes())
+                offsets[i + 1] = offsets[i] + len(atoms)
+                cells[i] = atoms.cell[:]
+                celldisp[i] = atoms.get_celldisp().ravel()
+                pbc[i] = atoms.pbc
+                infos.append(atoms.info)
+        except BaseException:
+            for f in raw.values():
+                f.close()
+                os.remove(f.name)
+            raise
+        for f in raw.values():
+            f.close()
+        for name, dtype, shape in layout:
+            _raw_to_npy(os.path.join(path, "arrays", name), np.dtype(dtype), (int(offsets[-1]),) + shape)
+        for name, arr in [("offsets", offsets), ("cells", cells), ("celldisp", celldisp), ("pbc", pbc),
+                          ("aids", np.array(aids, dtype=str))]:
+            np.save(os.path.join(path, name + ".npy"), arr)
+        with open(os.path.join(path, "collection.pkl"), "wb") as f:
+            pickle.dump({"name": self.name, "arrays": [name for name, _, _ in layout], "sources": self.sources,
+                         "info": infos}, f)
+
+    @classmethod
+    def load(cls, path, store=None, max_loaded=None):
+        """Collection saved as a snapshot by `save`.
+
+        The snapshot files are memory-mapped. For a lazy collection (see `max_loaded`), each Atoms object is only
+        copied out of them when accessed.
+
+        Parameters:
+            path (str): directory of the snapshot.
+            store (Store or str): store of the collection, see `AtomsCollection`.
+            max_loaded (int): see `AtomsCollection`. Defaults to None, every Atoms object is loaded.
+
+        Returns:
+            pyrelate.AtomsCollection
+        """
+        import pickle
+        if not os.path.isfile(os.path.join(path, "collection.pkl")):
+            raise FileNotFoundError(f"No collection snapshot found at {path}.")
+        with open(os.path.join(path, "collection.pkl"), "rb") as f:
+            meta = pickle.load(f)
+        new = cls(meta["name"], store=store, max_loaded=max_loaded)
+        snapshot = _open_snapshot(path) if max_loaded is None else None
+        for i, aid in enumerate(np.load(os.path.join(path, "aids.npy")).tolist()):
+            if max_loaded is None:
+                new[aid] = _snapshot_atoms(snapshot, i)
+            else:
+                new[aid] = _SnapshotRow(os.path.abspath(path), i, ())
+        new.sources = meta["sources"]
+        return new
 
     def _read_aid(self, fpath, comp_rxid, prefix=None):
         """Private function to read the aid for the Atoms object from filename.
@@ -94,7 +244,7 @@ class AtomsCollection(dict):
 
         return aid
 
-    def read(self, root, Z, f_format=None, rxid=None, prefix=None):
+    def read(self, root, Z, f_format=None, rxid=None, prefix=None, n_jobs=None, cache=None, frames=None):
         """Function to read atoms data into ASE Atoms objects and add to AtomsCollection.
 
         Utilizes functionality in ASE to read in atomic data.
@@ -103,52 +253,169 @@ class AtomsCollection(dict):
             root (str) : relative file path (or list of file paths) to the file, or directory of files, where the raw atomic descriptions are located.
             Z (int) : atomic number of the elements to be read
             f_format (str) : format of data file. Defaults to None. See ASE's documentation at 'https://wiki.fysik.dtu.dk/ase/ase/io/io.html'. Most formats can be automatically
-            read in without this parameter.
+            read in without this parameter. Uncompressed LAMMPS text dumps, given as "lammps-dump-text" or recognized by
+            their first line when f_format is None, are parsed with the faster `pyrelate.lammps.read_dump_text`.
             rxid (:obj: str, optional) : regex pattern for extracting the `aid` for each Atoms object. Defaults to None. The regex should include a named group `(?P<aid>...)` so that the id can be extracted correctly.  If any files don't match the regex or if it is not specified, the file name is used as the `aid`.
             prefix (str): optional prefix for aid. Defaults to none.
+            n_jobs (int): number of processes parsing files in parallel. Ignored for lazy collections (see
+            `max_loaded`), whose files are only listed here and parsed when accessed. Defaults to None (serial). All files are
+            listed first (with `os.scandir` for directories), then parsed and post-processed in a process pool, which
+            sends the Atoms objects back packed (see `pyrelate.transport`).
+            cache (str or bool): directory of a parse cache, or True for the "ParseCache" directory of the store.
+            Defaults to None (no cache). The processed arrays of every file read are saved there in binary form, and
+            later reads of the same file with the same Z and f_format load them (memory-mapped) instead of parsing the
+            file again. An entry is only used while the size and modification time of the file are unchanged, otherwise
+            the file is parsed again and its entry replaced.
+            frames (slice): frames to read from multi-frame files (e.g. MD trajectories), such as slice(None) for all of
+            them or slice(0, None, 10) for every 10th one, with non-negative bounds. Defaults to None, the last frame
+            only. Each frame is added with the aid "<aid>_f<frame>", frame being its index in the file. Frames are
+            streamed one at a time (see `iread`), without `n_jobs` nor `cache`.
 
         Example:
             .. code-block:: python
 
                 my_col.read(["/Ni/ni.p454.out", "/Ni/ni.p453.out"], 28, rxid=r'ni.p(?P<aid>\d+).out', prefix="Nickel")
-                my_col.read("/Ni/", 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out', prefix="Nickel")
+                my_col.read("/Ni/", 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out', prefix="Nickel", n_jobs=8)
+                my_col.read("/Ni/", 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out', prefix="Nickel", cache=True)
+                my_col.read("/Ni/ni.dump", 28, "lammps-dump-text", frames=slice(0, None, 10))
 
         """
+        if frames is not None:
+            for _ in self.iread(root, Z, f_format, rxid, prefix, frames):
+                pass
+            return
         comp_rxid = None
         if rxid is not None:
             import re
             comp_rxid = re.compile(rxid)
+        if cache is True:
+            cache = path.join(self.store.root, "ParseCache")
+        if cache is not None:
+            os.makedirs(cache, exist_ok=True)
+        if self.max_loaded is not None:
+            for fpath, z in _list_files(root, Z):
+                aid = self._read_aid(fpath, comp_rxid, prefix)
+                self[aid] = _Unloaded(fpath, z, f_format, cache, None, ())
+                self.sources[aid] = _source(fpath)
+            return
+        if n_jobs is not None and n_jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            from pyrelate import transport
+            files = _list_files(root, Z)
+            sources = [_source(fpath) for fpath, _ in files]
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                parsed = pool.map(_try_read_file, [fpath for fpath, _ in files], [z for _, z in files], [f_format] * len(files), [cache] * len(files), chunksize=max(1, len(files) // (4 * n_jobs)))
+                for (fpath, _), source, a in zip(files, sources, tqdm(parsed, total=len(files))):
+                    if a is None:
+                        print("Invalid file path,", fpath, "was not read.")
+                    else:
+                        aid = self._read_aid(fpath, comp_rxid, prefix)
+                        self[aid] = transport.unpack(a)
+                        self.sources[aid] = source
+            return
         try:
             if isinstance(root, list):
                 for i in tqdm(range(len(root))):
                     if not isinstance(Z, list):
-                        self.read(root[i], Z, f_format, rxid, prefix)
+                        self.read(root[i], Z, f_format, rxid, prefix, cache=cache)
                     else:
-                        self.read(root[i], Z[i], f_format, rxid, prefix)
+                        self.read(root[i], Z[i], f_format, rxid, prefix, cache=cache)
             elif(path.isfile(root)):
-                # TODO generalize for reading multi elemental data
-                a0 = io.read(root, format=f_format)
-                a = a0.copy()
-                # delete end blocks
-                del a[[atom.index for atom in a if atom.number == 4 or atom.number == 5]]
-                a.new_array('type', a.get_array(
-                    'numbers', copy=True), dtype=int)
-                a.set_atomic_numbers([Z for i in a])
+                source = _source(root)
+                a = _read_file(root, Z, f_format, cache)
                 # TODO aid is stored as an array in the Atoms object, ideally want a single property for the Atoms object
                 aid = self._read_aid(root, comp_rxid, prefix)
                 self[aid] = a
-
-                # initialize mask to all ones (keep all)
-                a.new_array("mask", np.array([1 for i in range(len(a))]), dtype="int")
+                self.sources[aid] = source
             elif(path.isdir(root)):
                 for afile in os.listdir(root):
                     fpath = os.path.join(root, afile)
-                    self.read(fpath, Z, f_format, rxid, prefix)
+                    self.read(fpath, Z, f_format, rxid, prefix, cache=cache)
             else:
                 raise ValueError(root)
         except ValueError:
             print("Invalid file path,", root, "was not read.")
 
+    def iread(self, root, Z, f_format=None, rxid=None, prefix=None, frames=slice(None)):
+        """Generator reading the frames of multi-frame files (e.g. MD trajectories) one at a time into the collection,
+        yielding the aid of each frame once it is added, so that it can be described before the next one is parsed.
+
+        Parameters are those of `read`, and each frame gets the aid "<aid>_f<frame>". In a lazy collection (see
+        `max_loaded`), the frames are not held in memory: each frame is read again when it is accessed after being
+        dropped. Frames of LAMMPS text dumps read with `pyrelate.lammps` are read from their position in the file,
+        while frames of other formats are read with `ase.io.read(index=frame)`, which parses the file up to that
+        frame again on every access.
+
+        Example:
+            .. code-block:: python
+
+                my_col = AtomsCollection("md", max_loaded=8)
+                for aid in my_col.iread("/Ni/ni.dump", 28, "lammps-dump-text", frames=slice(0, None, 10)):
+                    my_col.describe("soap", aid=aid, **soap_args)
+        """
+        comp_rxid = None
+        if rxid is not None:
+            import re
+            comp_rxid = re.compile(rxid)
+        for fpath, z in _list_files(root, Z):
+            source = _source(fpath)
+            base = self._read_aid(fpath, comp_rxid, prefix)
+            try:
+                for frame, offset, atoms in _iread_file(fpath, z, f_format, frames):
+                    aid = f"{base}_f{frame}"
+                    if self.max_loaded is not None:
+                        value = _Unloaded(fpath, z, f_format, None, (frame, offset), ())
+                        self[aid] = value
+                        self._remember(aid, value, atoms)
+                    else:
+                        self[aid] = atoms
+                    self.sources[aid] = source
+                    yield aid
+            except ValueError:
+                print("Invalid file path,", fpath, "was not read.")
+
+    def refresh(self, root, Z, f_format=None, rxid=None, prefix=None, n_jobs=None, cache=None, remove=False,
+                frames=None):
+        """Read only the files under `root` that are new, or were modified since they were read into this collection.
+
+        Files are compared with `sources` by path, size and modification time. Parameters are those of `read`, plus:
+
+        Parameters:
+            remove (bool): if True, aids whose files no longer exist are removed from the collection. Defaults to False.
+
+        The aids of a modified file that are not read again, such as the frames "<aid>_f<frame>" past the end of a
+        trajectory that got shorter, are removed from the collection.
+
+        Returns:
+            set: aids that were read (new or modified files). Descriptions stored for modified files are outdated and
+            should be computed again with `override=True`.
+
+        Example:
+            .. code-block:: python
+
+                changed = my_col.refresh("/Ni/", 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out')
+                my_col.describe("soap", aid=changed, override=True, **soap_args)
+        """
+        files = _list_files(root, Z)
+        known = {source[0]: source for source in self.sources.values()}
+        to_read = [(fpath, z) for fpath, z in files if known.get(path.abspath(fpath)) != _source(fpath)]
+        before = dict(self.sources)
+        if len(to_read) > 0:
+            self.read([fpath for fpath, _ in to_read], [z for _, z in to_read], f_format, rxid, prefix, n_jobs=n_jobs,
+                      cache=cache, frames=frames)
+        # aids of the files read again that were not replaced are stale
+        read_again = {source[0] for aid, source in self.sources.items() if before.get(aid) != source}
+        for aid, source in list(self.sources.items()):
+            if source[0] in read_again and before.get(aid) == source:
+                del self[aid]
+                del self.sources[aid]
+        if remove:
+            for aid, source in list(self.sources.items()):
+                if not path.exists(source[0]):
+                    del self[aid]
+                    del self.sources[aid]
+        return {aid for aid, source in self.sources.items() if before.get(aid) != source}
+
     def trim(self, trim, dim, pad=True):
         """Trims off excess atoms and indicates padding (specified in a mask).
         #FIXME store trim and pad values for the entire collection
@@ -181,24 +448,18 @@ class AtomsCollection(dict):
         if not isinstance(dim, list):
             dim = [dim for i in range(len(self))]
 
-        slice_width = trim + pad
         for idx, aid in enumerate(tqdm(self)):
-            atoms = self[aid]
             d = dim[idx]
             if d not in [0, 1, 2]:
                 raise TypeError("Dimension should equal 0, 1, or 2")
+            value = super(AtomsCollection, self).__getitem__(aid)
+            if isinstance(value, (_Unloaded, _SnapshotRow)):
+                # applied when the Atoms object is loaded
+                self[aid] = value._replace(trims=value.trims + ((trim, pad, d),))
+            else:
+                _trim_atoms(value, trim, pad, d)
 
-            atoms.get_positions()[:, d]
-            # TODO verify gbcenter = 0
-            gbcenter = 0
-            # delete atoms outside of trim and pad
-            del atoms[[atom.index for atom in atoms if atom.position[d] < (gbcenter - slice_width) or atom.position[d] > (gbcenter + slice_width)]]
-
-            # update mask -- 1 for inside trim, and 0 for pad
-            mask = np.array([atom.position[d] > (gbcenter - trim) for atom in atoms]) * np.array([atom.position[d] < (gbcenter + trim) for atom in atoms]) * 1
-            atoms.set_array("mask", mask)
-
-    def describe(self, descriptor, aid=None, fcn=None, override=False, **desc_args):
+    def describe(self, descriptor, aid=None, fcn=None, override=False, n_jobs=None, shared_memory=False, reuse=True, keep_unchanged=False, pickle_atoms=False, **desc_args):
         """Function to calculate and store atomic description.
 
         User can specify a descriptor function to be used, or use those in descriptors.py. When there is a padding associated with the Atoms object, the padding atoms are deleted from the final description before being stored.
@@ -208,6 +469,23 @@ class AtomsCollection(dict):
             aid (iterable or string) : Atoms ID's (aid) of atomic systems to be described. Can pass in single aid string, or an iterable of aids. Defaults to None. When None, all ASE Atoms objects in AtomsCollection are described.
             fcn : function to apply said description. Defaults to none. When none, built in functions in descriptors.py are used.
             override (bool) : if True, descriptor will override any matching results in the store. Defaults to False.
+            n_jobs (int) : number of processes computing descriptions in parallel. Defaults to None (serial). `fcn` must
+            then be picklable (defined at module level). Only the arrays, cell, periodic boundary conditions and info
+            of the Atoms objects are sent to the processes (see `pyrelate.transport`), not their calculators or
+            constraints, unless `pickle_atoms`.
+            shared_memory (bool) : if True, Atoms objects are sent to the processes through reusable blocks of shared
+            memory instead of a pipe. Defaults to False. The shared memory holds about 2 * n_jobs Atoms objects.
+            reuse (bool) : if True (default), aids with identical structures (see `structure_fingerprint`) are
+            described once, and the others are linked to the same stored description (see `Store.link_description`),
+            including, without `override`, the descriptions already stored for other aids of the collection.
+            The fingerprint of each structure is computed as its Atoms object is loaded to be described, so the Atoms
+            objects of a lazy collection are still loaded once. Set to False to compute every description.
+            keep_unchanged (bool) : if True, with `override` and `reuse`, the stored descriptions of structures unchanged
+            since they were stored are kept instead of being computed again. Defaults to False, `override` computes
+            every description again (e.g. after changing `fcn`).
+            pickle_atoms (bool) : if True, Atoms objects are pickled whole, with their calculators and constraints, when
+            sent to the processes, for descriptor functions that need them. Not supported with `shared_memory`.
+            Defaults to False.
             desc_args (dict) : Parameters associated with the description function specified. See documentation in descriptors.py for function details and parameters.
 
         Examples:
@@ -226,39 +504,306 @@ class AtomsCollection(dict):
         if fcn is None:
             from pyrelate import descriptors
             fcn = getattr(descriptors, descriptor)
+        if shared_memory and pickle_atoms:
+            raise ValueError("Atoms objects cannot be pickled whole through shared memory, use either shared_memory or pickle_atoms.")
 
         if aid is None:
             to_calculate = self.aids()
         else:
             to_calculate = [aid] if type(aid) is str else aid
 
-        for aid in tqdm(to_calculate):
-            if aid not in self.aids():
+        for aid in to_calculate:
+            if aid not in self:
                 raise ValueError(f"{aid} is not a valid atoms ID.")
-             
-
-            # TODO make sure this works with default store name you know? 
-            exists = self.store.check_exists("Descriptions", aid, descriptor, **desc_args)
-            if not exists or override:
-                returned = fcn(self[aid], **desc_args)
-                if type(returned) is tuple:
-                    result = returned[0]
-                    info = returned[1]
-                else:
-                    result = returned
-                    info = {}
-                if len(result) > np.count_nonzero(self[aid].get_array("mask")):
-                    to_delete = np.logical_not(self[aid].get_array("mask"))
-                    result = np.delete(result, to_delete, axis=0)
+        if not override:
+            to_calculate = self.store.missing_descriptions(to_calculate, descriptor, **desc_args)
+        fingerprints = {}
+        links = {}
+        # aid described for each fingerprint
+        sources = {}
+        if reuse and not override and to_calculate:
+            # missing descriptions of structures already described for other aids are linked to theirs
+            missing = set(to_calculate)
+            for described in self.aids():
+                if described not in missing:
+                    info = self.store.get_description_info(described, descriptor, **desc_args)
+                    if info is not None and "structure_fingerprint" in info:
+                        sources.setdefault(info["structure_fingerprint"], described)
+
+        def to_describe(aid):
+            """Atoms object of an aid to describe, or None if its description is reused (see `reuse`)."""
+            atoms = self[aid]
+            if not reuse:
+                return atoms
+            fingerprint = fingerprints[aid] = structure_fingerprint(atoms)
+            if fingerprint in sources:
+                links[aid] = sources[fingerprint]
+                return None
+            sources[fingerprint] = aid
+            if override and keep_unchanged:
+                info = self.store.get_description_info(aid, descriptor, **desc_args)
+                if info is not None and info.get("structure_fingerprint") == fingerprint:
+                    return None
+            return atoms
+
+        def store_description(result, info, aid):
+            if aid in fingerprints:
+                info["structure_fingerprint"] = fingerprints[aid]
+            self.store.store_description(result, info, aid, descriptor, **desc_args)
+
+        if n_jobs is not None and n_jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+            from contextlib import nullcontext
+            from pyrelate import transport
+
+            def store(futures):
+                for future in futures:
+                    aid, slot = pending.pop(future)
+                    result, info = future.result()
+                    if slot is not None:
+                        slots.release(slot)
+                    store_description(result, info, aid)
+
+            with transport.SharedSlots() if shared_memory else nullcontext() as slots, \
+                    ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                # a bounded number of Atoms objects is handed to the pool at a time
+                pending = {}
+                for aid in tqdm(to_calculate):
+                    atoms = to_describe(aid)
+                    if atoms is None:
+                        continue
+                    if len(pending) >= 2 * n_jobs:
+                        store(wait(pending, return_when=FIRST_COMPLETED)[0])
+                    future, slot = self._submit_description(pool, atoms, fcn, desc_args, slots, pickle_atoms)
+                    pending[future] = (aid, slot)
+                store(list(pending))
+        else:
+            for aid in tqdm(to_calculate):
+                atoms = to_describe(aid)
+                if atoms is None:
+                    continue
+                result, info = _describe_atoms(atoms, fcn, desc_args)
 
                 # FIXME store trim/pad data in info dict
                 # "trim":None, "pad":None}
 
-                self.store.store_description(
-                    result, info, aid, descriptor, **desc_args)
-        # self.clear("temp")
+                store_description(result, info, aid)
+        for aid, source in links.items():
+            self.store.link_description(source, aid, descriptor, **desc_args)
+
+    def _describe_aid(self, aid, fcn, **desc_args):
+        """Description of a single aid as (result, info), with the padding atoms removed."""
+        return _describe_atoms(self[aid], fcn, desc_args)
+
+    def _submit_description(self, pool, atoms, fcn, desc_args, slots=None, pickle_atoms=False):
+        """Submit the description of an Atoms object to a process pool, packed into a slot of the
+        `transport.SharedSlots` if not None, otherwise packed (see `transport.pack`) or, with `pickle_atoms`, pickled
+        as is. Returns (future, slot), slot being None without shared memory."""
+        from pyrelate import transport
+        if slots is not None:
+            slot, packed = slots.put(atoms)
+            return pool.submit(_describe_packed, packed, fcn, desc_args), slot
+        if pickle_atoms:
+            return pool.submit(_describe_atoms, atoms, fcn, desc_args), None
+        return pool.submit(_describe_packed, transport.pack(atoms), fcn, desc_args), None
+
+    def describe_and_process(self, descriptor, methods, fcn=None, store_descriptions=False, override=False, n_jobs=None, queue_size=8, shared_memory=False, pickle_atoms=False, **desc_args):
+        """Describe every aid and feed each description straight into one or more processing methods while it is
+        still in memory, instead of storing all descriptions first and reading them back in `process`.
+
+        The results of the methods are stored under the same keys as with `process(method, (descriptor, desc_args),
+        **kwargs)`, and can be retrieved with `get_collection_result` as usual. Descriptions already in the store are
+        read instead of computed again (unless `override`). Supported methods are the streaming reductions "asr",
+        "sum" and "reduce", and "ler_classify" against a fixed set of centers (see `descriptors.streaming_consumer`).
 
-    def process(self, method, based_on, fcn=None, override=None, **kwargs):
+        Parameters:
+            descriptor (str): descriptor to be applied.
+            methods (list): (method, kwargs) tuples of the processing methods to apply.
+            fcn: function to apply said description. Defaults to None. When None, built in functions in descriptors.py are used.
+            store_descriptions (bool): if True, the per-atom descriptions are also stored, as with `describe`.
+            Defaults to False, only the results of the methods are stored.
+            override (bool): if True, descriptions are computed again even if stored. Defaults to False.
+            n_jobs (int): number of processes computing descriptions. Defaults to None (serial). In parallel, the run
+            is pipelined: descriptions are handed, as they complete, through a queue to a thread feeding the methods
+            (and storing descriptions), so processing overlaps with describing and the total time approaches the
+            longer of the two rather than their sum. `fcn` must then be picklable (defined at module level).
+            queue_size (int): maximum number of finished descriptions waiting to be processed, bounding memory when
+            processing is slower than describing. Defaults to 8.
+            shared_memory (bool): if True, Atoms objects are sent to the processes through shared memory, see
+            `describe`. Defaults to False.
+            pickle_atoms (bool): if True, Atoms objects are pickled whole when sent to the processes, see `describe`.
+            Defaults to False.
+            desc_args (dict): Parameters associated with the description function specified.
+
+        Returns:
+            List of the results of the methods, in order.
+
+        Examples:
+            .. code-block:: python
+
+                asr, ler = my_col.describe_and_process("soap", [("asr", {}), ("ler_classify", {"basis": centers})], **soap_args)
+        """
+        from pyrelate import descriptors
+        if fcn is None:
+            fcn = getattr(descriptors, descriptor)
+        if shared_memory and pickle_atoms:
+            raise ValueError("Atoms objects cannot be pickled whole through shared memory, use either shared_memory or pickle_atoms.")
+        based_on = (descriptor, desc_args)
+        consumers = [descriptors.streaming_consumer(method, self, based_on, **kwargs) for method, kwargs in methods]
+
+        def consume(row, aid, result, info):
+            # info is None for descriptions read from the store
+            if store_descriptions and info is not None:
+                self.store.store_description(result, info, aid, descriptor, **desc_args)
+            for consumer in consumers:
+                consumer.add(row, result)
+
+        def stored(aid):
+            if not override and self.store.check_exists("Descriptions", aid, descriptor, **desc_args):
+                return self.store.get_description(aid, descriptor, **desc_args)
+            return None
+
+        if n_jobs is None:
+            for row, aid in enumerate(tqdm(self.aids())):
+                result = stored(aid)
+                if result is not None:
+                    consume(row, aid, result, None)
+                else:
+                    consume(row, aid, *self._describe_aid(aid, fcn, **desc_args))
+        else:
+            self._pipeline(fcn, desc_args, stored, consume, n_jobs, queue_size, shared_memory, pickle_atoms)
+
+        results = []
+        for (method, kwargs), consumer in zip(methods, consumers):
+            result, info = consumer.result(self.aids())
+            key_args = _stored_args(method, kwargs)
+            self._record_inputs(info, based_on, kwargs, key_args)
+            self.store.store_collection_result(result, info, method, self.name, based_on, **key_args)
+            results.append(result)
+        return results
+
+    def _pipeline(self, fcn, desc_args, stored, consume, n_jobs, queue_size, shared_memory=False, pickle_atoms=False):
+        """Describe aids in a process pool and pass each finished description to `consume` in a separate thread,
+        through a bounded queue. See `describe_and_process`."""
+        import queue
+        import threading
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+        from contextlib import nullcontext
+        from pyrelate import transport
+        finished = queue.Queue(maxsize=queue_size)
+        errors = []
+        aids = self.aids()
+
+        def consumer_loop():
+            while True:
+                item = finished.get()
+                if item is None:
+                    return
+                if not errors:
+                    try:
+                        consume(*item)
+                    except Exception as e:
+                        errors.append(e)
+
+        def hand_over(futures, pending):
+            for future in futures:
+                row, slot = pending.pop(future)
+                result = future.result()
+                if slot is not None:
+                    slots.release(slot)
+                # blocks while the queue is full, so describing never runs too far ahead of processing
+                finished.put((row, aids[row]) + result)
+
+        thread = threading.Thread(target=consumer_loop)
+        thread.start()
+        try:
+            with transport.SharedSlots() if shared_memory else nullcontext() as slots, \
+                    ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                pending = {}
+                for row, aid in enumerate(tqdm(aids)):
+                    if errors:
+                        break
+                    result = stored(aid)
+                    if result is not None:
+                        finished.put((row, aid, result, None))
+                        continue
+                    if len(pending) >= 2 * n_jobs:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        hand_over(done, pending)
+                    future, slot = self._submit_description(pool, self[aid], fcn, desc_args, slots, pickle_atoms)
+                    pending[future] = (row, slot)
+                hand_over(list(pending), pending)
+        finally:
+            finished.put(None)
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def dependencies(self, based_on):
+        """Dependency graph of a result computed from `based_on`, flattened in the order its prerequisites must be
+        computed.
+
+        A `based_on` of the form (descriptor, desc_args) depends on the description of every aid. A collection result
+        can itself be a prerequisite, given as (method, method_args, based_on_of_method), e.g.
+        ("ler", ler_args, ("soap", soap_args)): its own prerequisites are then resolved first, so chains such as
+        soap -> ler -> downstream method are resolved the same way at every level.
+
+        Parameters:
+            based_on (tuple): (descriptor, desc_args) or (method, method_args, based_on_of_method).
+
+        Returns:
+            List of dictionaries, prerequisites first, each with the "kind" of step ("describe" or "process"), the
+            "name" and "args" of the descriptor or method, its "based_on" (for "process") and what is "missing": the
+            list of aids without the description, or whether the collection result is missing. The existence of all
+            descriptions is checked in bulk, see `Store.missing_descriptions`.
+        """
+        if len(based_on) == 3:
+            name, args, inner = based_on
+            steps = self.dependencies(inner)
+            missing = not self.store.check_exists("Collections", self.name, name, _stored_based_on(inner), **_stored_args(name, args))
+            return steps + [{"kind": "process", "name": name, "args": args, "based_on": inner, "missing": missing}]
+        name, args = based_on
+        missing = self.store.missing_descriptions(self.aids(), name, **args)
+        return [{"kind": "describe", "name": name, "args": args, "missing": missing}]
+
+    def input_fingerprint(self, based_on):
+        """Cheap fingerprint of the inputs of a collection result: the aids of the collection and the content hashes of
+        their descriptions (or of the collection result given as (method, method_args, based_on), see `dependencies`),
+        read from the stored metadata only. Stored with every result of `process`, which recomputes a result when
+        the fingerprint changed, e.g. after descriptions were computed again with `override` or aids were added.
+
+        Returns:
+            str, or None if an input is missing or was stored without a content hash.
+        """
+        from pyrelate.store import content_hash
+        if len(based_on) == 3:
+            name, args, inner = based_on
+            info = self.store.get_collection_info(name, self.name, _stored_based_on(inner), **_stored_args(name, args))
+            hashes = [None if info is None else info.get("content_hash")]
+        else:
+            hashes = self.store.description_hashes(self.aids(), based_on[0], **based_on[1])
+        if None in hashes:
+            return None
+        return content_hash((self.aids(), hashes))
+
+    def _resolve_dependencies(self, based_on, n_jobs=None):
+        """Compute the missing prerequisites of `based_on` (see `dependencies`) before processing. Descriptions are
+        computed with the descriptor function registered in `descriptors.descriptor_functions`; a FileNotFoundError is
+        raised before any work starts if descriptions are missing for a descriptor without one."""
+        from pyrelate import descriptors
+        steps = self.dependencies(based_on)
+        for step in steps:
+            if step["kind"] == "describe" and step["missing"] and step["name"] not in descriptors.descriptor_functions:
+                raise FileNotFoundError(f"No {step['name']} results found for aids {step['missing']}, and no descriptor "
+                                        f"function is registered for '{step['name']}' in descriptors.descriptor_functions "
+                                        f"to compute them. Describe them first or register one.")
+        for step in steps:
+            if step["kind"] == "describe" and step["missing"]:
+                self.describe(step["name"], aid=step["missing"], fcn=descriptors.descriptor_functions[step["name"]], n_jobs=n_jobs, **step["args"])
+            elif step["kind"] == "process" and step["missing"]:
+                self.process(step["name"], step["based_on"], resolve=False, **step["args"])
+
+    def process(self, method, based_on, fcn=None, override=None, update=False, resolve=True, describe_jobs=None, **kwargs):
         """Calculate and store collection specific results.
 
         Parameters:
@@ -266,7 +811,20 @@ class AtomsCollection(dict):
             based_on (str, dict): tuple holding the information necessary to get previously calculated results for use in processing.
             fcn (str): function to apply said processing method. Defaults to none. When none, built in functions in descriptors.py are used.
             override (bool): if True, results will override any matching results in the store. Defaults to False.
+            update (bool): if True and a matching result is already stored, it is passed to the processing function as
+            `previous=(result, info)` so that methods supporting it (such as "ler", which declare a `previous`
+            parameter) only compute what changed since, e.g. aids added to the collection. Other methods compute the
+            result from scratch. The updated result replaces the stored one, and info['aids'] records the aid of each
+            row of every result (unless the method sets it). Defaults to False.
+            resolve (bool): if True, the missing prerequisites of `based_on` are found with a single bulk check and
+            computed before running the method: descriptions with the function registered for their descriptor in
+            `descriptors.descriptor_functions` (a FileNotFoundError is raised if there is none), and collection results
+            given as (method, method_args, based_on) with `process`. See `dependencies`. Defaults to True.
+            describe_jobs (int): number of processes computing missing descriptions. Defaults to None (serial).
             kwargs (dict): Parameters associated with the processing function specified. See documentation in descriptors.py for function details and parameters.
+            Those only changing how the result is computed (see `descriptors.execution_args`, e.g. n_jobs) are passed
+            to the function but not used to store and look up the result, unless they change it for the given
+            arguments (see `descriptors.method_execution_args`).
 
         Examples:
             .. code-block:: python
@@ -279,23 +837,41 @@ class AtomsCollection(dict):
                     "dissim_args" : {"gamma":4000},
                 }
                 my_col.process("ler", based_on=("soap", soap_args), **ler_args)
+
+                # after reading and describing new structures, only the new aids are clustered and classified
+                my_col.process("ler", based_on=("soap", soap_args), update=True, **ler_args)
+
+                # computes missing SOAP descriptions (in parallel) and the LER result it depends on first
+                my_col.process("my_method", based_on=("ler", ler_args, ("soap", soap_args)), describe_jobs=4)
         """
 
         if fcn is None:
             from pyrelate import descriptors
             fcn = getattr(descriptors, method)
 
-        # TODO: if soap not calculated, calculate
-        # would require the function used to be passed in somehow...
-        # desc = based_on[0]
-        # desc_args = based_on[1]
-        # for aid in self.aids():
-        #     if not self.store.check_exists("Descriptions", aid, desc, **desc_args):
-        #         self.describe(desc, aid=aid, **desc_args)
-
-        exists = self.store.check_exists("Collections", self.name, method, based_on, **kwargs)
-        if not exists or override:
-            returned = fcn(self, based_on, **kwargs)
+        # execution-only arguments are left out of the key of the result
+        key_args = _stored_args(method, kwargs)
+        key_based_on = _stored_based_on(based_on)
+        # a single lookup finds the stored result and its info
+        stored_info = self.store.get_collection_info(method, self.name, key_based_on, **key_args)
+        exists = stored_info is not None
+        if exists and not (override or update):
+            # a stored result is only reused if its inputs did not change since it was computed
+            stored = stored_info.get("input_fingerprint")
+            if stored is not None and stored != self.input_fingerprint(based_on):
+                if "aids" in stored_info and set(stored_info["aids"]) - set(self.aids()):
+                    print(f"The stored {method} result of collection '{self.name}' was computed for other aids and is "
+                          f"replaced, give subsets their own name to keep both (see `subset`).")
+                print(f"Inputs of the stored {method} result changed, recomputing.")
+                override = True
+        if not exists or override or update:
+            if resolve:
+                self._resolve_dependencies(based_on, describe_jobs)
+            if update and exists and _accepts_previous(fcn):
+                previous = self.store.get_collection_result(method, self.name, key_based_on, metadata=True, **key_args)
+                returned = fcn(self, based_on, previous=previous, **kwargs)
+            else:
+                returned = fcn(self, based_on, **kwargs)
             if type(returned) is tuple:
                 result = returned[0]
                 info = returned[1]
@@ -303,9 +879,18 @@ class AtomsCollection(dict):
                 result = returned
                 info = {}
 
-            self.store.store_collection_result(result, info, method, self.name, based_on, **kwargs)
+            self._record_inputs(info, based_on, kwargs, key_args)
+            self.store.store_collection_result(result, info, method, self.name, key_based_on, **key_args)
 
-        return self.store.get_collection_result(method, self.name, based_on, **kwargs)  # return result and info dict
+        return self.store.get_collection_result(method, self.name, key_based_on, **key_args)  # return result and info dict
+
+    def _record_inputs(self, info, based_on, kwargs, key_args):
+        """Record in the info of a collection result what it was computed from: the fingerprint of its inputs (see
+        `input_fingerprint`), the execution-only arguments left out of `key_args` and the aid of each row."""
+        info["input_fingerprint"] = self.input_fingerprint(based_on)
+        info["execution_args"] = {key: value for key, value in kwargs.items() if key not in key_args}
+        # aid of each row, so that the rows of aids already computed can be reused when updating
+        info.setdefault("aids", self.aids())
 
     def clear(self, descriptor=None, aid=None, collection_name=None, method=None, based_on=None, **kwargs):
         '''Function to delete specified results from Store.
@@ -361,7 +946,7 @@ class AtomsCollection(dict):
 
         elif method is not None and collection_name is not None:
             if based_on is not None and has_kwargs:
-                self.store.clear_collection_result(method, collection_name, based_on, **kwargs)
+                self.store.clear_collection_result(method, collection_name, _stored_based_on(based_on), **_stored_args(method, kwargs))
             else:
                 self.store.clear_method(method, collection_name)
         else:
@@ -377,10 +962,337 @@ class AtomsCollection(dict):
 
     def get_collection_result(self, method, based_on, metadata=False, **method_args):
         """Wrapper function to retrieve collection specific results from the store"""
-        return self.store.get_collection_result(method, self.name, based_on, metadata=metadata, **method_args)
+        return self.store.get_collection_result(method, self.name, _stored_based_on(based_on), metadata=metadata, **_stored_args(method, method_args))
 
     def aids(self):
         '''Returns sorted list of atom ID's (aids) in collection'''
         a = list(self)
         a.sort()
         return a
+
+
+def structure_fingerprint(atoms, decimals=6):
+    """Short hash identifying a structure for its descriptions: every per-atom array of an Atoms object (positions,
+    atomic numbers, mask, types, ...), its cell and periodic boundary conditions, with floating point values rounded to
+    the given number of decimals.
+
+    Returns:
+        str: hexadecimal digest.
+    """
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    parts = [("cell", np.round(atoms.cell[:], decimals) + 0.0), ("pbc", np.asarray(atoms.pbc, dtype=bool))]
+    for name in sorted(atoms.arrays):
+        arr = atoms.arrays[name]
+        if np.issubdtype(arr.dtype, np.floating):
+            arr = np.round(arr, decimals) + 0.0
+        parts.append((name, arr))
+    for name, part in parts:
+        part = np.ascontiguousarray(part)
+        h.update(repr((name, part.dtype.str, part.shape)).encode())
+        # object arrays are hashed by value, not by the addresses they hold
+        h.update(repr(part.tolist()).encode() if part.dtype == object else part.data)
+    return h.hexdigest()
+
+
+def _stored_args(method, kwargs):
+    """Arguments of a processing method a collection result is stored under, without the execution-only ones (see
+    `descriptors.execution_args` and `descriptors.method_execution_args`)."""
+    from pyrelate import descriptors
+    execution = descriptors.execution_args
+    if method in descriptors.method_execution_args:
+        execution = descriptors.method_execution_args[method](kwargs)
+    return {key: value for key, value in kwargs.items() if key not in execution}
+
+
+def _stored_based_on(based_on):
+    """`based_on` of a collection result as stored, without the execution-only arguments of the collection results
+    it is based on."""
+    if len(based_on) == 3:
+        name, args, inner = based_on
+        return (name, _stored_args(name, args), _stored_based_on(inner))
+    return based_on
+
+
+def _accepts_previous(fcn):
+    """Whether a processing function declares a `previous` parameter, to update a stored result (see `process`)."""
+    import inspect
+    try:
+        return "previous" in inspect.signature(fcn).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _describe_atoms(atoms, fcn, desc_args):
+    """Description of an Atoms object as (result, info), with the padding atoms removed."""
+    returned = fcn(atoms, **desc_args)
+    if type(returned) is tuple:
+        result = returned[0]
+        info = returned[1]
+    else:
+        result = returned
+        info = {}
+    if len(result) > np.count_nonzero(atoms.get_array("mask")):
+        to_delete = np.logical_not(atoms.get_array("mask"))
+        result = np.delete(result, to_delete, axis=0)
+    return result, info
+
+
+def _describe_packed(packed, fcn, desc_args):
+    """`_describe_atoms` for worker processes, of an Atoms object packed by `pyrelate.transport`."""
+    from pyrelate import transport
+    return _describe_atoms(transport.unpack(packed), fcn, desc_args)
+
+
+def _read_file(fpath, Z, f_format=None, cache=None):
+    """Read a single file into an Atoms object ready to be added to a collection: end block atoms are deleted, the
+    original atom types are kept in the "type" array, atomic numbers are set to Z and the mask keeps all atoms. With a
+    `cache` directory, the result is loaded from or saved to the parse cache (see `AtomsCollection.read`)."""
+    if cache is not None:
+        stat = os.stat(fpath)
+        cache_file = _cache_file(cache, fpath, Z, f_format)
+        a = _load_cached(cache_file, stat)
+        if a is not None:
+            return a
+    if _fast_lammps(fpath, f_format):
+        from pyrelate.lammps import read_dump_text
+        a0 = read_dump_text(fpath)
+    else:
+        a0 = io.read(fpath, format=f_format)
+    a = _prepare_atoms(a0, Z)
+    if cache is not None:
+        _save_cached(cache_file, stat, a)
+    return a
+
+
+def _prepare_atoms(a0, Z):
+    """Atoms object read from a file, ready to be added to a collection (see `_read_file`)."""
+    # TODO generalize for reading multi elemental data
+    # delete end blocks (indexing with a boolean array returns a copy)
+    a = a0[(a0.numbers != 4) & (a0.numbers != 5)]
+    a.new_array('type', a.get_array(
+        'numbers', copy=True), dtype=int)
+    a.set_atomic_numbers(np.full(len(a), Z))
+
+    # initialize mask to all ones (keep all)
+    a.new_array("mask", np.ones(len(a), dtype=int), dtype="int")
+    return a
+
+
+def _fast_lammps(fpath, f_format):
+    """Whether a file is read with `pyrelate.lammps` rather than ASE: LAMMPS text dumps, given as such or recognized by
+    their content when no format is given, as long as the ASE functions it relies on are available."""
+    from pyrelate import lammps
+    if fpath.endswith((".gz", ".bz2", ".xz")) or f_format not in (None, "lammps-dump-text"):
+        return False
+    if f_format is None and not lammps.is_dump_text(fpath):
+        return False
+    return lammps.available()
+
+
+def _iread_file(fpath, Z, f_format, frames):
+    """Yield (frame, offset, atoms) for the selected frames of a multi-frame file, ready to be added to a collection.
+    The offset is the position of the frame in the file, or None if it is not read with `pyrelate.lammps`."""
+    from pyrelate.lammps import frame_range, iread_dump_text
+    if _fast_lammps(fpath, f_format):
+        parsed = iread_dump_text(fpath, frames)
+    else:
+        selected = frame_range(frames)
+        parsed = ((i, None, a) for i, a in zip(selected, io.iread(fpath, index=frames, format=f_format)))
+    for frame, offset, a0 in parsed:
+        yield frame, offset, _prepare_atoms(a0, Z)
+
+
+def _read_frame(fpath, Z, f_format, frame, offset):
+    """A single frame of a multi-frame file, ready to be added to a collection."""
+    if offset is not None:
+        from pyrelate.lammps import read_dump_frame
+        return _prepare_atoms(read_dump_frame(fpath, offset), Z)
+    return _prepare_atoms(io.read(fpath, index=frame, format=f_format), Z)
+
+
+_Unloaded = namedtuple("_Unloaded", ["fpath", "Z", "f_format", "cache", "frame", "trims"])
+"""Value of an aid of a lazy collection that is read from `fpath` when accessed (only the (index, offset) `frame` of a
+multi-frame file if not None), then trimmed with each (trim, pad, dim) of `trims`. See `AtomsCollection.max_loaded`."""
+
+_SnapshotRow = namedtuple("_SnapshotRow", ["path", "row", "trims"])
+"""Value of an aid of a lazy collection loaded from a snapshot: the Atoms object of `row` of the snapshot saved at the
+absolute `path` by `AtomsCollection.save`, copied out when accessed and trimmed like an `_Unloaded` value."""
+
+
+def _load_unloaded(value):
+    """Atoms object of an `_Unloaded` or `_SnapshotRow` value."""
+    if isinstance(value, _SnapshotRow):
+        atoms = _snapshot_atoms(_open_snapshot(value.path), value.row)
+    elif value.frame is None:
+        atoms = _read_file(value.fpath, value.Z, value.f_format, value.cache)
+    else:
+        atoms = _read_frame(value.fpath, value.Z, value.f_format, *value.frame)
+    for trim, pad, d in value.trims:
+        _trim_atoms(atoms, trim, pad, d)
+    return atoms
+
+
+def _raw_to_npy(fname, dtype, shape):
+    """Turn the raw file "<fname>.raw" of an array into "<fname>.npy", by writing the header and copying the data."""
+    import shutil
+    with open(fname + ".npy", "wb") as out:
+        np.lib.format.write_array_header_2_0(out, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+                                                   "shape": shape})
+        with open(fname + ".raw", "rb") as f:
+            shutil.copyfileobj(f, out)
+    os.remove(fname + ".raw")
+
+
+_snapshots = OrderedDict()
+"""OrderedDict: snapshots opened by `_open_snapshot`, by path and modification time, so that the Atoms objects of a lazy
+collection loaded from a snapshot are copied out of arrays mapped once, rather than opening the snapshot again on every
+access. At most `_max_snapshots` are kept open, least recently used first out."""
+
+_max_snapshots = 4
+"""int: number of snapshots kept open in `_snapshots`."""
+
+
+def _open_snapshot(path):
+    """Arrays of a snapshot saved by `AtomsCollection.save`, memory-mapped, and the info of each Atoms object. Opened
+    snapshots are kept in `_snapshots` until the snapshot is saved again or other snapshots are opened."""
+    path = os.path.abspath(path)
+    key = (path, os.stat(os.path.join(path, "collection.pkl")).st_mtime_ns)
+    if key in _snapshots:
+        _snapshots.move_to_end(key)
+    else:
+        for old in [old for old in _snapshots if old[0] == path]:
+            del _snapshots[old]
+        _snapshots[key] = _read_snapshot(path)
+        while len(_snapshots) > _max_snapshots:
+            _snapshots.popitem(last=False)
+    return _snapshots[key]
+
+
+def _read_snapshot(path):
+    """Open a snapshot, see `_open_snapshot`."""
+    import pickle
+    with open(os.path.join(path, "collection.pkl"), "rb") as f:
+        meta = pickle.load(f)
+    names = meta["arrays"]
+    snapshot = {name: np.load(os.path.join(path, name + ".npy")) for name in ["offsets", "cells", "celldisp", "pbc"]}
+    # empty files cannot be memory-mapped
+    mmap_mode = "r" if snapshot["offsets"][-1] > 0 else None
+    snapshot["arrays"] = {name: np.load(os.path.join(path, "arrays", name + ".npy"), mmap_mode=mmap_mode)
+                          for name in names}
+    # snapshots saved before the info was kept have none
+    snapshot["info"] = meta.get("info")
+    return snapshot
+
+
+def _snapshot_atoms(snapshot, i):
+    """Atoms object of row i of an open snapshot."""
+    from ase import Atoms
+    start, stop = snapshot["offsets"][i], snapshot["offsets"][i + 1]
+    arrays = {name: arr[start:stop] for name, arr in snapshot["arrays"].items()}
+    atoms = Atoms(numbers=arrays.pop("numbers"), positions=arrays.pop("positions"), cell=snapshot["cells"][i],
+                  celldisp=snapshot["celldisp"][i], pbc=snapshot["pbc"][i])
+    for name, arr in arrays.items():
+        atoms.new_array(name, arr)
+    if snapshot["info"] is not None:
+        import copy
+        atoms.info = copy.deepcopy(snapshot["info"][i])
+    return atoms
+
+
+def _trim_atoms(atoms, trim, pad, d):
+    """Trim an Atoms object in place, see `AtomsCollection.trim`."""
+    # TODO verify gbcenter = 0
+    gbcenter = 0
+    slice_width = trim + pad
+    # delete atoms outside of trim and pad
+    position = atoms.positions[:, d]
+    del atoms[np.nonzero((position < (gbcenter - slice_width)) | (position > (gbcenter + slice_width)))[0]]
+
+    # update mask -- 1 for inside trim, and 0 for pad
+    position = atoms.positions[:, d]
+    mask = ((position > (gbcenter - trim)) & (position < (gbcenter + trim))) * 1
+    atoms.set_array("mask", mask)
+
+
+def _source(fpath):
+    """(absolute path, size, modification time in ns) of a file, as recorded in `AtomsCollection.sources`."""
+    stat = os.stat(fpath)
+    return (path.abspath(fpath), stat.st_size, stat.st_mtime_ns)
+
+
+_cache_meta_dtype = np.dtype([("size", "i8"), ("mtime", "i8"), ("n_atoms", "i8"), ("cell", "f8", (3, 3)),
+                              ("celldisp", "f8", (3,)), ("pbc", "?", (3,))])
+"""numpy.dtype: record saved next to each parse cache entry, with the size and modification time (ns) of the file it
+was parsed from, and the properties of the Atoms object that are not per-atom arrays."""
+
+
+def _cache_file(cache, fpath, Z, f_format):
+    """Path of the parse cache entry of a file read with the given Z and format."""
+    import hashlib
+    key = repr((path.abspath(fpath), Z, f_format)).encode()
+    return path.join(cache, hashlib.blake2b(key, digest_size=16).hexdigest() + ".npy")
+
+
+def _load_cached(cache_file, stat):
+    """Atoms object of a parse cache entry, or None if there is no entry or the file changed since it was saved."""
+    from ase import Atoms
+    try:
+        meta = np.load(cache_file[:-len(".npy")] + ".meta.npy")
+        if meta["size"] != stat.st_size or meta["mtime"] != stat.st_mtime_ns:
+            return None
+        # one record per atom, with a field for each array of the Atoms object
+        data = np.load(cache_file, mmap_mode="r" if meta["n_atoms"] > 0 else None)
+    except (OSError, ValueError):
+        return None
+    a = Atoms(numbers=data["numbers"], positions=data["positions"], cell=meta["cell"], celldisp=meta["celldisp"],
+              pbc=meta["pbc"])
+    for name in data.dtype.names:
+        if name not in ("numbers", "positions"):
+            a.new_array(name, data[name])
+    return a
+
+
+def _save_cached(cache_file, stat, a):
+    """Save the arrays of an Atoms object read from a file with the given `os.stat` result as a parse cache entry."""
+    data = np.empty(len(a), dtype=[(name, arr.dtype, arr.shape[1:]) for name, arr in a.arrays.items()])
+    for name, arr in a.arrays.items():
+        data[name] = arr
+    meta = np.array((stat.st_size, stat.st_mtime_ns, len(a), a.cell[:], a.get_celldisp(), a.pbc),
+                    dtype=_cache_meta_dtype)
+    # the entry is written to temporary files first, so that readers never see a partial entry; the metadata, which
+    # validates the entry, is replaced last
+    tmp = f"{cache_file[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+    for fname, arr in [(cache_file, data), (cache_file[:-len(".npy")] + ".meta.npy", meta)]:
+        np.save(tmp, arr)
+        os.replace(tmp, fname)
+
+
+def _try_read_file(fpath, Z, f_format=None, cache=None):
+    """`_read_file` for worker processes, returning the Atoms object packed by `pyrelate.transport`, or None for files
+    that cannot be read (ValueError), as reported by `AtomsCollection.read`."""
+    from pyrelate import transport
+    try:
+        return transport.pack(_read_file(fpath, Z, f_format, cache))
+    except ValueError:
+        return None
+
+
+def _list_files(root, Z):
+    """(file path, Z) pairs of all files to read under `root`, in the order `AtomsCollection.read` reads them serially.
+    Invalid paths are reported and skipped."""
+    if isinstance(root, list):
+        files = []
+        for i, r in enumerate(root):
+            files.extend(_list_files(r, Z[i] if isinstance(Z, list) else Z))
+        return files
+    elif path.isfile(root):
+        return [(root, Z)]
+    elif path.isdir(root):
+        files = []
+        with os.scandir(root) as entries:
+            for entry in entries:
+                files.extend(_list_files(entry.path, Z))
+        return files
+    print("Invalid file path,", root, "was not read.")
+    return []
@@ -1,4 +1,6 @@
+import os
 import numpy as np
+from tqdm import tqdm
 '''Built-in descriptors for use with AtomsCollection's describe function.
 
 Some guidelines for writing your own descriptor function
@@ -29,7 +31,41 @@ def soap(atoms, rcut, nmax, lmax, **kwargs):
     return P
 
 
-def asr(collection, based_on, norm_asr=False):
+descriptor_functions = {
+    "soap": soap,
+}
+"""dict: per-atom descriptor functions by name. `AtomsCollection.process` uses them to compute missing descriptions
+a method is based on before running it; register your own descriptor functions here to have them computed too."""
+
+execution_args = {"n_jobs", "exact_clustering", "max_memory", "mmap_centers", "nn_threads"}
+"""set: keyword arguments of the processing methods that only change how a result is computed (parallelism, memory),
+not what is computed. `AtomsCollection.process` leaves them out of the arguments a result is stored and looked up
+under, so a result computed with `n_jobs=4` is reused by a serial call, and records them in info['execution_args'].
+Methods for which some of them do change the result depending on the other arguments are listed in
+`method_execution_args`."""
+
+
+def _ler_execution_args(kwargs):
+    """The `execution_args` of a "ler" call that leave its result unchanged: n_jobs changes the centers with the
+    parallel leader clustering (without exact_clustering), and max_memory which near-duplicates are collapsed
+    together with a positive dedup_tol."""
+    args = set(execution_args)
+    n_jobs = kwargs.get("n_jobs")
+    if n_jobs is not None and n_jobs > 1 and not kwargs.get("exact_clustering", False) and kwargs.get("engine", "leader") == "leader":
+        args.discard("n_jobs")
+    if kwargs.get("dedup_tol", 0) and kwargs.get("max_memory") is not None:
+        args.discard("max_memory")
+    return args
+
+
+method_execution_args = {
+    "ler": _ler_execution_args,
+}
+"""dict: functions by processing method name, returning which of `execution_args` leave the result of a call with the
+given keyword arguments unchanged. Methods not listed here leave all `execution_args` out of the stored arguments."""
+
+
+def asr(collection, based_on, norm_asr=False, n_jobs=None, previous=None):
     """Average SOAP representation: average vectors from SOAP matrix into a single vector
 
     Parameters:
@@ -38,20 +74,13 @@ def asr(collection, based_on, norm_asr=False):
         based_on( (string, dict) ): holds necessary info to fetch results from the Store. String
         is the descriptor name, dictionary holds the keyword arguments. 
         norm_asr (bool): Normalize ASR vector. Default is False, not normalized.
+        n_jobs (int): number of threads averaging aids in parallel. Defaults to None (serial).
+        previous( (np.ndarray, dict) ): previous result, only the aids it lacks are averaged. See `reduce`.
     """
-    # for each gb, average and add to matrix, and return
-    asr_matrix = []
-    magnitude = 1
-    for aid in collection.aids():
-        res = collection.get_description(aid, based_on[0], **based_on[1])
-        asr_row = np.average(res, axis=0)
-        if norm_asr is True:
-            magnitude = np.linalg.norm(asr_row)
-        asr_matrix.append(asr_row / magnitude)
-    return np.array(asr_matrix)
-
-
-def sum(collection, based_on):
+    return _reduce_matrix(collection, based_on, "norm_mean" if norm_asr else "mean", n_jobs, previous)
+
+
+def sum(collection, based_on, n_jobs=None, previous=None):
     """Sum all rows of a descriptor matrix into a single vector
 
     Parameters:
@@ -59,22 +88,41 @@ def sum(collection, based_on):
         for fetching previously calculated descriptions from the store.
         based_on( (string, dict) ): holds necessary info to fetch results from the Store. String
         is the descriptor name, dictionary holds the keyword arguments. 
+        n_jobs (int): number of threads summing aids in parallel. Defaults to None (serial).
+        previous( (np.ndarray, dict) ): previous result, only the aids it lacks are summed. See `reduce`.
+    """
+    return _reduce_matrix(collection, based_on, "sum", n_jobs, previous)
+
+
+def _reduce_matrix(collection, based_on, reduction, n_jobs=None, previous=None):
+    """Matrix of a single built-in reduction, computed with `reduce`. The rows of a previous result are reused if its
+    info dictionary lists their aids (recorded by `AtomsCollection.process`)."""
+    from pyrelate import reductions as _reductions
+    if previous is not None:
+        prev_matrix, prev_info = previous
+        if "aids" in prev_info:
+            prev_info = {"reductions": [reduction], "columns": {reduction: (0, prev_matrix.shape[1])}, "aids": prev_info["aids"]}
+            previous = (prev_matrix, prev_info)
+        else:
+            previous = None
+    return _reductions.reduce(collection, based_on, [reduction], n_jobs=n_jobs, previous=previous)[0]
+
+
+def reduce(collection, based_on, reductions=("mean",), n_jobs=None, previous=None):
+    """Several row-wise reductions (e.g. mean, variance, max) of a descriptor matrix, fused into a single pass over
+    the descriptions. See `pyrelate.reductions.reduce` for the parameters.
 
+    Example:
+        .. code-block:: python
+
+            my_col.process("reduce", ("soap", soap_args), reductions=["mean", "var", ("moment", {"order": 3})])
     """
-    sum_matrix = []
-    for aid in collection.aids():
-        res = collection.get_description(aid, based_on[0], **based_on[1])
-        sum_row = np.sum(res, axis=0)
-        sum_matrix.append(sum_row)
-    return np.array(sum_matrix)
+    from pyrelate import reductions as _reductions
+    return _reductions.reduce(collection, based_on, reductions, n_jobs=n_jobs, previous=previous)
+
 
 # uses euclidean distance as dissimilarity metric
-import annoy
-from annoy import AnnoyIndex
-from tqdm import tqdm
-import os
-from collections import OrderedDict
-def ler(collection, based_on, eps, soap_fcn=None, seed=None, sorting=None, metric='euclidean', n_trees=10, search_k=-1, **kwargs):
+def ler(collection, based_on, eps, dissimilarity="euclidean", dissim_args=None, soap_fcn=None, seed=None, sorting=None, metric=None, n_trees=10, search_k=-1, nn_backend="annoy", dedup_tol=0, n_jobs=None, exact_clustering=False, max_memory=None, mmap_centers=False, sparse=False, engine="leader", engine_args=None, previous=None, nn_threads=None, **kwargs):
     '''Local Environment Representation
         Parameters:
             collection(AtomsCollection): AtomsCollection the description will be based on, needed
@@ -82,178 +130,494 @@ def ler(collection, based_on, eps, soap_fcn=None, seed=None, sorting=None, metri
             based_on( (string, dict) ): holds necessary info to fetch results from the Store. String
             is the descriptor name, dictionary holds the keyword arguments. 
             eps (float): epsilon value indicating that any LAE's outside this value are considered dissimilar. Descriptor and dissimilarity metric specific.
-            dissimilarity (function): dissimilarity metric function that has the first 2 parameters as the 2 LAE's to be compared.
-            dissim_args (dict): dictionary with any additional hyperparameter arguments for the given dissimilarity metric.
+            dissimilarity (str or function): dissimilarity metric used for clustering, either the name of a built-in
+            metric ("euclidean", "cosine" or "gaussian", see `pyrelate.clustering.metrics`) or a function taking a
+            block of LAEs and the matrix of centers (as two 2D arrays) and returning the matrix of their
+            dissimilarities. Defaults to "euclidean". A custom function requires the "brute" backend (see
+            nn_backend), which classifies LAEs using the same function.
+            dissim_args (dict): dictionary with any additional hyperparameter arguments for the given dissimilarity metric (e.g. {'gamma': 0.5} for "gaussian").
             soap_fcn (function): optional parameter for a function to compute SOAP matrix for the element's perfect crystal on the fly. Defaults to None. When None, 'soap' function in descriptors.py will be used.
             seed(np.ndarray or list): perfect seed for the element being considered. Defaults to None. When None, seed will be generated on the fly with soap_fcn.
             sorting(list): list of the ordered aids to be used when calculating LER
             metric(str): For approximate nearest neighbor calculation. See Annoy's documentation for more details.
+            Defaults to the Annoy metric matching the dissimilarity ("euclidean" for "euclidean" and "gaussian",
+            "angular" for "cosine"); a different metric raises a ValueError.
             n_trees(int): For approximate nearest neighbor calculation. See Annoy's documentation for more details.
             search_k(int): For approximate nearest neighbor calculation. See Annoy's documentation for more details.
+            nn_backend(str): backend used to classify every LAE to its nearest cluster center. "annoy" (default) for
+            approximate nearest neighbors, "kdtree" for an exact search with scipy's cKDTree (euclidean or gaussian
+            dissimilarity only), or "brute" for an exact search computing the dissimilarity to all centers.
+            With "annoy", the index over the cluster centers is saved in the Store next to the result (as
+            info['center_index'], a `clustering.CenterIndex`) so later classifications can reuse it, see `ler_classify`.
+            nn_threads(int): number of threads querying the Annoy index, in chunks of LAEs (Annoy releases the GIL
+            while querying). Defaults to None (a single thread). The result does not depend on it.
+            dedup_tol(float): LAEs equal up to this tolerance (e.g. the bulk-like environments making up most of a
+            grain boundary slab) are collapsed before clustering and classification, so only unique LAEs are processed
+            and their multiplicity is carried into the counts. Defaults to 0, only exact duplicates are collapsed,
+            which leaves the result unchanged. A positive tolerance rounds the LAEs to a grid of that spacing, which
+            also collapses near-duplicates: an LAE may then be skipped while up to dedup_tol * sqrt(dim) away from the
+            one it was collapsed onto, so it is not considered as a center and the centers and counts can differ from
+            the exact algorithm. Must be well below eps. None disables deduplication.
+            n_jobs(int): number of processes to use. Defaults to None (serial). In parallel, the aids are split into
+            n_jobs contiguous shards of the clustering order, each process builds the leaders of its shard, and the
+            union of these local leaders is clustered again with the same eps, in shard order. Classification is then
+            done in parallel over the aids. The final centers are still at least eps apart, but an LAE may lie up to
+            2*eps (instead of eps) from the center it was clustered under, so the centers can differ from the serial,
+            order-dependent algorithm. The centers found for the first shard are always the same as in serial.
+            n_jobs is therefore part of the arguments the result is stored under, unless the result is the serial
+            one (with exact_clustering or a single job) and it is left out (see `execution_args`).
+            exact_clustering(bool): with n_jobs, cluster serially to keep the exact serial result and only run the
+            classification in parallel. Defaults to False.
+            max_memory(int): approximate bound, in bytes, on the memory used for LAEs and counts while clustering and
+            classifying. Descriptions are streamed from the Store one aid at a time when clustering, and when
+            classifying in chunks of aids of at most half of what is left once the (dense) count matrix is allocated,
+            so collections larger than memory can be processed. A ValueError is raised if the dense count matrix does
+            not fit, use `sparse` then. The result is identical to the in-memory path, except with a positive
+            dedup_tol: near-duplicates are then only collapsed within each chunk when classifying and max_memory is
+            part of the arguments the result is stored under. Defaults to None (all LAEs are classified at once).
+            mmap_centers(bool): keep the cluster centers in a memory-mapped temporary file in the Store, grown in
+            place while clustering, instead of in memory. They stay memory-mapped until the result is stored. With
+            n_jobs (without exact_clustering) or the "kmeans" engine, the centers are only written to the file once
+            found, as the shard leaders and k-means centers are computed in memory. Defaults to False.
+            sparse(bool): return the LER matrix and info['ler_matrix_count'] as scipy.sparse CSR matrices, and store
+            them that way. Each aid usually populates only a small fraction of the centers, so memory and store size
+            then scale with the number of non-zeros. Defaults to False.
+            engine(str): algorithm used to find the cluster centers. "leader" (default) is the greedy clustering
+            described above, which depends on the order of the LAEs (see `sorting`). "grid" bins the LAEs into a grid
+            of cells of size eps / sqrt(dim) and takes the first LAE of each cell as a center, in a single pass
+            without distance computations but with more centers. "kmeans" adds a given number of centers with
+            streaming mini-batch k-means (engine_args must then hold `n_clusters`), eps being only used for
+            `dedup_tol`. Both alternatives visit the aids in sorted order so the result does not depend on `sorting`,
+            hold a single aid (or mini-batch) of LAEs in memory at once, support only the euclidean dissimilarity
+            and ignore n_jobs and dedup_tol when clustering. They cannot update a previous result (see `previous`).
+            With "kmeans", the (aid, lae_num) keys of `info['cluster_centers']` give the LAE each center started
+            from, while the vectors are the final centers. See `pyrelate.clustering.engines`.
+            engine_args(dict): additional arguments for the clustering engine, e.g. {'n_clusters': 100,
+            'random_state': 0} for "kmeans" or {'cell': 0.5} for "grid".
+            previous( (np.ndarray, dict) ): a previously computed LER result and its info dictionary for a subset of
+            this collection, passed by `AtomsCollection.process` when called with `update=True`. Only the LAEs of the
+            new aids are clustered, against the previous centers, appending new ones beyond eps. If no center was
+            added, only the new aids are classified and the earlier LER vectors are kept; otherwise every aid is
+            classified again against all centers, as an earlier LAE may now be closer to a new center. This gives the
+            result of a full run with the previous aids clustered first (in their previous order).
             soapargs (dict): Parameters associated with the SOAP description being used.
             `Annoy's documentation <https://github.com/spotify/annoy>`_.
     '''
-    
-    U = {
-        'centers': OrderedDict(),
-        'clusters': {}
-    }
+    from pyrelate import clustering
+    distance = clustering.get_metric(dissimilarity, **(dissim_args or {}))
+    # Annoy metric finding the same nearest centers, None for custom metrics
+    nn_metric = clustering.annoy_metrics.get(dissimilarity) if isinstance(dissimilarity, str) else None
+    if nn_metric is None and nn_backend != "brute":
+        raise ValueError(f"The '{nn_backend}' backend does not support a custom dissimilarity, use nn_backend='brute'.")
+    if metric is None:
+        metric = nn_metric or 'euclidean'
+    elif nn_metric is not None and metric != nn_metric:
+        raise ValueError(f"Annoy metric '{metric}' is inconsistent with the '{dissimilarity}' dissimilarity, use '{nn_metric}'.")
 
-    # Part 1: Clustering
-    print("Clustering")
-    import pyrelate.elements as elements
-    if seed is None:
-        seed = elements.seed(list(collection.values())[0].get_chemical_symbols()[0], soap_fcn, **based_on[1])
-    U['centers'][('0', 0)] = seed
+    if nn_backend == "annoy":
+        nn_args = {"search_k": search_k, "n_threads": nn_threads}
+    elif nn_backend == "brute":
+        nn_args = {"dissimilarity": distance, "max_memory": max_memory}
+    elif metric != 'euclidean':
+        raise ValueError(f"The '{nn_backend}' backend only supports the euclidean metric.")
+    else:
+        nn_args = {}
+
+    if engine != "leader":
+        if engine not in clustering.engines:
+            raise ValueError(f"Unknown clustering engine '{engine}', expected 'leader' or one of {list(clustering.engines)}.")
+        if dissimilarity != "euclidean":
+            raise ValueError(f"The '{engine}' clustering engine only supports the euclidean dissimilarity.")
+        if previous is not None:
+            raise ValueError(f"The '{engine}' clustering engine does not support updating a previous result.")
+    engine_args = engine_args or {}
+
+    if dedup_tol is not None and dedup_tol >= eps:
+        raise ValueError("dedup_tol should be well below eps.")
+
+    # aids in the order they are clustered
     if sorting is None:
         aids = collection.aids()
     else:
         if len(sorting) != len(collection):
             raise RuntimeError("The sorting specified by user is not the correct number of elements.")
         aids = sorting
-        
-    for aid in tqdm(aids): #aids:
-        soap = collection.get_description(aid, based_on[0], **based_on[1])
-        if soap is None:
-            raise RuntimeError(f"No {based_on[0]} results found for aid {aid}.")
-            
-        for lae_num, lae in enumerate(soap):
-#             if lae is None:
-#                 raise RuntimeError(
-#                     "LER requires SOAP to be generated first")
-            for unique in U['centers'].values():
-                dist = np.linalg.norm(unique - lae)
-                if dist < eps:
-                    break
-            else:
-                U['centers'][(aid, lae_num)] = np.copy(lae)
+
+    if previous is not None:
+        _, prev_info = previous
+        prev_aids = prev_info.get("aids")
+        if prev_aids is None or not set(prev_aids).issubset(collection):
+            print("Previous LER result does not match this collection, recomputing from scratch.")
+            previous = None
+
+    # Part 1: Clustering
+    print("Clustering")
+    if previous is None:
+        import pyrelate.elements as elements
+        if seed is None:
+            seed = elements.seed(next(iter(collection.values())).get_chemical_symbols()[0], soap_fcn, **based_on[1])
+        prev_centers = clustering.ClusterCenters.from_items([(('0', 0), seed)])
+    else:
+        # only the LAEs of new aids are clustered, against the centers found previously
+        prev_centers = clustering.ClusterCenters.from_dict(prev_info["cluster_centers"])
+        prev_set = set(prev_aids)
+        aids = [aid for aid in aids if aid not in prev_set]
+    N_prev = len(prev_centers)
+    initial = np.asarray(prev_centers.vectors, dtype=float)
+    centers_file = None
+    if mmap_centers:
+        import tempfile
+        fd, centers_file = tempfile.mkstemp(suffix=".dat", dir=collection.store.root)
+        os.close(fd)
+    try:
+        # all centers are kept in a single growable array, which the new centers are appended to
+        centers = clustering.GrowableArray(initial.shape[1], N_prev + 1024, path=centers_file)
+        centers.extend(initial)
+        if engine == "grid":
+            from functools import partial
+            keys, _ = clustering.grid(partial(_get_laes, collection.store, based_on), aids, centers, eps, **engine_args)
+        elif engine != "leader":
+            from functools import partial
+            keys, vectors = clustering.engines[engine](partial(_get_laes, collection.store, based_on), aids, initial, max_memory=max_memory, **engine_args)
+            centers.extend(vectors)
+        elif n_jobs is not None and n_jobs > 1 and not exact_clustering:
+            keys, vectors = _parallel_leader_cluster(collection.store, based_on, aids, initial, eps, dedup_tol, n_jobs, max_memory, distance)
+            centers.extend(vectors)
+        else:
+            keys, _ = _leader_cluster(collection.store, based_on, aids, centers, eps, dedup_tol, True, max_memory, None, distance)
+    finally:
+        if centers_file is not None:
+            # the centers stay memory-mapped, until they are no longer used, once the file is removed
+            os.remove(centers_file)
+    cluster_centers = prev_centers.extend(keys, centers.array, appended=True)
 
     # TODO sort the unique bins
 
     # Part 2: Classifying
     print("Classifying and calculating LER")
-    dim = len(seed)
-    a = AnnoyIndex(dim, metric)
-    for i, unique in enumerate(U['centers'].values()):
-        a.add_item(i, unique)
-    a.build(n_trees)
-    a.save('tmp')  # TODO find better way to save temporary file
-    
-    N_unique = len(U['centers'])
-    ler_matrix = np.zeros((len(collection), N_unique))
-    for i, aid in enumerate(tqdm(collection.aids())): #collection.aids():
-        soap = collection.get_description(aid, based_on[0], **based_on[1])
-        for lae_num, lae in enumerate(soap):
-            nni = a.get_nns_by_vector(
-                lae, 1, search_k=search_k, include_distances=False)[0]
-            ler_matrix[i, nni] += 1    
-    os.remove('tmp')
+    centers = cluster_centers.vectors
+    if previous is not None and len(centers) > N_prev:
+        # earlier LAEs may be closer to a new center than to their own, so every aid is classified again
+        previous = None
+    if previous is None:
+        to_classify = collection.aids()
+    else:
+        to_classify = [aid for aid in collection.aids() if aid not in prev_set]
+    # the centers are kept in the store as a single memory-mappable array when the result is stored, unchanged
+    # centers keep using the array of the previous result
+    if previous is not None and prev_centers.path is not None:
+        cluster_centers.path = prev_centers.path
+    info = {}
+    if nn_backend == "annoy":
+        # the index is kept next to the result when it is stored, so it can be reused (see ler_classify)
+        if previous is not None and "center_index" in prev_info:
+            center_index = prev_info["center_index"]
+        else:
+            center_index = clustering.CenterIndex(centers, metric, n_trees)
+        nn_args.update(index=center_index.file, metric=center_index.metric)
+        info["center_index"] = center_index
+    counts = _count_ler(collection.store, based_on, to_classify, centers, nn_backend, nn_args, dedup_tol, n_jobs, max_memory, sparse)
+
+    if previous is not None:
+        # the counts of the earlier aids still hold for the same centers
+        prev_count = prev_info["ler_matrix_count"]
+        if sparse:
+            from scipy.sparse import csr_matrix, vstack
+            stacked = vstack([csr_matrix(prev_count), counts]).tocsr()
+        else:
+            stacked = np.vstack((prev_count, counts))
+        row = {aid: i for i, aid in enumerate(prev_aids)}
+        row.update((aid, len(prev_aids) + i) for i, aid in enumerate(to_classify))
+        ler_matrix = stacked[[row[aid] for aid in collection.aids()]]
+    else:
+        ler_matrix = counts
 
     # divide each LER vector by the sum of its elements (get percentages)
-    ler_matrix_count = ler_matrix.copy() #leave a copy of the matrix in info from before you divide 
-    # each LER vector by it's sum
-    ler_matrix = (ler_matrix.T/np.sum(ler_matrix, axis=1)).T
+    # leave a copy of the matrix in info from before you divide each LER vector by it's sum
+    ler_matrix_count = ler_matrix.copy()
+    ler_matrix = _normalize_ler(ler_matrix)
+
+    info.update({
+        "dissimilarity": dissimilarity if isinstance(dissimilarity, str) else None,  # name of a built-in metric
+        "num_clusters": len(cluster_centers),
+        "cluster_centers": cluster_centers,  # clustering.ClusterCenters, a dictionary view keyed by (aid, lae_num)
+        "ler_matrix_count": ler_matrix_count,  # ler matrix with counts of how many of each unique LAE type is contained
+        "aids": collection.aids(),  # aid of each row of the LER matrix
+    })
+    return ler_matrix, info
+
+
+def _normalize_ler(ler_matrix):
+    """Divide each row of a (dense or scipy.sparse) count matrix by its sum."""
+    if isinstance(ler_matrix, np.ndarray):
+        return (ler_matrix.T / np.sum(ler_matrix, axis=1)).T
+    from scipy.sparse import diags
+    return (diags(1 / np.asarray(ler_matrix.sum(axis=1)).ravel()) @ ler_matrix).tocsr()
 
+
+def _get_laes(store, based_on, aid):
+    """LAE matrix of an aid from the store."""
+    soap = store.get_description(aid, based_on[0], **based_on[1])
+    if soap is None:
+        raise RuntimeError(f"No {based_on[0]} results found for aid {aid}.")
+    return np.asarray(soap, dtype=float)
+
+
+def _leader_cluster(store, based_on, aids, initial, eps, dedup_tol=None, progress=True, max_memory=None, centers_file=None, dissimilarity=None):
+    """Greedy clustering of the LAEs of the given aids, in order, starting from the `initial` centers. Descriptions
+    are read one aid at a time, and the centers are kept in a single growable array: `initial` itself if it is a
+    `clustering.GrowableArray`, which the new centers are then appended to, or a new one (memory-mapped to
+    `centers_file` if given). With `dedup_tol`, duplicates of an LAE seen before are skipped, as they can never
+    become a center. With `max_memory`, the digests of the LAEs seen are kept to a quarter of it, and forgotten
+    when they outgrow it. LAEs are compared with `dissimilarity` (euclidean if None), see `clustering.leader`.
+
+    Returns:
+        Tuple (keys, vectors) of the new centers, with keys (aid, lae_num) giving where each center was found. The
+        vectors are a view of the rows of the growable array.
+    """
+    from pyrelate import clustering
+    if isinstance(initial, clustering.GrowableArray):
+        centers = initial
+    else:
+        initial = np.asarray(initial, dtype=float)
+        centers = clustering.GrowableArray(initial.shape[1], len(initial) + 1024, path=centers_file)
+        centers.extend(initial)
+    n_initial = len(centers)
+    dim = centers.array.shape[1]
+    keys = []
+    seen = set()
+    # about 100 bytes per digest in the set
+    max_seen = None if max_memory is None else max(1, max_memory // 400)
+    for aid in tqdm(aids, disable=not progress):
+        soap = store.get_description(aid, based_on[0], **based_on[1])
+        if soap is None:
+            raise RuntimeError(f"No {based_on[0]} results found for aid {aid}.")
+        soap = np.asarray(soap, dtype=float).reshape(-1, dim)
+        lae_nums = np.arange(len(soap))
+        if dedup_tol is not None:
+            if max_seen is not None and len(seen) > max_seen:
+                seen.clear()
+            lae_nums = []
+            for lae_num, key in enumerate(clustering.row_keys(soap, dedup_tol)):
+                # a short digest keeps the set of LAEs seen small
+                key = clustering._digest(key)
+                if key not in seen:
+                    seen.add(key)
+                    lae_nums.append(lae_num)
+            lae_nums = np.array(lae_nums, dtype=np.intp)
+
+        new = lae_nums[clustering.leader(soap[lae_nums], centers, eps, max_memory=max_memory, dissimilarity=dissimilarity)]
+        keys.extend((aid, int(lae_num)) for lae_num in new)
+    return keys, centers.array[n_initial:]
+
+
+def _parallel_leader_cluster(store, based_on, aids, initial, eps, dedup_tol, n_jobs, max_memory=None, dissimilarity=None):
+    """Map-reduce version of `_leader_cluster`: the leaders of each shard of aids are found in parallel, sharing
+    max_memory, then clustered again (in shard order) to give the final centers."""
+    from pyrelate import clustering
+    from concurrent.futures import ProcessPoolExecutor
+    shards = [list(shard) for shard in np.array_split(np.array(aids, dtype=object), n_jobs) if len(shard) > 0]
+    shard_memory = None if max_memory is None else max_memory // len(shards)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(_leader_cluster, store, based_on, shard, initial, eps, dedup_tol, False, shard_memory, None, dissimilarity) for shard in shards]
+        local = [future.result() for future in futures]
+
+    keys = [key for shard_keys, _ in local for key in shard_keys]
+    vectors = np.concatenate([initial[:0]] + [shard_vectors for _, shard_vectors in local])
+    merged = clustering.leader(vectors, initial, eps, max_memory=max_memory, dissimilarity=dissimilarity)
+    return [keys[i] for i in merged], vectors[merged]
+
+
+def _count_ler(store, based_on, aids, centers, nn_backend, nn_args, dedup_tol=None, n_jobs=None, max_memory=None, sparse=False, progress=True):
+    """Classify all LAEs of the given aids to their nearest center, returning a (len(aids) x N_centers) matrix of counts.
+    Descriptions are read and classified in chunks of about half of max_memory left once the dense count matrix is
+    allocated (all at once if None), and each chunk only counts into its own rows.
+    With `dedup_tol`, each unique LAE of a chunk is classified once and counted with its multiplicity per aid.
+    With `n_jobs`, the aids are split into shards classified in parallel, sharing max_memory. With `sparse`, counts
+    are a CSR matrix."""
+    if sparse:
+        from scipy.sparse import csr_matrix, vstack
+        counts = csr_matrix((len(aids), len(centers)))
+    else:
+        counts = np.zeros((len(aids), len(centers)))
+    counts_bytes = 0 if sparse else counts.nbytes
+    if max_memory is not None and counts_bytes >= max_memory:
+        raise ValueError(f"The LER count matrix ({counts_bytes} bytes) does not fit in max_memory, use sparse=True.")
+    if len(aids) == 0:
+        return counts
+    if n_jobs is not None and n_jobs > 1 and len(aids) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        if nn_backend == "kdtree":
+            # each process already works on its own shard
+            nn_args = dict(nn_args, workers=1)
+        shards = [list(shard) for shard in np.array_split(np.array(aids, dtype=object), n_jobs) if len(shard) > 0]
+        shard_memory = None if max_memory is None else max_memory // len(shards)
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_count_ler, store, based_on, shard, centers, nn_backend, nn_args, dedup_tol, None, shard_memory, sparse, False) for shard in shards]
+            shard_counts = [future.result() for future in futures]
+            return vstack(shard_counts).tocsr() if sparse else np.concatenate(shard_counts)
+
+    chunk_bytes = None if max_memory is None else (max_memory - counts_bytes) // 2
+    # classify the LAEs of a chunk of aids at once, keeping track of the row (aid) each LAE belongs to
+    laes = []
+    rows = []
+    size = 0
+    start = 0
+    chunks = []
+    for i, aid in enumerate(tqdm(aids, disable=not progress)):
+        soap = store.get_description(aid, based_on[0], **based_on[1])
+        laes.append(np.asarray(soap, dtype=float).reshape(-1, centers.shape[1]))
+        rows.append(np.full(len(laes[-1]), i - start, dtype=np.intp))
+        size += laes[-1].nbytes
+        if (chunk_bytes is not None and size >= chunk_bytes) or i == len(aids) - 1:
+            chunk = _count_chunk(np.concatenate(laes), np.concatenate(rows), i + 1 - start, centers, nn_backend, nn_args, dedup_tol, sparse)
+            if sparse:
+                chunks.append(chunk)
+            else:
+                counts[start:i + 1] += chunk
+            laes = []
+            rows = []
+            size = 0
+            start = i + 1
+    return vstack(chunks).tocsr() if sparse else counts
+
+
+def _count_chunk(laes, rows, n_rows, centers, nn_backend, nn_args, dedup_tol=None, sparse=False):
+    """Counts of the nearest centers of a chunk of LAEs, see `_count_ler`."""
+    from pyrelate import clustering
+    if dedup_tol is None:
+        labels = clustering.classify(laes, centers, nn_backend=nn_backend, **nn_args)
+        return clustering.count(labels, rows, n_rows, len(centers), sparse=sparse)
+
+    first, inverse, _ = clustering.unique_rows(laes, dedup_tol)
+    unique_labels = clustering.classify(laes[first], centers, nn_backend=nn_backend, **nn_args)
+    # (aid, unique LAE) pairs with their multiplicity
+    pairs, multiplicity = np.unique(rows * len(first) + inverse, return_counts=True)
+    pair_rows, pair_unique = np.divmod(pairs, len(first))
+    return clustering.count(unique_labels[pair_unique], pair_rows, n_rows, len(centers), weights=multiplicity, sparse=sparse)
+
+
+def ler_classify(collection, based_on, basis, nn_backend="annoy", search_k=-1, dedup_tol=0, n_jobs=None, max_memory=None, sparse=False, dissimilarity=None, dissim_args=None, nn_threads=None):
+    '''Compute the LER of a collection against the cluster centers of a previously computed LER result, without
+    clustering again. When the basis was computed with the "annoy" backend, its index is memory-mapped from the Store
+    instead of being rebuilt.
+
+        Parameters:
+            collection(AtomsCollection): AtomsCollection to be classified, it must share its Store with the collection
+            the basis was computed for.
+            based_on( (string, dict) ): holds necessary info to fetch results from the Store. String
+            is the descriptor name, dictionary holds the keyword arguments. Must match the description the basis was built on.
+            basis (dict or np.ndarray): info dictionary of a stored LER result, e.g. from `get_collection_result("ler", ..., metadata=True)[1]`,
+            or the (N_centers x dim) matrix of the cluster centers, e.g. `basis["cluster_centers"].vectors`. Pass the
+            matrix to store the result with `process`, so it can be looked up by its arguments.
+            nn_backend(str): "annoy", "kdtree" or "brute", see `ler`.
+            search_k(int): For approximate nearest neighbor calculation. See Annoy's documentation for more details.
+            dedup_tol(float): classify LAEs equal up to this tolerance only once, see `ler`. Defaults to 0, exact
+            duplicates only.
+            n_jobs(int): number of processes classifying the aids in parallel. Defaults to None (serial).
+            max_memory(int): approximate bound in bytes on the memory used for LAEs, see `ler`.
+            sparse(bool): return scipy.sparse CSR matrices, see `ler`.
+            dissimilarity (str or function): metric used by the "brute" backend, defaults to the built-in metric the
+            basis was computed with (euclidean if it was a custom function, which is not stored).
+            dissim_args (dict): additional arguments for the dissimilarity metric.
+            nn_threads(int): number of threads querying the Annoy index, see `ler`.
+
+        Example:
+            .. code-block:: python
+
+                _, basis = s5.get_collection_result("ler", ("soap", soap_args), metadata=True, **ler_args)
+                ler_matrix, info = ler_classify(new_col, ("soap", soap_args), basis)
+    '''
+    cluster_centers, centers, nn_args = _classify_args(collection.store, basis, nn_backend, search_k, max_memory, dissimilarity, dissim_args, nn_threads)
+    ler_matrix_count = _count_ler(collection.store, based_on, collection.aids(), centers, nn_backend, nn_args, dedup_tol, n_jobs, max_memory, sparse)
+    ler_matrix = _normalize_ler(ler_matrix_count)
     info = {
-        "num_clusters": len(U['centers']),
-        "cluster_centers": U['centers'], 
-        "ler_matrix_count": ler_matrix_count # ler matrix with counts of how many of each unique LAE type is contained
+        "num_clusters": len(centers),
+        "cluster_centers": cluster_centers,
+        "ler_matrix_count": ler_matrix_count,
+        "aids": collection.aids(),
     }
     return ler_matrix, info
 
-# def gaussian_dissimilarity(lae1, lae2, gamma):
-#     """Gaussian (RBF) dissimilarity metric (used with LER) that varies between 0 and 1.
-
-#     This metric is given by :math:`1 - \exp{(-\gamma*||x - x'||^2)}`. A dissimilarity value closer to 0 means the LAEs are more similar, while closer to 1 means more dissimilar.
-
-#     Parameters:
-#         lae1 (np.array): first lae to compare
-#         lae2 (np.array): second lae to compare
-#         gamma (float): gamma value
-#     """
-#     diff = lae1 - lae2
-#     gker = 1 - np.exp((-gamma * (np.linalg.norm(diff)**2)))
-#     return gker
-
-# def ler(collection, based_on, eps, dissimilarity=gaussian_dissimilarity, dissim_args={}, soap_fcn=None, seed=None, metric='euclidean', n_trees=10, search_k=-1, **kwargs):
-#     '''Local Environment Representation
-
-#         Parameters:
-#             collection(AtomsCollection): AtomsCollection the description will be based on, needed
-#             for fetching previously calculated descriptions from the store.
-#             based_on( (string, dict) ): holds necessary info to fetch results from the Store. String
-#             is the descriptor name, dictionary holds the keyword arguments. 
-#             eps (float): epsilon value indicating that any LAE's outside this value are considered dissimilar. Descriptor and dissimilarity metric specific.
-#             dissimilarity (function): dissimilarity metric function that has the first 2 parameters as the 2 LAE's to be compared.
-#             dissim_args (dict): dictionary with any additional hyperparameter arguments for the given dissimilarity metric.
-#             soap_fcn (function): optional parameter for a function to compute SOAP matrix for the element's perfect crystal on the fly. Defaults to None. When None, 'soap' function in descriptors.py will be used.
-#             seed(np.ndarray or list): perfect seed for the element being considered. Defaults to None. When None, seed will be generated on the fly with soap_fcn.
-#             metric(str): For approximate nearest neighbor calculation. See Annoy's documentation for more details.
-#             n_trees(int): For approximate nearest neighbor calculation. See Annoy's documentation for more details.
-#             search_k(int): For approximate nearest neighbor calculation. See Annoy's documentation for more details.
-#             soapargs (dict): Parameters associated with the SOAP description being used.
-#             `Annoy's documentation <https://github.com/spotify/annoy>`_.
-#     '''
-
-#     from collections import OrderedDict
-#     U = {
-#         'centers': OrderedDict(),
-#         'clusters': {}
-#     }
-
-#     # Part 1: Clustering
-#     import pyrelate.elements as elements
-#     if seed is None:
-#         seed = elements.seed(list(collection.values())[0].get_chemical_symbols()[0], soap_fcn, **based_on[1])
-#     U['centers'][('0', 0)] = seed
-#     # print("Part 1: Clustering (for each LAE in each GB)")
-#     for aid in collection:
-#         soap = collection.get_description(aid, based_on[0], **based_on[1])
-#         for lae_num, lae in enumerate(soap):
-#             if lae is None:
-#                 raise RuntimeError(
-#                     "LER requires SOAP to be generated first")
-#             for unique in U['centers'].values():
-#                 dist = dissimilarity(unique, lae, **dissim_args)
-#                 if dist < eps:
-#                     break
-#             else:
-#                 U['centers'][(aid, lae_num)] = np.copy(lae)
-#     # TODO sort the unique bins
-
-#     # Part 2: Classifying
-#     from annoy import AnnoyIndex
-#     dim = len(seed)
-#     a = AnnoyIndex(dim, metric)
-#     for i, unique in enumerate(U['centers'].values()):
-#         a.add_item(i, unique)
-#     a.build(n_trees)
-#     a.save('tmp')  # TODO find better way to save temporary file
-#     for aid in collection:
-#         soap = collection.get_description(aid, based_on[0], **based_on[1])
-#         for lae_num, lae in enumerate(soap):
-#             nni = a.get_nns_by_vector(
-#                 lae, 1, search_k=search_k, include_distances=False)[0]
-#             cluster = list(U['centers'].keys())[nni]
-#             # TODO when we sort just fill the empty lists first
-#             if cluster not in U['clusters']:
-#                 U['clusters'][cluster] = []
-#             U['clusters'][cluster].append((aid, lae_num))
-#     import os
-#     os.remove('tmp')
-
-#     # Calculate LER
-#     ler_matrix = []
-#     for aid in collection.aids():
-#         result = np.zeros(len(U['clusters']))
-#         for uid, (center, cluster) in enumerate(U['clusters'].items()):
-#             result[uid] = np.count_nonzero(
-#                 np.array([c[0] for c in cluster]) == aid)
-#         result = result / np.sum(result)
-#         ler_matrix.append(result)
-
-#     info = {
-#         "num_clusters": len(U['centers']),
-#         "cluster_centers": U['centers']
-#     }
-#     return np.array(ler_matrix), info
+
+def _classify_args(store, basis, nn_backend, search_k=-1, max_memory=None, dissimilarity=None, dissim_args=None, nn_threads=None):
+    """Cluster centers of an LER basis (see `ler_classify`), as stored in the result and as a matrix, and the
+    arguments of the nearest neighbor backend."""
+    from pyrelate import clustering
+    if isinstance(basis, dict):
+        cluster_centers = clustering.ClusterCenters.from_dict(basis["cluster_centers"]).copy()
+        centers = cluster_centers.vectors
+    else:
+        cluster_centers = centers = np.asarray(basis, dtype=float)
+        basis = {}
+    if nn_backend == "annoy":
+        nn_args = {"search_k": search_k, "n_threads": nn_threads}
+        if "center_index" in basis:
+            nn_args["index"] = basis["center_index"].file
+            nn_args["metric"] = basis["center_index"].metric
+    elif nn_backend == "brute":
+        if dissimilarity is None:
+            dissimilarity = basis.get("dissimilarity") or "euclidean"
+        nn_args = {"dissimilarity": clustering.get_metric(dissimilarity, **(dissim_args or {})), "max_memory": max_memory}
+    else:
+        nn_args = {}
+    return cluster_centers, centers, nn_args
+
+
+class _LERCounter:
+    """Streaming version of `ler_classify`: the LAEs of each aid are classified as soon as its description is added,
+    against indexes built once. See `streaming_consumer`."""
+
+    def __init__(self, store, n_rows, basis, nn_backend="annoy", search_k=-1, dedup_tol=None, max_memory=None, sparse=False, dissimilarity=None, dissim_args=None, n_trees=10, nn_threads=None):
+        from pyrelate import clustering
+        self.cluster_centers, self.centers, self.nn_args = _classify_args(store, basis, nn_backend, search_k, max_memory, dissimilarity, dissim_args, nn_threads)
+        self.nn_backend = nn_backend
+        self.dedup_tol = dedup_tol
+        self.sparse = sparse
+        if nn_backend == "annoy" and "index" not in self.nn_args:
+            self.nn_args["index"] = clustering.build_index(self.centers, self.nn_args.get("metric", "euclidean"), n_trees)
+        elif nn_backend == "kdtree":
+            from scipy.spatial import cKDTree
+            self.nn_args["tree"] = cKDTree(self.centers)
+        self.rows = [None] * n_rows
+
+    def add(self, row, desc):
+        desc = np.asarray(desc, dtype=float).reshape(-1, self.centers.shape[1])
+        self.rows[row] = _count_chunk(desc, np.zeros(len(desc), dtype=np.intp), 1, self.centers, self.nn_backend, self.nn_args, self.dedup_tol, self.sparse)
+
+    def result(self, aids):
+        if self.sparse:
+            from scipy.sparse import vstack
+            ler_matrix_count = vstack(self.rows).tocsr()
+        else:
+            ler_matrix_count = np.concatenate(self.rows)
+        info = {
+            "num_clusters": len(self.centers),
+            "cluster_centers": self.cluster_centers,
+            "ler_matrix_count": ler_matrix_count,
+            "aids": list(aids),
+        }
+        return _normalize_ler(ler_matrix_count), info
+
+
+def streaming_consumer(method, collection, based_on, **kwargs):
+    """Consumer computing the result of `process(method, based_on, **kwargs)` one description at a time, as the
+    descriptions are computed, so they never have to be read back from the Store. Supported methods are "asr", "sum",
+    "reduce" and "ler_classify" (with `basis` given as the matrix of centers to store the result).
+
+    Returns:
+        Object with `add(row, desc)`, to be called with the description of the aid of every row of the collection
+        (in any order), and `result(aids)` giving the same (result, info) as the method.
+    """
+    from pyrelate import reductions
+    n_rows = len(collection)
+    if method == "asr":
+        return reductions.Reducer(["norm_mean" if kwargs.get("norm_asr", False) else "mean"], n_rows)
+    elif method == "sum":
+        return reductions.Reducer(["sum"], n_rows)
+    elif method == "reduce":
+        return reductions.Reducer(kwargs.get("reductions", ("mean",)), n_rows)
+    elif method == "ler_classify":
+        kwargs = {key: value for key, value in kwargs.items() if key != "n_jobs"}
+        return _LERCounter(collection.store, n_rows, **kwargs)
+    raise ValueError(f"Method '{method}' cannot be computed while describing, expected 'asr', 'sum', 'reduce' or 'ler_classify'.")
@@ -0,0 +1,171 @@
+'''Fast reader for LAMMPS text dump files ("lammps-dump-text"), used by `AtomsCollection.read`.
+
+ASE's reader goes through the file line by line in Python. Here only the few header lines of each timestep are parsed
+in Python, and each block of atoms is converted with a single call to NumPy's C parser. The Atoms objects are then
+built with ASE's own conversion, so they are the same as those returned by `ase.io.read`. Timesteps (frames) are read
+one at a time, so trajectories can be streamed without holding them in memory.
+
+The conversion functions are internal to ASE's reader: callers check `available` and fall back to `ase.io.read` if
+they cannot be imported. Files are recognized by their first line (see `is_dump_text`), as ASE's format detection
+does not recognize LAMMPS text dumps.
+'''
+import numpy as np
+from io import BytesIO
+from itertools import islice
+
+
+def available():
+    """Whether the ASE functions the Atoms objects are built with can be imported."""
+    try:
+        from ase.io.lammpsrun import construct_cell, lammps_data_to_ase_atoms  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def is_dump_text(path):
+    """Whether an (uncompressed) file is a LAMMPS text dump, i.e. starts with a timestep."""
+    try:
+        with open(path, "rb") as f:
+            return f.readline().startswith(b"ITEM: TIMESTEP")
+    except OSError:
+        return False
+
+
+def _next_line(f):
+    """Next line of a binary file, decoded."""
+    line = f.readline()
+    if not line:
+        raise ValueError("Unexpected end of the dump file.")
+    return line.decode()
+
+
+def _frames(f, wanted=None):
+    """Yield (offset, n_atoms, colnames, cell, celldisp, pbc, block) for every timestep of an open binary dump file,
+    starting from its current position. `offset` is the position of the timestep in the file and `block` the bytes of
+    its rows of atoms, or None for timesteps whose index is not `wanted` (a function of the index)."""
+    from ase.io.lammpsrun import construct_cell
+    n_atoms = 0
+    cell = celldisp = None
+    pbc = (False,) * 3
+    offset = f.tell()
+    index = 0
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line:
+            return
+        line = line.decode()
+        if line.startswith("ITEM: TIMESTEP"):
+            offset = pos
+        elif line.startswith("ITEM: NUMBER OF ATOMS"):
+            n_atoms = int(_next_line(f).split()[0])
+        elif line.startswith("ITEM: BOX BOUNDS"):
+            tilt_items = line.split()[3:]
+            celldata = np.array([_next_line(f).split() for _ in range(3)], dtype=float)
+            diagdisp = celldata[:, :2].reshape(6, 1).flatten()
+            if celldata.shape[1] > 2:
+                offdiag = celldata[:, 2]
+                if len(tilt_items) >= 3:
+                    offdiag = offdiag[[tilt_items.index(i) for i in ["xy", "xz", "yz"]]]
+            else:
+                offdiag = (0.0,) * 3
+            cell, celldisp = construct_cell(diagdisp, offdiag)
+            if len(tilt_items) > 3:
+                pbc = ["p" in d.lower() for d in tilt_items[3:]]
+            else:
+                pbc = (False,) * 3
+        elif line.startswith("ITEM: ATOMS"):
+            colnames = line.split()[2:]
+            if wanted is None or wanted(index):
+                block = b"".join(islice(f, n_atoms))
+            else:
+                block = None
+                for _ in islice(f, n_atoms):
+                    pass
+            yield offset, n_atoms, colnames, cell, celldisp, pbc, block
+            index += 1
+
+
+def _to_atoms(frame):
+    """Atoms object of a timestep yielded by `_frames`."""
+    from ase.atoms import Atoms
+    from ase.io.lammpsrun import lammps_data_to_ase_atoms
+    _, n_atoms, colnames, cell, celldisp, pbc, block = frame
+    # the whole block of atoms at once
+    data = np.loadtxt(BytesIO(block), dtype=float, ndmin=2) if n_atoms > 0 else np.empty((0, len(colnames)))
+    if data.shape != (n_atoms, len(colnames)):
+        raise ValueError(f"Expected {n_atoms} rows of {len(colnames)} columns in the dump file.")
+
+    def atomsobj(symbols, **kwargs):
+        # the types are already atomic numbers, no need to look them up one by one
+        return Atoms(numbers=np.asarray(symbols), **kwargs)
+
+    return lammps_data_to_ase_atoms(data=data, colnames=colnames, cell=cell, celldisp=celldisp, atomsobj=atomsobj, pbc=pbc)
+
+
+def read_dump_text(path, index=-1):
+    """Read a LAMMPS text dump file, as `ase.io.read(path, index, format="lammps-dump-text")` does.
+
+    Parameters:
+        path (str): path of the dump file.
+        index (int or slice): timestep(s) to return. Defaults to -1, the last one.
+
+    Returns:
+        ASE Atoms object, or list of Atoms objects if `index` is a slice.
+    """
+    with open(path, "rb") as f:
+        if index == -1:
+            # only the rows of the last timestep are kept
+            frames = []
+            for frame in _frames(f):
+                frames = [frame]
+        else:
+            frames = list(_frames(f))
+    if len(frames) == 0:
+        raise ValueError(f"No atoms found in {path}.")
+    if isinstance(index, slice):
+        return [_to_atoms(frame) for frame in frames[index]]
+    return _to_atoms(frames[index])
+
+
+def iread_dump_text(path, index=slice(None)):
+    """Generator reading the timesteps of a LAMMPS text dump file one at a time.
+
+    Parameters:
+        path (str): path of the dump file.
+        index (slice): timesteps to read, with non-negative bounds. Defaults to all of them. The rows of atoms of the
+        other timesteps are skipped without being parsed.
+
+    Yields:
+        Tuple (frame, offset, atoms): index of the timestep in the file, position of the timestep in the file (see
+        `read_dump_frame`) and its ASE Atoms object.
+    """
+    selected = frame_range(index)
+    with open(path, "rb") as f:
+        for i, frame in enumerate(_frames(f, wanted=selected.__contains__)):
+            if i >= selected.stop:
+                return
+            if frame[-1] is not None:
+                yield i, frame[0], _to_atoms(frame)
+
+
+def read_dump_frame(path, offset):
+    """Read the timestep starting at the given position (as yielded by `iread_dump_text`) of a LAMMPS text dump file.
+
+    Returns:
+        ASE Atoms object.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for frame in _frames(f):
+            return _to_atoms(frame)
+    raise ValueError(f"No atoms found in {path} at position {offset}.")
+
+
+def frame_range(index):
+    """Range of the timestep indices selected by a slice with non-negative bounds (open-ended if it has no stop)."""
+    start, stop, step = index.start or 0, index.stop, index.step or 1
+    if start < 0 or (stop is not None and stop < 0) or step < 1:
+        raise ValueError("Timesteps must be given as a slice with non-negative bounds and a positive step.")
+    return range(start, stop if stop is not None else np.iinfo(np.int64).max, step)
@@ -0,0 +1,175 @@
+'''Row-wise reductions of descriptor matrices into a single vector per aid (e.g. ASR), computed in one streaming pass.
+
+A reduction is a function taking the (N_atoms x dim) description of an aid and returning a vector. Several
+reductions over the same description are fused: each description is read from the Store once, and every reduction
+writes its columns directly into a preallocated output matrix.
+'''
+import numpy as np
+
+
+def mean(desc):
+    """Average of the rows."""
+    return np.average(desc, axis=0)
+
+
+def norm_mean(desc):
+    """Average of the rows, normalized to unit length."""
+    row = np.average(desc, axis=0)
+    return row / np.linalg.norm(row)
+
+
+def sum_(desc):
+    """Sum of the rows."""
+    return np.sum(desc, axis=0)
+
+
+def max_(desc):
+    """Maximum of each column."""
+    return np.max(desc, axis=0)
+
+
+def min_(desc):
+    """Minimum of each column."""
+    return np.min(desc, axis=0)
+
+
+def var(desc):
+    """Variance of each column."""
+    return np.var(desc, axis=0)
+
+
+def moment(desc, order=3):
+    """Central moment of the given order of each column."""
+    return np.mean((desc - np.average(desc, axis=0))**order, axis=0)
+
+
+reducers = {
+    "mean": mean,
+    "norm_mean": norm_mean,
+    "sum": sum_,
+    "max": max_,
+    "min": min_,
+    "var": var,
+    "moment": moment,
+}
+"""dict: built-in reductions by name (the functions for "sum", "max" and "min" have a trailing underscore so they do not
+shadow the builtins)."""
+
+
+def _resolve(reduction):
+    """(name, function) of a reduction given by name, as a (name, dict of arguments) tuple, or as a function."""
+    if callable(reduction):
+        return reduction.__name__, reduction
+    args = {}
+    if isinstance(reduction, tuple):
+        reduction, args = reduction
+    if reduction not in reducers:
+        raise ValueError(f"Unknown reduction '{reduction}', expected one of {list(reducers)} or a function.")
+    fcn = reducers[reduction]
+    if args:
+        from functools import partial
+        fcn = partial(fcn, **args)
+        reduction += "(" + ", ".join(f"{key}={value}" for key, value in sorted(args.items())) + ")"
+    return reduction, fcn
+
+
+class Reducer:
+    """Streaming, fused application of reductions: descriptions are added one aid (row) at a time, in any order, and
+    every reduction writes its columns into an output matrix preallocated when the first description is added.
+
+    Parameters:
+        reductions (list): reductions to apply, see `reduce`.
+        n_rows (int): number of rows (aids) of the output.
+    """
+
+    def __init__(self, reductions, n_rows):
+        self.resolved = [_resolve(reduction) for reduction in reductions]
+        self.names = [name for name, _ in self.resolved]
+        self.n_rows = n_rows
+        self.matrix = None
+        self.columns = None
+
+    def allocate(self, lengths):
+        """Preallocate the output for reductions returning vectors of the given lengths."""
+        self.columns = {}
+        start = 0
+        for name, length in zip(self.names, lengths):
+            self.columns[name] = (start, start + length)
+            start += length
+        self.matrix = np.empty((self.n_rows, start))
+
+    def add(self, row, desc):
+        """Reduce the description of the aid of the given row."""
+        rows = [np.asarray(fcn(desc), dtype=float).ravel() for _, fcn in self.resolved]
+        if self.matrix is None:
+            self.allocate([len(r) for r in rows])
+        for name, r in zip(self.names, rows):
+            self.matrix[row, self.columns[name][0]:self.columns[name][1]] = r
+
+    def result(self, aids):
+        """Tuple (matrix, info) once every row was added, see `reduce`."""
+        if self.matrix is None:
+            self.allocate([0] * len(self.names))
+        return self.matrix, {"reductions": self.names, "columns": self.columns, "aids": list(aids)}
+
+
+def reduce(collection, based_on, reductions=("mean",), n_jobs=None, previous=None):
+    """Apply one or more row-wise reductions to the description of every aid of a collection, reading each
+    description once.
+
+    Parameters:
+        collection(AtomsCollection): AtomsCollection the reductions are based on, needed for fetching previously
+        calculated descriptions from the store.
+        based_on( (string, dict) ): holds necessary info to fetch results from the Store. String
+        is the descriptor name, dictionary holds the keyword arguments.
+        reductions (list): reductions to apply, each either the name of a built-in reduction (see `reducers`), a
+        (name, dict of arguments) tuple such as ("moment", {"order": 4}), or a function of the description matrix.
+        n_jobs (int): number of threads reducing aids in parallel. Defaults to None (serial).
+        previous( (np.ndarray, dict) ): a previous result of the same reductions and its info dictionary, passed by
+        `AtomsCollection.process` when called with `update=True`. Only the rows of aids not in the previous result are
+        computed.
+
+    Returns:
+        Tuple (matrix, info): the (N_aids x sum of the reductions' lengths) matrix, with the reductions side by side
+        in the given order, and a dictionary with the column range of each reduction under "columns" and the aid of
+        each row under "aids".
+
+    Example:
+        .. code-block:: python
+
+            matrix, info = reduce(my_col, ("soap", soap_args), ["mean", "var", ("moment", {"order": 3})])
+            start, stop = info["columns"]["var"]
+            variances = matrix[:, start:stop]
+    """
+    aids = collection.aids()
+    reducer = Reducer(reductions, len(aids))
+
+    prev_rows = {}
+    if previous is not None:
+        prev_matrix, prev_info = previous
+        if prev_info.get("reductions") == reducer.names and "aids" in prev_info:
+            prev_rows = {aid: row for row, aid in enumerate(prev_info["aids"])}
+        else:
+            print("Previous result does not match these reductions, recomputing from scratch.")
+    to_reduce = [i for i, aid in enumerate(aids) if aid not in prev_rows]
+
+    def fill(i):
+        reducer.add(i, collection.get_description(aids[i], based_on[0], **based_on[1]))
+
+    # the first description gives the length of every reduction, to preallocate the output
+    if len(to_reduce) > 0:
+        fill(to_reduce[0])
+    elif len(prev_rows) > 0:
+        reducer.allocate([stop - start for start, stop in prev_info["columns"].values()])
+    for i, aid in enumerate(aids):
+        if aid in prev_rows:
+            reducer.matrix[i] = prev_matrix[prev_rows[aid]]
+
+    if n_jobs is not None and n_jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(fill, to_reduce[1:]))
+    else:
+        for i in to_reduce[1:]:
+            fill(i)
+    return reducer.result(aids)
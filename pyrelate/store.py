@@ -19,6 +19,13 @@ class Store:
             self.root = os.path.expanduser(store_path)
         if not os.path.exists(self.root):
             os.mkdir(self.root)
+        # info dictionaries of descriptions, see `_load_info`
+        self._info_cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_info_cache"] = {}
+        return state
 
     def __str__(self):
         """Returns relative path of the store location for the string representation of Store object"""
@@ -64,6 +71,8 @@ class Store:
 
         # put description args in info dict
         info["desc_args"] = self._replace_functions(desc_args)
+        # lets collection results based on this description notice when it changes
+        info["content_hash"] = content_hash(result)
 
         # edit info to replace any "function" parameters with the string of the name
         info = self._replace_functions(info)
@@ -72,6 +81,34 @@ class Store:
         info_path = os.path.join(path, info_fname)
         self._store_file(info, info_path)
 
+    def link_description(self, source_aid, aid, descriptor, **desc_args):
+        """Store the description of `source_aid` as the description of `aid` too, for an identical structure, without
+        pickling it again: the result file is hard linked (copied where links are not supported) and the info
+        dictionary records the aid it was linked from under "linked_from".
+
+        Parameters:
+            source_aid (str): atoms id with a stored description
+            aid (str): atoms id to store the same description for
+            descriptor (str): name of descriptor
+            \*\*desc_args: keyword arguments of the descriptor
+        """
+        filename, info = self._find_result("Descriptions", source_aid, descriptor, **desc_args)
+        if filename is False:
+            raise FileNotFoundError(f"No {descriptor} description of {source_aid} to link to.")
+        if self.check_exists("Descriptions", aid, descriptor, **desc_args):
+            self.clear_description_result(aid, descriptor, **desc_args)
+
+        fname = self._generate_default_file_name(aid, descriptor)
+        path = os.path.join(self.root, "Descriptions", aid, descriptor)
+        os.makedirs(path, exist_ok=True)
+        source = os.path.join(self.root, "Descriptions", source_aid, descriptor, filename)
+        try:
+            os.link(source, os.path.join(path, fname))
+        except OSError:
+            shutil.copyfile(source, os.path.join(path, fname))
+        info["linked_from"] = source_aid
+        self._store_file(info, os.path.join(path, "info_" + fname))
+
     def store_collection_result(self, result, info, method, collection_name, based_on, **method_args):
         """Store collection specific results generated.
 
@@ -84,32 +121,90 @@ class Store:
             on, and b) a dictionary holding the arguments used in the calculation of the descriptor results
             \*\*method_args: additional arguments to used in generating the method result, any function arguments will
             be converted to a string of the function name before storing in the info dict
+
+        Values of the info dict that keep their data in an attachment (such as `pyrelate.clustering.ClusterCenters`,
+        with a `save_attachment` method) write it here, and the attachments are listed in `info["attachments"]`. Those
+        with a `detached` method are pickled as the copy it returns, without the data already in the attachment.
         """
+        attached = [key for key, value in info.items() if hasattr(value, "save_attachment")]
+        attachments = list(info.get("attachments", []))
         exists = self.check_exists("Collections", collection_name, method, based_on=based_on, **method_args)
         if exists:
-            self.clear_collection_result(method, collection_name, based_on, **method_args)
+            # attachments the new result still refers to (e.g. a reused index) must survive the replacement
+            keep = attachments + [info[key].path for key in attached if info[key].path is not None]
+            self._clear_collection_result(method, collection_name, based_on, method_args, keep=keep)
 
         fname = self._generate_default_file_name(collection_name, method)
         info_fname = "info_" + fname
         path = os.path.join(self.root, "Collections", collection_name, method)
         os.makedirs(path, exist_ok=True)
 
-        # store result
-        full_path = os.path.join(path, fname)
-        self._store_file(result, full_path)
+        # attachments are only written along with the result, and removed if it cannot be stored
+        new = []
+        try:
+            for key in attached:
+                saved = info[key].path is None
+                attachments.append(info[key].save_attachment(self, collection_name, method))
+                if saved:
+                    new.append(attachments[-1])
+            if len(attachments) > 0:
+                info["attachments"] = attachments
+
+            # store result
+            full_path = os.path.join(path, fname)
+            self._store_file(result, full_path)
+        except BaseException:
+            for attachment in new:
+                if os.path.exists(self.attachment_path(attachment)):
+                    os.remove(self.attachment_path(attachment))
+            raise
 
         # put description and method args in info dict
         # edit args to replace any "function" parameters with the string of the name
         info["based_on_name"] = based_on[0]
         info["based_on_args"] = self._replace_functions(based_on[1])
         info["method_args"] = self._replace_functions(method_args)
+        info["content_hash"] = content_hash(result)
 
         # edit info to replace any "function" parameters with the string of the name
         info = self._replace_functions(info)
 
-        # store info dict
+        # store info dict, without the data kept in attachments
         info_path = os.path.join(path, info_fname)
-        self._store_file(info, info_path)
+        self._store_file({key: value.detached() if hasattr(value, "detached") else value for key, value in info.items()}, info_path)
+
+    def new_attachment(self, collection_name, method, extension):
+        """Reserve a file name for a binary attachment (e.g. an index or a memory-mappable array) stored next to the
+        collection results of the given method.
+
+        Attachments are not pickled by the Store, the caller writes the file itself. They are written by the values of
+        the info dict of a result that have a `save_attachment(store, collection_name, method)` method, called by
+        `store_collection_result` so that attachments only exist along with a stored result, and listed in
+        `info["attachments"]` to be removed together with it.
+
+        Parameters:
+            collection_name (str): name of the collection
+            method (str): method the attachment belongs to
+            extension (str): three letter file extension, e.g. "ann" or "npy"
+
+        Returns:
+            Path of the attachment relative to the store root, use `attachment_path` to get the full path.
+        """
+        fname = self._generate_default_file_name("attach_" + collection_name, method)[:-3] + extension
+        path = os.path.join(self.root, "Collections", collection_name, method)
+        os.makedirs(path, exist_ok=True)
+        return os.path.relpath(os.path.join(path, fname), self.root)
+
+    def attachment_path(self, relpath):
+        """Full path of an attachment given its path relative to the store root (as returned by `new_attachment`)."""
+        return os.path.join(self.root, relpath)
+
+    def _load_attachments(self, info):
+        """Let the values of a loaded info dictionary that keep their data in an attachment (such as
+        `pyrelate.clustering.ClusterCenters`) open it."""
+        for value in info.values():
+            if hasattr(value, "load_attachment"):
+                value.load_attachment(self)
 
     def _replace_functions(self, dictionary):
         """Function to replace any items in dictionary that are functions with a string of its name."""
@@ -174,6 +269,25 @@ class Store:
                     return False
         return True
 
+    def missing_descriptions(self, aids, descriptor, **desc_args):
+        """Aids among `aids` without a stored description for the given descriptor and arguments, found by listing
+        the Descriptions section once and then only the directories of the aids that have this descriptor, the info
+        files of descriptions being unpickled once per Store (see `_load_info`).
+
+        Parameters:
+            aids (list of str): aids to check
+            descriptor (str): descriptor name
+            \*\*desc_args: keyword arguments of the descriptor
+
+        Returns:
+            List of the aids missing the description, in the given order.
+        """
+        root = os.path.join(self.root, "Descriptions")
+        if not os.path.exists(root):
+            return list(aids)
+        described = set(entry.name for entry in os.scandir(root) if entry.is_dir() and os.path.isdir(os.path.join(entry.path, descriptor)))
+        return [aid for aid in aids if aid not in described or self._find_result("Descriptions", aid, descriptor, **desc_args)[0] is False]
+
     def check_exists(self, store_section, level1, level2, based_on=None, explicit=False, **kwargs):
         """ Function to check if correct file structure is in place and if a result file exists for these parameters
 
@@ -187,23 +301,62 @@ class Store:
             explicit(bool): If True and result exists, function will return the filename of the result location. If False and result exists, will
             return True. Returns False if result does not exist.
         """
+        filename, _ = self._find_result(store_section, level1, level2, based_on, **kwargs)
+        if filename is False or explicit:
+            return filename
+        return True
+
+    def _find_result(self, store_section, level1, level2, based_on=None, **kwargs):
+        """File name and info dictionary of the result matching the parameters (see `check_exists`), or (False, None)."""
         path = os.path.join(self.root, store_section, level1, level2)
         if os.path.exists(path):
             directory = os.fsencode(path)
             for file in os.listdir(directory):
                 filename = os.fsdecode(file)
                 if (level1 + "_" + level2) == filename[:-26]:  # remove the date/time and file end
-                    info = self._unpickle(path, "info_" + filename)
+                    info = self._load_info(store_section, path, filename)
                     check_args = info['desc_args'] if 'desc_args' in info else info['method_args']
                     if self._based_on_is_correct(based_on, info) and self._equal_args(kwargs, check_args):
-                        if explicit:
-                            return filename
-                        else:
-                            return True
-            else:
-                return False
-        else:
-            return False
+                        return filename, info
+        return False, None
+
+    def _load_info(self, store_section, path, filename):
+        """Info dictionary of the result stored in `filename`. Those of descriptions are small and kept once unpickled,
+        keyed by path and modification time, so that bulk checks over many aids (see `missing_descriptions` and
+        `description_hashes`) only list directories after the first one. A copy is returned."""
+        if store_section != "Descriptions":
+            return self._unpickle(path, "info_" + filename)
+        info_path = os.path.join(path, "info_" + filename)
+        key = (info_path, os.stat(info_path).st_mtime_ns)
+        if key not in self._info_cache:
+            self._info_cache[key] = self._unpickle(info_path)
+        return dict(self._info_cache[key])
+
+    def description_hashes(self, aids, descriptor, **desc_args):
+        """Content hashes of the stored descriptions of the given aids (see `content_hash`), read from their info
+        dictionaries without loading the descriptions. The hash is None for missing descriptions, and for descriptions
+        stored before hashes were recorded.
+
+        Returns:
+            List of hashes, in the order of `aids`.
+        """
+        hashes = []
+        for aid in aids:
+            _, info = self._find_result("Descriptions", aid, descriptor, **desc_args)
+            hashes.append(None if info is None else info.get("content_hash"))
+        return hashes
+
+    def get_description_info(self, aid, descriptor, **desc_args):
+        """Info dictionary of a description, without loading the description itself. Returns None if there is no such
+        description."""
+        _, info = self._find_result("Descriptions", aid, descriptor, **desc_args)
+        return info
+
+    def get_collection_info(self, method, collection_name, based_on, **method_args):
+        """Info dictionary of a collection result, without loading the result itself. Returns None if there is no
+        such result."""
+        _, info = self._find_result("Collections", collection_name, method, based_on, **method_args)
+        return info
 
     def _based_on_is_correct(self, based_on, info):
         """Function used when checking if result exists, makes sure what the user expects for the 'based_on' parameter
@@ -249,6 +402,7 @@ class Store:
             res = self._unpickle(path, filename)
             if metadata:
                 info = self._unpickle(path, "info_" + filename)
+                self._load_attachments(info)
                 return res, info
             else:
                 return res
@@ -275,6 +429,7 @@ class Store:
             res = self._unpickle(path, filename)
             if metadata:
                 info = self._unpickle(path, "info_" + filename)
+                self._load_attachments(info)
                 return res, info
             else:
                 return res
@@ -289,6 +444,10 @@ class Store:
             and the parameters used in generating the results.
             \*\*method_args: keyword arguments used in generating the method result
         '''
+        self._clear_collection_result(method, collection_name, based_on, method_args)
+
+    def _clear_collection_result(self, method, collection_name, based_on, method_args, keep=()):
+        """Remove a single collection result along with its attachments, except those listed in `keep`."""
         filename = self.check_exists("Collections", collection_name, method, based_on=based_on, explicit=True, **method_args)
         if filename is False:
             raise FileNotFoundError("No such results found for given parameters")
@@ -296,6 +455,11 @@ class Store:
             path = os.path.join(self.root, "Collections", collection_name, method, filename)
             info_path = os.path.join(self.root, "Collections", collection_name, method, "info_" + filename)
             if os.path.exists(path):
+                info = self._unpickle(info_path)
+                for attachment in info.get("attachments", []):
+                    attachment_path = self.attachment_path(attachment)
+                    if attachment not in keep and os.path.exists(attachment_path):
+                        os.remove(attachment_path)
                 os.remove(path)
                 os.remove(info_path)
 
@@ -385,3 +549,17 @@ class Store:
             path = os.path.join(self.root, item)
             if os.path.isdir(path):
                 shutil.rmtree(path)
+
+
+def content_hash(result):
+    """Short hash of the content of a result, used to detect when the inputs of a collection result change. Arrays are
+    hashed from their raw data, other results from their pickled form."""
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(result, np.ndarray) and result.dtype != object:
+        result = np.ascontiguousarray(result)
+        h.update(repr((result.dtype.str, result.shape)).encode())
+        h.update(result.data)
+    else:
+        h.update(pickle.dumps(result))
+    return h.hexdigest()
@@ -0,0 +1,131 @@
+'''Compact transport of Atoms objects between processes, used by the parallel `AtomsCollection.describe`,
+`AtomsCollection.describe_and_process` and `AtomsCollection.read`.
+
+Pickling an Atoms object also pickles its calculator, constraints and other Python state. `pack` keeps only what is
+needed to describe it: the per-atom arrays, the cell, its displacement, the periodic boundary conditions and the info
+dictionary, and is pickled and sent through a pipe. With `SharedSlots`, the arrays are copied into reusable blocks of
+shared memory instead, and only their layout is sent to the worker.
+'''
+import numpy as np
+
+_alignment = 64
+"""int: alignment (in bytes) of the arrays in a block of shared memory."""
+
+_attached = {}
+"""dict: block of shared memory attached by this (worker) process for each slot of a `SharedSlots`. When the block of a
+slot was replaced by a larger one, the previous block is closed."""
+
+
+def pack(atoms):
+    """Compact, picklable representation of an Atoms object, rebuilt by `unpack`."""
+    return {"arrays": dict(atoms.arrays), "cell": atoms.cell[:], "celldisp": atoms.get_celldisp().ravel(),
+            "pbc": atoms.pbc.copy(), "info": dict(atoms.info)}
+
+
+def unpack(packed):
+    """Atoms object of a representation made by `pack` or `SharedSlots.put`. Arrays in shared memory are copied out
+    of it."""
+    from ase import Atoms
+    arrays = packed["arrays"]
+    if isinstance(arrays, tuple):
+        arrays = _shared_arrays(*arrays)
+    arrays = dict(arrays)
+    atoms = Atoms(numbers=arrays.pop("numbers"), positions=arrays.pop("positions"), cell=packed["cell"],
+                  celldisp=packed["celldisp"], pbc=packed["pbc"])
+    for name, arr in arrays.items():
+        atoms.new_array(name, arr)
+    atoms.info.update(packed.get("info", {}))
+    return atoms
+
+
+def _shared_arrays(slot, name, layout):
+    """Views of the arrays laid out in the block of shared memory with the given name, the current block of `slot`."""
+    from multiprocessing import shared_memory
+    block = _attached.get(slot)
+    if block is None or block.name != name:
+        if block is not None:
+            # the block of the slot was replaced (and unlinked) by a larger one
+            block.close()
+        block = _attached[slot] = shared_memory.SharedMemory(name=name)
+    return {key: np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=start) for key, dtype, shape, start in layout}
+
+
+def _layout(arrays):
+    """(name, dtype, shape, offset) of each array in a block, and the size of the block."""
+    layout = []
+    start = 0
+    for name, arr in arrays.items():
+        layout.append((name, arr.dtype.str, arr.shape, start))
+        start += -(-arr.nbytes // _alignment) * _alignment
+    return layout, start
+
+
+class SharedSlots:
+    """Reusable blocks (slots) of shared memory holding Atoms objects sent to worker processes.
+
+    `put` copies an Atoms object into a free slot, which is reused once the worker is done with it and it is given back
+    with `release`. Slots grow as needed to fit larger Atoms objects. Must be created before the process pool, so that
+    the workers share the resource tracker of this process, and closed after the pool is shut down (or used as a
+    context manager) to free the shared memory.
+
+    Example:
+        .. code-block:: python
+
+            with SharedSlots() as slots, ProcessPoolExecutor(4) as pool:
+                slot, packed = slots.put(atoms)
+                future = pool.submit(work, packed)  # work calls unpack(packed)
+                future.result()
+                slots.release(slot)
+    """
+
+    def __init__(self):
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+        self._blocks = []
+        self._free = []
+
+    def put(self, atoms):
+        """Copy an Atoms object into a free slot.
+
+        Returns:
+            Tuple (slot, packed): the slot to release once the worker is done, and the representation to send to the
+            worker, rebuilt by `unpack`.
+        """
+        from multiprocessing import shared_memory
+        packed = pack(atoms)
+        layout, size = _layout(packed["arrays"])
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._blocks)
+            self._blocks.append(None)
+        block = self._blocks[slot]
+        if block is None or block.size < size:
+            if block is not None:
+                block.close()
+                block.unlink()
+            previous = 0 if block is None else block.size
+            block = self._blocks[slot] = shared_memory.SharedMemory(create=True, size=max(size, 2 * previous, 1))
+        for name, dtype, shape, start in layout:
+            np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=start)[...] = packed["arrays"][name]
+        packed["arrays"] = (slot, block.name, layout)
+        return slot, packed
+
+    def release(self, slot):
+        """Give back a slot, once the worker it was sent to is done with it."""
+        self._free.append(slot)
+
+    def close(self):
+        """Free the shared memory of all slots."""
+        for block in self._blocks:
+            if block is not None:
+                block.close()
+                block.unlink()
+        self._blocks = []
+        self._free = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
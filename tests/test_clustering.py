@@ -0,0 +1,164 @@
+import pyrelate.clustering as clustering
+import numpy as np
+import os
+import shutil
+
+
+class TestClustering():
+    def test_classify_backends_agree(self):
+        '''Test that the approximate and exact backends find the same nearest centers'''
+        centers = np.array([[0, 0, 0], [10, 10, 10], [-10, -10, -10]], dtype=float)
+        laes = np.array([[1, 0, 1], [9, 10, 11], [-9, -10, -12], [0, 1, 0]], dtype=float)
+        expected = np.array([0, 1, 2, 0])
+        assert np.array_equal(clustering.classify(laes, centers, nn_backend="annoy"), expected)
+        assert np.array_equal(clustering.classify(laes, centers, nn_backend="kdtree"), expected)
+
+    def test_classify_annoy_chunks(self):
+        '''Test that querying Annoy in chunks, and in threads, gives the same nearest centers as the exact backend'''
+        rng = np.random.default_rng(0)
+        centers = rng.random((20, 3)) * 10
+        laes = centers[rng.integers(0, 20, 50)] + rng.random((50, 3)) * 0.01
+        expected = clustering.classify(laes, centers, nn_backend="kdtree")
+        assert np.array_equal(clustering.classify(laes, centers, nn_backend="annoy", chunk_size=7), expected)
+        assert np.array_equal(clustering.classify(laes, centers, nn_backend="annoy", chunk_size=7, n_threads=3), expected)
+
+    def test_classify_unknown_backend(self):
+        try:
+            clustering.classify(np.zeros((1, 3)), np.zeros((1, 3)), nn_backend="nope")
+            assert False, "Exception should be raised."
+        except ValueError:
+            assert True
+
+    def test_count(self):
+        labels = np.array([0, 1, 1, 2, 0])
+        rows = np.array([0, 0, 0, 1, 1])
+        counts = clustering.count(labels, rows, 2, 3)
+        assert np.array_equal(counts, np.array([[1, 2, 0], [1, 0, 1]]))
+
+    def test_unique_rows(self):
+        '''Test that rows equal up to the tolerance are collapsed, keeping the order of first occurrence'''
+        laes = np.array([[1, 1], [0, 0], [1, 1 + 1e-9], [2, 2], [0, 0]], dtype=float)
+        first, inverse, multiplicity = clustering.unique_rows(laes, 1e-6)
+        assert np.array_equal(first, [0, 1, 3])
+        assert np.array_equal(inverse, [0, 1, 0, 2, 1])
+        assert np.array_equal(multiplicity, [2, 2, 1])
+        # with no tolerance, only exactly equal rows are collapsed
+        first, inverse, multiplicity = clustering.unique_rows(np.vstack((laes, [[-0., 0]])), 0)
+        assert np.array_equal(first, [0, 1, 2, 3])
+        assert np.array_equal(inverse, [0, 1, 2, 3, 1, 1])
+        assert np.array_equal(multiplicity, [1, 3, 1, 1])
+
+    def test_count_weights(self):
+        counts = clustering.count(np.array([1, 0]), np.array([0, 1]), 2, 2, weights=np.array([3, 2]))
+        assert np.array_equal(counts, np.array([[0, 3], [2, 0]]))
+
+    def test_leader_matches_pairwise_loop(self):
+        '''Test that the vectorized leader clustering finds the same centers as comparing LAEs one by one'''
+        rng = np.random.default_rng(0)
+        laes = rng.normal(size=(500, 5))
+        eps = 2.0
+        expected = [0]
+        for i in range(1, len(laes)):
+            if all(np.linalg.norm(laes[j] - laes[i]) >= eps for j in expected):
+                expected.append(i)
+        new = clustering.leader(laes[1:], laes[:1], eps, block_size=64)
+        assert [0] + [i + 1 for i in new] == expected
+
+    def test_growable_array(self):
+        '''Test that rows appended past the initial capacity are kept, in memory and memory-mapped'''
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for path in [None, os.path.join(tmpdir, "growable.dat")]:
+                arr = clustering.GrowableArray(2, capacity=2, path=path)
+                arr.extend([[0, 1]])
+                arr.extend([[2, 3], [4, 5], [6, 7]])
+                assert len(arr) == 4
+                assert np.array_equal(arr.array, [[0, 1], [2, 3], [4, 5], [6, 7]])
+                if path is not None:
+                    # the file was grown in place
+                    assert os.path.getsize(path) == 4 * 2 * 8
+                del arr
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_cluster_centers(self):
+        '''Test that ClusterCenters behaves as the dictionary of centers it replaces and pickles back'''
+        import pickle
+        legacy = {('0', 0): np.array([0., 0.]), ('454', 2): np.array([1., 2.]), ('455', 0): np.array([3., 4.])}
+        centers = clustering.ClusterCenters.from_dict(legacy)
+        assert list(centers) == list(legacy)
+        assert np.array_equal(centers[('454', 2)], [1, 2])
+        assert np.array_equal(centers.vectors, [[0, 0], [1, 2], [3, 4]])
+        assert centers.aids == ['0', '454', '455']
+
+        extended = centers.extend([('454', 3)], [[5., 6.]])
+        assert list(extended)[-1] == ('454', 3)
+        assert extended.aids == ['0', '454', '455']
+        loaded = pickle.loads(pickle.dumps(extended))
+        assert list(loaded) == list(extended)
+        assert np.array_equal(loaded.vectors, extended.vectors)
+
+        # only the detached copy pickled by the Store drops the vectors
+        try:
+            extended.detached()
+            assert False, "Exception should be raised."
+        except RuntimeError:
+            pass
+        extended.path = "centers.npy"
+        assert np.array_equal(pickle.loads(pickle.dumps(extended)).vectors, extended.vectors)
+        assert extended.detached().vectors is None
+        assert extended.vectors is not None
+
+    def test_metrics(self):
+        '''Test the vectorized metrics against scipy's pairwise distances'''
+        from scipy.spatial.distance import cdist
+        rng = np.random.default_rng(0)
+        block, centers = rng.normal(size=(7, 4)), rng.normal(size=(5, 4))
+        assert np.allclose(clustering.euclidean(block, centers), cdist(block, centers))
+        assert np.allclose(clustering.cosine(block, centers), cdist(block, centers, 'cosine'))
+        gaussian = clustering.get_metric("gaussian", gamma=0.5)
+        assert np.allclose(gaussian(block, centers), 1 - np.exp(-0.5 * cdist(block, centers)**2))
+        try:
+            clustering.get_metric("manhattan")
+            assert False, "Exception should be raised."
+        except ValueError:
+            assert True
+
+    def test_leader_custom_metric(self):
+        '''Test leader clustering and brute force classification with a non-euclidean metric'''
+        rng = np.random.default_rng(1)
+        laes = rng.normal(size=(200, 3))
+        eps = 0.1
+        expected = [0]
+        for i in range(1, len(laes)):
+            if all(clustering.cosine(laes[j:j + 1], laes[i:i + 1])[0, 0] >= eps for j in expected):
+                expected.append(i)
+        new = clustering.leader(laes[1:], laes[:1], eps, block_size=16, dissimilarity=clustering.cosine)
+        assert [0] + [i + 1 for i in new] == expected
+
+        centers = laes[expected]
+        labels = clustering.classify(laes, centers, nn_backend="brute", dissimilarity=clustering.cosine, block_size=16)
+        assert np.array_equal(labels, np.argmin(clustering.cosine(laes, centers), axis=1))
+
+    def test_grid(self):
+        '''Test that grid clustering gives one center per occupied cell, independently of the order of the aids'''
+        laes = {'a': np.array([[0.1, 0.1], [5.0, 5.0], [5.1, 5.1]]), 'b': np.array([[5.05, 5.0], [-3.0, 2.0]])}
+        initial = np.zeros((1, 2))
+        keys, vectors = clustering.grid(laes.get, ['b', 'a'], initial, eps=1, cell=1)
+        assert keys == [('a', 1), ('b', 1)]
+        assert np.array_equal(vectors, [[5, 5], [-3, 2]])
+        assert clustering.grid(laes.get, ['a', 'b'], initial, eps=1, cell=1)[0] == keys
+
+    def test_kmeans(self):
+        '''Test that mini-batch k-means finds well separated blobs'''
+        rng = np.random.default_rng(0)
+        means = np.array([[10., 0.], [0., 10.], [-10., -10.]])
+        laes = {str(i): means[i % 3] + rng.normal(scale=0.1, size=(50, 2)) for i in range(6)}
+        initial = np.zeros((1, 2))
+        keys, vectors = clustering.kmeans(laes.get, list(laes), initial, n_clusters=3, batch_size=64, random_state=1)
+        assert len(keys) == 3 and all(aid in laes for aid, _ in keys)
+        # every blob gets its own center, close to its mean
+        nearest = clustering.classify(means, vectors, nn_backend="kdtree")
+        assert sorted(nearest) == [0, 1, 2]
+        assert np.allclose(vectors[nearest], means, atol=0.1)
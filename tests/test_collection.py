@@ -8,6 +8,7 @@ import io
 import re
 import unittest
 import os
+from ase.io import read as io_read
 
 '''Functions to help in writing and designing clear, functional unit tests'''
 
@@ -68,6 +69,28 @@ def _test_descriptor(atoms, num=0, **kwargs):
         return 'test result 2', {}
 
 
+def _positions_descriptor(atoms, scale=1, **kwargs):
+    return atoms.get_positions() * scale
+
+
+def _energy_descriptor(atoms, **kwargs):
+    return np.full((len(atoms), 1), 0.0 if atoms.calc is None else atoms.get_potential_energy())
+
+
+_described = []
+
+
+def _counting_descriptor(atoms, **kwargs):
+    # records every structure it describes
+    _described.append(len(atoms))
+    return atoms.get_positions()
+
+
+def _downstream_method(collection, based_on):
+    # collection result based on another collection result
+    return collection.get_collection_result(based_on[0], based_on[2], **based_on[1]) * 10
+
+
 def _processing_method(collection, based_on, method_name, **kwargs):
     # process collection of results
     new_string = method_name + "__"
@@ -219,6 +242,178 @@ class TestCollection(unittest.TestCase):
         assert 1 == len(my_col)
         _delete_store(my_col)
 
+    def test_read_parallel(self):
+        '''Test that reading in parallel gives the same collection as reading serially'''
+        serial = AtomsCollection("Test", store="./tests/store")
+        parallel = AtomsCollection("Test", store="./tests/store")
+        files = ["./tests/test_data/ni.p455.out", "./tests/test_data/ni.p455.out", "definitely_wrong"]
+        serial.read(files, 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out', prefix="TEST")
+        parallel.read(files, 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out', prefix="TEST", n_jobs=2)
+        assert parallel.aids() == serial.aids() == ["test_455"]
+        assert parallel["test_455"] == serial["test_455"]
+        for array in ["type", "mask"]:
+            assert np.array_equal(parallel["test_455"].get_array(array), serial["test_455"].get_array(array))
+        _delete_store(serial)
+
+    def test_read_cache(self):
+        '''Test that cached reads give the same Atoms as parsing, and that entries of changed files are not used'''
+        my_col = AtomsCollection("Test", store="./tests/store")
+        fpath = "./tests/store/ni.p455.out"
+        shutil.copy("./tests/test_data/ni.p455.out", fpath)
+        my_col.read(fpath, 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out')
+        parsed = my_col["455"]
+        for n_jobs in [None, 2]:
+            my_col.read(fpath, 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out', n_jobs=n_jobs, cache=True)
+            cached = my_col["455"]
+            assert cached == parsed
+            for name in parsed.arrays:
+                assert np.array_equal(cached.get_array(name), parsed.get_array(name))
+        assert len(os.listdir("./tests/store/ParseCache")) == 2
+
+        # same size, different content and modification time
+        with open(fpath) as f:
+            text = f.read()
+        with open(fpath, "w") as f:
+            f.write(text.replace("pp pp ss", "pp pp pp"))
+        stat = os.stat(fpath)
+        os.utime(fpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        my_col.read(fpath, 28, "lammps-dump-text", rxid=r'ni.p(?P<aid>\d+).out', cache=True)
+        assert my_col["455"].pbc.all()
+        assert len(os.listdir("./tests/store/ParseCache")) == 2
+        _delete_store(my_col)
+
+    def test_refresh(self):
+        '''Test that refresh reads only new and modified files, and removes aids of deleted files when asked to'''
+        my_col = AtomsCollection("Test", store="./tests/store")
+        raw = "./tests/store/raw"
+        os.makedirs(raw)
+        for aid in ["455", "456"]:
+            shutil.copy("./tests/test_data/ni.p455.out", os.path.join(raw, f"ni.p{aid}.out"))
+        rxid = r'ni.p(?P<aid>\d+).out'
+        my_col.read(raw, 28, "lammps-dump-text", rxid=rxid)
+        assert my_col.refresh(raw, 28, "lammps-dump-text", rxid=rxid) == set()
+
+        stat = os.stat(os.path.join(raw, "ni.p456.out"))
+        os.utime(os.path.join(raw, "ni.p456.out"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        shutil.copy("./tests/test_data/ni.p455.out", os.path.join(raw, "ni.p457.out"))
+        assert my_col.refresh(raw, 28, "lammps-dump-text", rxid=rxid, n_jobs=2) == {"456", "457"}
+
+        os.remove(os.path.join(raw, "ni.p455.out"))
+        assert my_col.refresh(raw, 28, "lammps-dump-text", rxid=rxid) == set()
+        assert "455" in my_col
+        assert my_col.refresh(raw, 28, "lammps-dump-text", rxid=rxid, remove=True) == set()
+        assert sorted(my_col.aids()) == ["456", "457"]
+        assert sorted(my_col.subset(["457"]).sources) == ["457"]
+        _delete_store(my_col)
+
+    def test_lazy_collection(self):
+        '''Test that a lazy collection gives the same Atoms and descriptions while keeping few Atoms loaded'''
+        raw = "./tests/store/raw"
+        os.makedirs(raw)
+        for aid in ["455", "456", "457"]:
+            shutil.copy("./tests/test_data/ni.p455.out", os.path.join(raw, f"ni.p{aid}.out"))
+        rxid = r'ni.p(?P<aid>\d+).out'
+        eager = AtomsCollection("Eager", store="./tests/store")
+        lazy = AtomsCollection("Lazy", store="./tests/store", max_loaded=1)
+        eager.read(raw, 28, "lammps-dump-text", rxid=rxid)
+        lazy.read(raw, 28, "lammps-dump-text", rxid=rxid)
+        assert lazy.aids() == eager.aids()
+        assert len(lazy._loaded) == 0
+
+        eager.trim(10, 0)
+        lazy.trim(10, 0)
+        for aid, atoms in lazy.items():
+            assert atoms == eager[aid]
+            assert np.array_equal(atoms.get_array("mask"), eager[aid].get_array("mask"))
+            assert len(lazy._loaded) == 1
+        subset = lazy.subset(["456"])
+        assert subset.max_loaded == 1 and subset["456"] == eager["456"]
+        copy = AtomsCollection("Copy", store="./tests/store", data=lazy)
+        assert copy.max_loaded == 1 and copy.sources == lazy.sources
+        assert copy["455"] == eager["455"] and copy["456"] == eager["456"]
+
+        eager.describe("pos", fcn=_positions_descriptor)
+        lazy.describe("pos", fcn=_positions_descriptor, n_jobs=2)
+        for aid in eager.aids():
+            assert np.array_equal(lazy.get_description(aid, "pos"), eager.get_description(aid, "pos"))
+        _delete_store(eager)
+
+    def test_read_frames(self):
+        '''Test reading every other frame of a trajectory, into a collection and a lazy collection'''
+        from tests.test_lammps import _write_trajectory
+        os.makedirs("./tests/store")
+        fpath = "./tests/store/traj.out"
+        _write_trajectory(fpath, 5)
+        expected = io_read(fpath, ":", format="lammps-dump-text")
+        my_col = AtomsCollection("Test", store="./tests/store")
+        my_col.read(fpath, 28, "lammps-dump-text", frames=slice(0, None, 2))
+        assert my_col.aids() == ["traj.out_f0", "traj.out_f2", "traj.out_f4"]
+        lazy = AtomsCollection("Lazy", store="./tests/store", max_loaded=1)
+        aids = []
+        for aid in lazy.iread(fpath, 28, "lammps-dump-text", frames=slice(0, None, 2)):
+            aids.append(aid)
+            lazy.describe("pos", aid=aid, fcn=_positions_descriptor)
+        assert aids == my_col.aids() and len(lazy._loaded) == 1
+        for aid in aids:
+            frame = int(aid.split("_f")[1])
+            assert np.array_equal(my_col[aid].get_array("type"), expected[frame].numbers)
+            assert np.array_equal(my_col[aid].positions, expected[frame].positions)
+            assert lazy[aid] == my_col[aid]
+            assert np.array_equal(lazy.get_description(aid, "pos"), expected[frame].positions)
+
+        # frames past the end of a shorter trajectory are removed when refreshing
+        _write_trajectory(fpath, 3)
+        stat = os.stat(fpath)
+        os.utime(fpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert my_col.refresh(fpath, 28, "lammps-dump-text", frames=slice(0, None, 2)) == {"traj.out_f0", "traj.out_f2"}
+        assert my_col.aids() == ["traj.out_f0", "traj.out_f2"]
+        assert sorted(my_col.sources) == ["traj.out_f0", "traj.out_f2"]
+        _delete_store(my_col)
+
+    def test_save_load(self):
+        '''Test that a saved collection loads back with the same Atoms, lazily or not'''
+        my_col = _initialize_collection_and_read(['455'])
+        my_col.trim(10, 0)
+        my_col["copy"] = my_col["455"][:100]
+        my_col["copy"].info["note"] = "copy"
+        my_col.save("./tests/store/snapshot")
+        for max_loaded in [None, 1]:
+            loaded = AtomsCollection.load("./tests/store/snapshot", store=my_col.store, max_loaded=max_loaded)
+            assert loaded.name == my_col.name and loaded.aids() == my_col.aids()
+            assert loaded.sources == my_col.sources
+            for aid in my_col.aids():
+                assert loaded[aid] == my_col[aid]
+                assert np.array_equal(loaded[aid].get_celldisp(), my_col[aid].get_celldisp())
+                for name, arr in my_col[aid].arrays.items():
+                    assert loaded[aid].get_array(name).dtype == arr.dtype
+                    assert np.array_equal(loaded[aid].get_array(name), arr)
+            assert loaded["copy"].info == {"note": "copy"}
+        # the snapshot is opened once for all accesses
+        from pyrelate.collection import _open_snapshot
+        assert _open_snapshot("./tests/store/snapshot") is _open_snapshot("./tests/store/snapshot")
+        # lazy rows keep the absolute path of the snapshot, and only a few snapshots are kept open
+        from pyrelate.collection import _snapshots, _max_snapshots
+        row = dict.__getitem__(loaded, "455")
+        assert row.path == os.path.abspath("./tests/store/snapshot") and row.row == 0
+        for i in range(_max_snapshots + 1):
+            my_col.save(f"./tests/store/snapshot{i}")
+            _open_snapshot(f"./tests/store/snapshot{i}")
+        assert len(_snapshots) == _max_snapshots
+
+        del my_col["copy"].arrays["c_cna"]
+        try:
+            my_col.save("./tests/store/snapshot")
+            assert False, "Exception should be raised."
+        except ValueError:
+            assert True
+        assert not any(fname.endswith(".raw") for fname in os.listdir("./tests/store/snapshot/arrays"))
+        try:
+            AtomsCollection.load("./tests/store/nothing")
+            assert False, "Exception should be raised."
+        except FileNotFoundError:
+            assert True
+        _delete_store(my_col)
+
     def test_read_nonexistent_directory(self):
         '''Test read, try to read nonexistent directory and throw error'''
         my_col = AtomsCollection("Test", store="./tests/store")
@@ -374,6 +569,51 @@ class TestCollection(unittest.TestCase):
         finally:
             _delete_store(my_col)
 
+    def test_describe_reuses_identical_structures(self):
+        '''Test that identical structures are described once, and unchanged ones are not described again'''
+        from pyrelate.collection import structure_fingerprint
+        my_col = _initialize_collection_and_read(['455'])
+        my_col["copy"] = my_col["455"].copy()
+        my_col["other"] = my_col["455"][:100]
+        assert structure_fingerprint(my_col["copy"]) == structure_fingerprint(my_col["455"])
+        assert structure_fingerprint(my_col["other"]) != structure_fingerprint(my_col["455"])
+        try:
+            _described.clear()
+            my_col.describe('count', fcn=_counting_descriptor)
+            assert sorted(_described) == [100, len(my_col["455"])]
+            assert np.array_equal(my_col.get_description("copy", 'count'), my_col.get_description("455", 'count'))
+            _, info = my_col.get_description("copy", 'count', metadata=True)
+            assert info["linked_from"] == "455"
+
+            _described.clear()
+            my_col.describe('count', fcn=_counting_descriptor, override=True)
+            assert sorted(_described) == [100, len(my_col["455"])]
+            _described.clear()
+            my_col.describe('count', fcn=_counting_descriptor, override=True, keep_unchanged=True)
+            assert _described == []
+            my_col["other"].positions += 1
+            my_col.describe('count', fcn=_counting_descriptor, override=True, keep_unchanged=True)
+            assert _described == [100]
+            # any per-atom array is part of the structure
+            my_col["other"].set_array("type", my_col["other"].get_array("type") + 1)
+            _described.clear()
+            my_col.describe('count', fcn=_counting_descriptor, override=True, keep_unchanged=True)
+            assert _described == [100]
+            assert np.array_equal(my_col.get_description("other", 'count'), my_col["other"].positions)
+            # a new aid is linked to the stored description of the same structure
+            my_col["new"] = my_col["455"].copy()
+            _described.clear()
+            my_col.describe('count', fcn=_counting_descriptor)
+            assert _described == []
+            _, info = my_col.get_description("new", 'count', metadata=True)
+            assert info["linked_from"] == "455"
+
+            _described.clear()
+            my_col.describe('count', fcn=_counting_descriptor, override=True, reuse=False)
+            assert len(_described) == 4
+        finally:
+            _delete_store(my_col)
+
     def test_describe_trim_post_descriptor(self):
         aid = '455'
         my_col = _initialize_collection_and_read([aid])
@@ -406,6 +646,167 @@ class TestCollection(unittest.TestCase):
 
         _delete_store(my_col)
 
+    def test_describe_and_process(self):
+        '''Test that the fused describe and process gives the same results as describing, then processing'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        kwargs = {'scale': 2}
+        centers = np.array([[0., 0., 0.], [10., 10., 10.], [20., 20., 20.]])
+        methods = [("asr", {}), ("ler_classify", {"basis": centers, "nn_backend": "kdtree"})]
+        try:
+            asr, ler = my_col.describe_and_process('pos', methods, fcn=_positions_descriptor, **kwargs)
+            assert not my_col.store.check_exists("Descriptions", '454', 'pos', **kwargs)
+            assert np.array_equal(my_col.get_collection_result("asr", ('pos', kwargs)), asr)
+
+            my_col.describe('pos', fcn=_positions_descriptor, **kwargs)
+            from pyrelate import descriptors
+            expected_asr = descriptors.asr(my_col, ('pos', kwargs))
+            expected_ler, _ = descriptors.ler_classify(my_col, ('pos', kwargs), centers, nn_backend="kdtree")
+        finally:
+            _delete_store(my_col)
+        assert np.allclose(asr, expected_asr)
+        assert np.array_equal(ler, expected_ler)
+
+    def test_describe_and_process_pipelined(self):
+        '''Test that describing in parallel while processing gives the same results as the serial fused run'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        kwargs = {'scale': 2}
+        methods = [("sum", {}), ("reduce", {"reductions": ["mean", "max"]})]
+        try:
+            sums, reduced = my_col.describe_and_process('pos', methods, fcn=_positions_descriptor, store_descriptions=True, n_jobs=2, queue_size=1, **kwargs)
+            stored = my_col.get_description('455', 'pos', **kwargs)
+            # the results are recorded as process records them
+            _, info = my_col.get_collection_result("reduce", ('pos', kwargs), metadata=True, reductions=["mean", "max"])
+            assert info["input_fingerprint"] == my_col.input_fingerprint(('pos', kwargs))
+            assert info["aids"] == ['454', '455'] and info["execution_args"] == {}
+            serial = my_col.describe_and_process('pos', methods, fcn=_positions_descriptor, override=True, **kwargs)
+        finally:
+            _delete_store(my_col)
+        assert np.array_equal(stored, my_col['455'].get_positions()[my_col['455'].get_array("mask").astype(bool)] * 2)
+        assert np.array_equal(sums, serial[0])
+        assert np.array_equal(reduced, serial[1])
+
+    def test_describe_shared_memory(self):
+        '''Test that describing in parallel through shared memory gives the serial descriptions'''
+        my_col = _initialize_collection_and_read(['455'])
+        my_col["small"] = my_col["455"][:50]
+        kwargs = {'scale': 2}
+        try:
+            my_col.describe('pos', fcn=_positions_descriptor, n_jobs=2, shared_memory=True, **kwargs)
+            sums, = my_col.describe_and_process('pos', [("sum", {})], fcn=_positions_descriptor, override=True, n_jobs=2,
+                                                shared_memory=True, **kwargs)
+            for aid in my_col.aids():
+                expected = my_col[aid].get_positions()[my_col[aid].get_array("mask").astype(bool)] * 2
+                assert np.array_equal(my_col.get_description(aid, 'pos', **kwargs), expected)
+                assert np.array_equal(sums[my_col.aids().index(aid)], expected.sum(axis=0))
+        finally:
+            _delete_store(my_col)
+
+    def test_describe_pickle_atoms(self):
+        '''Test that Atoms objects are packed for the processes, without their calculators unless pickled whole'''
+        from ase.calculators.singlepoint import SinglePointCalculator
+        my_col = _initialize_collection_and_read(['454', '455'])
+        for atoms in my_col.values():
+            atoms.calc = SinglePointCalculator(atoms, energy=-1.0)
+        try:
+            my_col.describe('energy', fcn=_energy_descriptor, n_jobs=2)
+            assert np.all(my_col.get_description('455', 'energy') == 0)
+            my_col.describe('energy', fcn=_energy_descriptor, override=True, n_jobs=2, pickle_atoms=True)
+            assert np.all(my_col.get_description('455', 'energy') == -1)
+            try:
+                my_col.describe('energy', fcn=_energy_descriptor, n_jobs=2, shared_memory=True, pickle_atoms=True)
+                assert False, "Exception should be raised."
+            except ValueError:
+                assert True
+        finally:
+            _delete_store(my_col)
+
+    def test_process_resolves_dependencies(self):
+        '''Test that process computes missing descriptions and prerequisite results before running a method'''
+        from pyrelate import descriptors
+        my_col = _initialize_collection_and_read(['454', '455'])
+        kwargs = {'scale': 2}
+        chain = ("asr", {}, ("pos", kwargs))
+        registered = dict(descriptors.descriptor_functions)
+        descriptors.descriptor_functions["pos"] = _positions_descriptor
+        try:
+            my_col.describe('pos', aid='454', fcn=_positions_descriptor, **kwargs)
+            steps = my_col.dependencies(chain)
+            assert [(step["kind"], step["name"]) for step in steps] == [("describe", "pos"), ("process", "asr")]
+            assert steps[0]["missing"] == ['455']
+            assert steps[1]["missing"] is True
+
+            res = my_col.process("downstream", chain, fcn=_downstream_method, describe_jobs=2)
+            assert my_col.store.missing_descriptions(my_col.aids(), 'pos', **kwargs) == []
+            # info files of descriptions are only unpickled once
+            unpickled = []
+            unpickle = my_col.store._unpickle
+            my_col.store._unpickle = lambda *args: unpickled.append(args) or unpickle(*args)
+            assert my_col.store.missing_descriptions(my_col.aids(), 'pos', **kwargs) == []
+            assert unpickled == []
+            asr = my_col.get_collection_result("asr", ("pos", kwargs))
+            assert np.array_equal(res, asr * 10)
+            assert not any(step["missing"] for step in my_col.dependencies(chain))
+        finally:
+            descriptors.descriptor_functions.clear()
+            descriptors.descriptor_functions.update(registered)
+            _delete_store(my_col)
+
+    def test_process_unregistered_descriptor(self):
+        '''Test that process names the aids missing a description it has no descriptor function for'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        try:
+            my_col.store.store_description(np.ones((2, 2)), {}, '454', "desc", num=1)
+            my_col.process("sum", ("desc", {'num': 1}))
+            assert False, "Exception should be raised."
+        except FileNotFoundError as e:
+            assert "['455']" in str(e) and "descriptor_functions" in str(e)
+        finally:
+            _delete_store(my_col)
+
+    def test_process_recomputes_changed_inputs(self):
+        '''Test that a stored result is recomputed when its descriptions or aids change, and only then'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        desc_args = {'num': 1}
+        try:
+            for aid in my_col.aids():
+                my_col.store.store_description(np.ones((2, 2)), {}, aid, "desc", **desc_args)
+            first = my_col.process("sum", ("desc", desc_args))
+            info = my_col.store.get_collection_info("sum", my_col.name, ("desc", desc_args))
+            assert info["input_fingerprint"] == my_col.input_fingerprint(("desc", desc_args))
+
+            my_col.store.store_description(np.full((2, 2), 2.), {}, '455', "desc", **desc_args)
+            second = my_col.process("sum", ("desc", desc_args))
+            assert np.array_equal(first, [[2, 2], [2, 2]])
+            assert np.array_equal(second, [[2, 2], [4, 4]])
+
+            sub = my_col.subset(['455'])
+            output = io.StringIO()
+            sys.stdout = output
+            try:
+                assert np.array_equal(sub.process("sum", ("desc", desc_args)), [[4, 4]])
+            finally:
+                sys.stdout = sys.__stdout__
+            assert "give subsets their own name" in output.getvalue()
+        finally:
+            _delete_store(my_col)
+
+    def test_process_execution_args(self):
+        '''Test that a result computed in parallel is stored under the same arguments as a serial one'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        desc_args = {'num': 1}
+        try:
+            for aid in my_col.aids():
+                my_col.store.store_description(np.ones((2, 2)), {}, aid, "desc", **desc_args)
+            first = my_col.process("sum", ("desc", desc_args), n_jobs=2)
+            fname = my_col.store.check_exists("Collections", my_col.name, "sum", ("desc", desc_args), explicit=True)
+            assert fname is not False
+            assert np.array_equal(my_col.process("sum", ("desc", desc_args)), first)
+            info = my_col.store.get_collection_info("sum", my_col.name, ("desc", desc_args))
+            assert info["execution_args"] == {"n_jobs": 2}
+            assert my_col.store.check_exists("Collections", my_col.name, "sum", ("desc", desc_args), explicit=True) == fname
+        finally:
+            _delete_store(my_col)
+
     def test_process(self):
         desc = "test"
         desc_args = {
@@ -420,6 +821,9 @@ class TestCollection(unittest.TestCase):
         my_col = _initialize_collection_and_describe([desc], ['454', '455'], **desc_args)
         res = my_col.process(method, (desc, desc_args), fcn=_processing_method, **method_args)
         assert res == "my_method__test result 2_test result 2_"
+        # methods without a `previous` parameter are computed from scratch when updating
+        res = my_col.process(method, (desc, desc_args), fcn=_processing_method, update=True, **method_args)
+        assert res == "my_method__test result 2_test result 2_"
 
         _delete_store(my_col)
 
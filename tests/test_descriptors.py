@@ -1,6 +1,9 @@
 from pyrelate.collection import AtomsCollection
 import shutil
+import os
 import numpy as np
+from pyrelate import descriptors
+from scipy.sparse import issparse
 
 
 '''Functions to help in writing and designing clear, functional unit tests'''
@@ -25,6 +28,16 @@ def _initialize_collection_and_read(aids, store_loc="tests/store"):
     return my_col
 
 
+def _store_fake_soap(my_col):
+    '''Store small "fake_soap" descriptions of aids 454 and 455 and return their descriptor arguments'''
+    soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
+    fake_mat1 = np.array([[-14, -13, -11], [4, 4, 4], [5, 4, 5], [1, 0, 1]])
+    fake_mat2 = np.array([[1, 1, 1], [10, 10, 9], [10, 9, 10], [-14, -12, -12]])
+    my_col.store.store_description(fake_mat1, {}, "454", "fake_soap", **soapargs)
+    my_col.store.store_description(fake_mat2, {}, "455", "fake_soap", **soapargs)
+    return soapargs
+
+
 '''Unit Tests'''
 
 
@@ -92,11 +105,7 @@ class TestDescriptors():
     def test_ler_functionality(self):
         '''Test LER, see if gives expected results'''
         my_col = _initialize_collection_and_read(['454', '455'])
-        soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
-        fake_mat1 = np.array([[-14, -13, -11], [4, 4, 4], [5, 4, 5], [1, 0, 1]])
-        fake_mat2 = np.array([[1, 1, 1], [10, 10, 9], [10, 9, 10], [-14, -12, -12]])
-        my_col.store.store_description(fake_mat1, {}, "454", "fake_soap", **soapargs)
-        my_col.store.store_description(fake_mat2, {}, "455", "fake_soap", **soapargs)
+        soapargs = _store_fake_soap(my_col)
         seed = [0, 0, 0]
         lerargs = {
             'eps': 2, #0.3,
@@ -117,11 +126,7 @@ class TestDescriptors():
     def test_ler_runs_pass_in_soapfcn(self):
         '''Test LER runs, check that using user specified SOAP function works'''
         my_col = _initialize_collection_and_read(['454', '455'])
-        soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
-        fake_mat1 = np.array([[-14, -13, -11], [4, 4, 4], [5, 4, 5], [1, 0, 1]])
-        fake_mat2 = np.array([[1, 1, 1], [10, 10, 9], [10, 9, 10], [-14, -12, -12]])
-        my_col.store.store_description(fake_mat1, {}, "454", "fake_soap", **soapargs)
-        my_col.store.store_description(fake_mat2, {}, "455", "fake_soap", **soapargs)
+        soapargs = _store_fake_soap(my_col)
 
         def soap_fcn(atoms, **kwargs):
             return [[0, 0, 0]]
@@ -143,3 +148,304 @@ class TestDescriptors():
         # when sorting is implemented into LER these will be in a different order
         assert np.array_equal(ler[0], np.array([1 / 4, 1 / 4, 1 / 2, 0]))
         assert np.array_equal(ler[1], np.array([1 / 4, 1 / 4, 0, 1 / 2]))
+
+    def test_ler_kdtree_backend(self):
+        '''Test LER with the exact kdtree backend, which should not write any file to the working directory'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0], 'nn_backend': 'kdtree'}
+        try:
+            ler = my_col.process("ler", ("fake_soap", soapargs), **lerargs)
+            assert not os.path.exists('tmp')
+        finally:
+            _delete_store(my_col)
+
+        assert np.array_equal(ler[0], np.array([1 / 4, 1 / 4, 1 / 2, 0]))
+        assert np.array_equal(ler[1], np.array([1 / 4, 1 / 4, 0, 1 / 2]))
+
+    def test_ler_classify_reuses_stored_index(self):
+        '''Test that the center index of a LER result is stored and can be used to classify another collection'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0]}
+        try:
+            my_col.process("ler", ("fake_soap", soapargs), **lerargs)
+            _, basis = my_col.get_collection_result("ler", ("fake_soap", soapargs), metadata=True, **lerargs)
+            index_path = basis["center_index"].file
+            assert index_path == my_col.store.attachment_path(basis["center_index"].path)
+            assert os.path.exists(index_path)
+            # the centers are memory-mapped from their own attachment rather than unpickled
+            assert isinstance(basis["cluster_centers"].vectors, np.memmap)
+            centers_path = my_col.store.attachment_path(basis["cluster_centers"].path)
+            assert np.array_equal(np.load(centers_path), [[0, 0, 0], [-14, -13, -11], [4, 4, 4], [10, 10, 9]])
+
+            new_col = my_col.subset(['455'], name="new")
+            ler, info = descriptors.ler_classify(new_col, ("fake_soap", soapargs), basis)
+            assert np.array_equal(ler[0], np.array([1 / 4, 1 / 4, 0, 1 / 2]))
+            assert info['num_clusters'] == 4
+
+            my_col.clear(method="ler", based_on=("fake_soap", soapargs), **lerargs)
+            assert not os.path.exists(index_path)
+            assert not os.path.exists(centers_path)
+        finally:
+            _delete_store(my_col)
+
+    def test_ler_attachments_stored_with_result(self):
+        '''Test that LER computed without storing its result leaves no index or centers in the store'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
+        my_col.store.store_description(np.array([[-14, -13, -11], [4, 4, 4]]), {}, "454", "fake_soap", **soapargs)
+        my_col.store.store_description(np.array([[1, 1, 1], [10, 10, 9]]), {}, "455", "fake_soap", **soapargs)
+        try:
+            _, info = descriptors.ler(my_col, ("fake_soap", soapargs), eps=2, seed=[0, 0, 0])
+            index_file = info["center_index"].file
+            assert os.path.exists(index_file)
+            assert not any(f.endswith((".ann", ".npy")) for _, _, files in os.walk(my_col.store.root) for f in files)
+            assert info["cluster_centers"].path is None
+            del info
+            assert not os.path.exists(index_file)
+        finally:
+            _delete_store(my_col)
+
+    def test_ler_incremental_update(self):
+        '''Test that updating LER after adding aids gives the same result as a full run'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0]}
+        try:
+            first = my_col.subset(['454'])
+            ler = first.process("ler", ("fake_soap", soapargs), **lerargs)
+            assert ler.shape == (1, 3)
+
+            ler = my_col.process("ler", ("fake_soap", soapargs), update=True, **lerargs)
+            ler, info = my_col.get_collection_result("ler", ("fake_soap", soapargs), metadata=True, **lerargs)
+        finally:
+            _delete_store(my_col)
+
+        assert info['num_clusters'] == 4
+        assert info['aids'] == ['454', '455']
+        assert np.array_equal(ler[0], np.array([1 / 4, 1 / 4, 1 / 2, 0]))
+        assert np.array_equal(ler[1], np.array([1 / 4, 1 / 4, 0, 1 / 2]))
+
+    def test_ler_incremental_update_reclassifies(self):
+        '''Test that an earlier LAE closer to a center found in an update is classified to it, as in a full run'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
+        my_col.store.store_description(np.array([[4, 4, 4], [5.6, 4, 4]]), {}, "454", "fake_soap", **soapargs)
+        my_col.store.store_description(np.array([[6.5, 4, 4], [1, 1, 1]]), {}, "455", "fake_soap", **soapargs)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0], 'nn_backend': 'kdtree'}
+        try:
+            my_col.subset(['454']).process("ler", ("fake_soap", soapargs), **lerargs)
+            ler = my_col.process("ler", ("fake_soap", soapargs), update=True, **lerargs)
+            full, _ = descriptors.ler(my_col, ("fake_soap", soapargs), **lerargs)
+        finally:
+            _delete_store(my_col)
+
+        assert np.array_equal(ler, full)
+        assert np.array_equal(ler[0], np.array([0, 1 / 2, 1 / 2]))
+
+    def test_ler_dedup(self):
+        '''Test that collapsing duplicate LAEs does not change the LER result'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
+        fake_mat1 = np.array([[-14, -13, -11], [4, 4, 4], [4, 4, 4], [5, 4, 5], [1, 0, 1], [0, 0, 0]])
+        fake_mat2 = np.array([[1, 1, 1], [10, 10, 9], [10, 9, 10], [-14, -12, -12], [4, 4, 4], [0, 0, 0]])
+        my_col.store.store_description(fake_mat1, {}, "454", "fake_soap", **soapargs)
+        my_col.store.store_description(fake_mat2, {}, "455", "fake_soap", **soapargs)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0]}
+        try:
+            ler, info = descriptors.ler(my_col, ("fake_soap", soapargs), dedup_tol=None, **lerargs)
+            # exact duplicates only (the default), and up to a tolerance
+            for dedup_tol in [0, 1e-6]:
+                ler_dedup, info_dedup = descriptors.ler(my_col, ("fake_soap", soapargs), dedup_tol=dedup_tol, **lerargs)
+                assert list(info['cluster_centers']) == list(info_dedup['cluster_centers'])
+                assert np.array_equal(info['ler_matrix_count'], info_dedup['ler_matrix_count'])
+                assert np.array_equal(ler, ler_dedup)
+        finally:
+            _delete_store(my_col)
+
+    def test_ler_parallel(self):
+        '''Test that parallel LER gives the serial result when the shard leaders merge into the same centers'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0], 'n_jobs': 2}
+        try:
+            my_col.process("ler", ("fake_soap", soapargs), **lerargs)
+            ler, info = my_col.get_collection_result("ler", ("fake_soap", soapargs), metadata=True, **lerargs)
+        finally:
+            _delete_store(my_col)
+
+        assert list(info['cluster_centers']) == [('0', 0), ('454', 0), ('454', 1), ('455', 1)]
+        assert np.array_equal(ler[0], np.array([1 / 4, 1 / 4, 1 / 2, 0]))
+        assert np.array_equal(ler[1], np.array([1 / 4, 1 / 4, 0, 1 / 2]))
+
+    def test_ler_parallel_stored_args(self):
+        '''Test that parallel leader clustering is stored apart from the serial result, unless it is exact'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0]}
+        based_on = ("fake_soap", soapargs)
+        try:
+            my_col.process("ler", based_on, **lerargs)
+            serial = my_col.store.check_exists("Collections", my_col.name, "ler", based_on, explicit=True, **lerargs)
+            my_col.process("ler", based_on, n_jobs=2, exact_clustering=True, **lerargs)
+            assert my_col.store.check_exists("Collections", my_col.name, "ler", based_on, explicit=True, **lerargs) == serial
+            my_col.process("ler", based_on, n_jobs=2, **lerargs)
+            parallel = my_col.store.check_exists("Collections", my_col.name, "ler", based_on, explicit=True, n_jobs=2, **lerargs)
+            assert parallel is not False and parallel != serial
+            # a positive dedup_tol collapses LAEs per chunk, so max_memory changes the result
+            my_col.process("ler", based_on, dedup_tol=0.1, max_memory=4096, **lerargs)
+            assert my_col.store.check_exists("Collections", my_col.name, "ler", based_on, dedup_tol=0.1, max_memory=4096, **lerargs)
+        finally:
+            _delete_store(my_col)
+
+    def test_ler_out_of_core(self):
+        '''Test that LER with a small memory budget and memory-mapped centers is identical to the in-memory path'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
+        rng = np.random.default_rng(0)
+        my_col.store.store_description(rng.normal(size=(200, 6)), {}, "454", "fake_soap", **soapargs)
+        my_col.store.store_description(rng.normal(size=(200, 6)), {}, "455", "fake_soap", **soapargs)
+        lerargs = {'eps': 2.5, 'seed': np.zeros(6), 'nn_backend': 'kdtree'}
+        try:
+            ler, info = descriptors.ler(my_col, ("fake_soap", soapargs), **lerargs)
+            ler_ooc, info_ooc = descriptors.ler(my_col, ("fake_soap", soapargs), max_memory=4096, mmap_centers=True, **lerargs)
+            try:
+                # the dense count matrix alone does not fit
+                descriptors.ler(my_col, ("fake_soap", soapargs), max_memory=16, **lerargs)
+                assert False, "Exception should be raised."
+            except ValueError:
+                pass
+        finally:
+            _delete_store(my_col)
+
+        assert list(info['cluster_centers']) == list(info_ooc['cluster_centers'])
+        assert np.array_equal(info['ler_matrix_count'], info_ooc['ler_matrix_count'])
+        assert np.array_equal(ler, ler_ooc)
+
+    def test_ler_out_of_core_dedup(self):
+        '''Test that exact deduplication and parallel counting stay within a small memory budget with the same result'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
+        rng = np.random.default_rng(0)
+        laes = rng.normal(size=(100, 6))
+        my_col.store.store_description(np.concatenate([laes, laes]), {}, "454", "fake_soap", **soapargs)
+        my_col.store.store_description(np.concatenate([laes[::-1], rng.normal(size=(100, 6))]), {}, "455", "fake_soap", **soapargs)
+        lerargs = {'eps': 2.5, 'seed': np.zeros(6), 'nn_backend': 'kdtree', 'dedup_tol': 0}
+        try:
+            ler, info = descriptors.ler(my_col, ("fake_soap", soapargs), **lerargs)
+            # the digests of the LAEs of 454 are forgotten before 455 is clustered
+            ler_ooc, info_ooc = descriptors.ler(my_col, ("fake_soap", soapargs), max_memory=8192, n_jobs=2, exact_clustering=True, **lerargs)
+        finally:
+            _delete_store(my_col)
+
+        assert list(info['cluster_centers']) == list(info_ooc['cluster_centers'])
+        assert np.array_equal(ler, ler_ooc)
+
+    def test_ler_nn_threads(self):
+        '''Test that querying the Annoy index in threads gives the same LER, stored under the same arguments'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0]}
+        try:
+            threaded = my_col.process("ler", ("fake_soap", soapargs), nn_threads=2, **lerargs)
+            assert my_col.store.check_exists("Collections", my_col.name, "ler", ("fake_soap", soapargs), **lerargs)
+            ler, _ = descriptors.ler(my_col, ("fake_soap", soapargs), **lerargs)
+            _, basis = my_col.get_collection_result("ler", ("fake_soap", soapargs), metadata=True, **lerargs)
+            classified, _ = descriptors.ler_classify(my_col, ("fake_soap", soapargs), basis, nn_threads=2)
+        finally:
+            _delete_store(my_col)
+        assert np.array_equal(threaded, ler)
+        assert np.array_equal(classified, ler)
+
+    def test_ler_sparse(self):
+        '''Test that sparse LER output holds the same values as the dense output'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+        lerargs = {'eps': 2, 'seed': [0, 0, 0], 'sparse': True}
+        try:
+            my_col.process("ler", ("fake_soap", soapargs), **lerargs)
+            ler, info = my_col.get_collection_result("ler", ("fake_soap", soapargs), metadata=True, **lerargs)
+        finally:
+            _delete_store(my_col)
+
+        assert issparse(ler) and issparse(info['ler_matrix_count'])
+        assert np.array_equal(ler.toarray(), np.array([[1 / 4, 1 / 4, 1 / 2, 0], [1 / 4, 1 / 4, 0, 1 / 2]]))
+        assert np.array_equal(info['ler_matrix_count'].toarray(), np.array([[1, 1, 2, 0], [1, 1, 0, 2]]))
+
+    def test_ler_dissimilarity(self):
+        '''Test LER with built-in and custom vectorized dissimilarity metrics'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+
+        def my_distance(block, centers):
+            return np.linalg.norm(block[:, None, :] - centers[None, :, :], axis=2)
+
+        try:
+            # gaussian dissimilarity below 1 - exp(-gamma * 4) is the same as euclidean distance below 2
+            gaussian = my_col.process("ler", ("fake_soap", soapargs), eps=1 - np.exp(-0.5 * 4), seed=[0, 0, 0], dissimilarity="gaussian", dissim_args={'gamma': 0.5})
+            custom = my_col.process("ler", ("fake_soap", soapargs), eps=2, seed=[0, 0, 0], dissimilarity=my_distance, nn_backend="brute")
+            try:
+                descriptors.ler(my_col, ("fake_soap", soapargs), eps=2, seed=[0, 0, 0], dissimilarity=my_distance)
+                assert False, "Exception should be raised."
+            except ValueError:
+                assert True
+            try:
+                descriptors.ler(my_col, ("fake_soap", soapargs), eps=0.1, seed=[0, 0, 0], dissimilarity="cosine", metric="euclidean")
+                assert False, "Exception should be raised."
+            except ValueError:
+                assert True
+        finally:
+            _delete_store(my_col)
+
+        expected = np.array([[1 / 4, 1 / 4, 1 / 2, 0], [1 / 4, 1 / 4, 0, 1 / 2]])
+        assert np.allclose(gaussian, expected)
+        assert np.allclose(custom, expected)
+
+    def test_ler_engines(self):
+        '''Test LER with the grid and k-means clustering engines'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = _store_fake_soap(my_col)
+        try:
+            grid = my_col.process("ler", ("fake_soap", soapargs), eps=20, seed=[0, 0, 0], engine="grid", engine_args={'cell': 10}, nn_backend="kdtree")
+            my_col.process("ler", ("fake_soap", soapargs), eps=2, seed=[0, 0, 0], engine="kmeans", engine_args={'n_clusters': 2, 'random_state': 0}, nn_backend="kdtree")
+            kmeans_info = my_col.get_collection_result("ler", ("fake_soap", soapargs), metadata=True, eps=2, seed=[0, 0, 0], engine="kmeans", engine_args={'n_clusters': 2, 'random_state': 0}, nn_backend="kdtree")[1]
+            grid_info = my_col.get_collection_result("ler", ("fake_soap", soapargs), metadata=True, eps=20, seed=[0, 0, 0], engine="grid", engine_args={'cell': 10}, nn_backend="kdtree")[1]
+            try:
+                descriptors.ler(my_col, ("fake_soap", soapargs), eps=20, seed=[0, 0, 0], engine="grid", engine_args={'cell': 10}, nn_backend="kdtree", previous=(grid, grid_info))
+                assert False, "Exception should be raised."
+            except ValueError:
+                assert True
+        finally:
+            _delete_store(my_col)
+
+        # cells of size 10 centered on the grid points: the seed's cell also holds [4, 4, 4], [5, 4, 5], [1, 0, 1] and [1, 1, 1]
+        assert list(grid_info['cluster_centers']) == [('0', 0), ('454', 0), ('455', 1)]
+        assert np.array_equal(grid, np.array([[3 / 4, 1 / 4, 0], [1 / 4, 1 / 4, 1 / 2]]))
+        # k-means puts the two centers at the means of the far away groups of LAEs
+        assert np.allclose(kmeans_info['cluster_centers'].vectors[1:], [[-14, -12.5, -11.5], [10, 9.5, 9.5]]) or \
+            np.allclose(kmeans_info['cluster_centers'].vectors[1:], [[10, 9.5, 9.5], [-14, -12.5, -11.5]])
+
+    def test_reduce(self):
+        '''Test fused reductions, in parallel and updating a previous result'''
+        my_col = _initialize_collection_and_read(['454', '455'])
+        soapargs = {'rcut': 0, 'nmax': 0, 'lmax': 0}
+        fake_mat1 = np.array([[1, 2, 3, 4], [3, 4, 5, 6], [-1, 0, 4, 2]])
+        fake_mat2 = np.array([[1, 1, 1, 1], [2, 0, 2, 0]])
+        my_col.store.store_description(fake_mat1, {}, "454", "fake_soap", **soapargs)
+        my_col.store.store_description(fake_mat2, {}, "455", "fake_soap", **soapargs)
+        args = {'reductions': ['mean', 'max', ('moment', {'order': 2})], 'n_jobs': 2}
+        try:
+            res = my_col.process('reduce', ('fake_soap', soapargs), **args)
+            _, info = my_col.get_collection_result('reduce', ('fake_soap', soapargs), metadata=True, **args)
+
+            first = my_col.subset(['454'])
+            assert first.process('asr', ('fake_soap', soapargs)).shape == (1, 4)
+            asr = my_col.process('asr', ('fake_soap', soapargs), update=True)
+        finally:
+            _delete_store(my_col)
+
+        assert info['columns'] == {'mean': (0, 4), 'max': (4, 8), 'moment(order=2)': (8, 12)}
+        for row, mat in zip(res, [fake_mat1, fake_mat2]):
+            assert np.allclose(row, np.concatenate((mat.mean(axis=0), mat.max(axis=0), mat.var(axis=0))))
+        assert np.array_equal(asr, np.array([[1, 2, 4, 4], [1.5, 0.5, 1.5, 0.5]]))
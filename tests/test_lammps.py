@@ -0,0 +1,79 @@
+from pyrelate.lammps import read_dump_text, iread_dump_text, read_dump_frame, is_dump_text
+from ase import io
+import numpy as np
+
+
+def _assert_same_atoms(a, b):
+    assert a == b
+    assert np.array_equal(a.get_celldisp(), b.get_celldisp())
+    assert sorted(a.arrays) == sorted(b.arrays)
+    for name in a.arrays:
+        assert a.arrays[name].dtype == b.arrays[name].dtype
+        assert np.array_equal(a.arrays[name], b.arrays[name])
+
+
+def _write_trajectory(fpath, n_frames):
+    '''Write a small dump file whose frames have different positions'''
+    with open(fpath, "w") as f:
+        for frame in range(n_frames):
+            f.write(f"ITEM: TIMESTEP\n{frame}\nITEM: NUMBER OF ATOMS\n3\nITEM: BOX BOUNDS pp pp pp\n"
+                    "-10 10\n-10 10\n-10 10\nITEM: ATOMS id type x y z\n")
+            for i in range(3):
+                f.write(f"{3 - i} {i + 1} {frame + i} {frame} 0.5\n")
+
+
+class TestLammps():
+    def test_read_dump_text(self):
+        '''Test that the fast reader gives the same Atoms as ASE'''
+        fpath = "./tests/test_data/ni.p455.out"
+        _assert_same_atoms(read_dump_text(fpath), io.read(fpath, format="lammps-dump-text"))
+
+    def test_read_dump_text_frames(self, tmp_path):
+        '''Test reading the timesteps of a file with several of them'''
+        fpath = str(tmp_path / "two_frames.out")
+        with open("./tests/test_data/ni.p455.out") as f:
+            frame = f.read()
+        with open(fpath, "w") as f:
+            f.write(frame + frame)
+        frames = read_dump_text(fpath, slice(None))
+        expected = io.read(fpath, ":", format="lammps-dump-text")
+        assert len(frames) == len(expected) == 2
+        for a, b in zip(frames, expected):
+            _assert_same_atoms(a, b)
+        _assert_same_atoms(read_dump_text(fpath, 0), expected[0])
+
+    def test_read_dump_text_truncated(self, tmp_path):
+        '''Test that a truncated file raises an error'''
+        fpath = str(tmp_path / "truncated.out")
+        with open("./tests/test_data/ni.p455.out") as f:
+            lines = f.readlines()
+        with open(fpath, "w") as f:
+            f.writelines(lines[:-10])
+        try:
+            read_dump_text(fpath)
+            assert False, "Exception should be raised."
+        except ValueError:
+            assert True
+
+    def test_iread_dump_text(self, tmp_path):
+        '''Test streaming selected timesteps, and reading them again from their position in the file'''
+        fpath = str(tmp_path / "trajectory.out")
+        _write_trajectory(fpath, 5)
+        expected = io.read(fpath, ":", format="lammps-dump-text")
+        frames = list(iread_dump_text(fpath, slice(1, None, 2)))
+        assert [frame for frame, _, _ in frames] == [1, 3]
+        for frame, offset, atoms in frames:
+            _assert_same_atoms(atoms, expected[frame])
+            _assert_same_atoms(read_dump_frame(fpath, offset), expected[frame])
+        assert [frame for frame, _, _ in iread_dump_text(fpath, slice(0, 2))] == [0, 1]
+        try:
+            list(iread_dump_text(fpath, slice(-2, None)))
+            assert False, "Exception should be raised."
+        except ValueError:
+            assert True
+
+    def test_is_dump_text(self):
+        '''Test that dump files are recognized by their content'''
+        assert is_dump_text("./tests/test_data/ni.p455.out")
+        assert not is_dump_text("./tests/test_lammps.py")
+        assert not is_dump_text("./tests/does_not_exist.out")
@@ -0,0 +1,26 @@
+import pyrelate.reductions as reductions
+import numpy as np
+
+
+class TestReductions():
+    def test_builtin_reductions(self):
+        desc = np.array([[1, 2, 3, 4], [3, 4, 5, 6], [-1, 0, 4, 2]], dtype=float)
+        assert np.array_equal(reductions.mean(desc), [1, 2, 4, 4])
+        assert np.allclose(reductions.norm_mean(desc), np.array([1, 2, 4, 4]) / np.sqrt(37))
+        assert np.allclose(reductions.moment(desc, order=2), reductions.var(desc))
+
+    def test_resolve(self):
+        name, fcn = reductions._resolve(("moment", {"order": 4}))
+        assert name == "moment(order=4)"
+        assert np.allclose(fcn(np.array([[0.], [2.]])), [1])
+
+        def spread(desc):
+            return np.ptp(desc, axis=0)
+        assert reductions._resolve(spread) == ("spread", spread)
+
+    def test_unknown_reduction(self):
+        try:
+            reductions._resolve("median")
+            assert False, "Exception should be raised."
+        except ValueError:
+            assert True
@@ -1,5 +1,6 @@
 from pyrelate.store import Store
 from pyrelate.collection import AtomsCollection
+import numpy as np
 import os
 import shutil
 import unittest
@@ -217,6 +218,23 @@ class TestStore(unittest.TestCase):
             assert False, "No correct file found"
         _delete_store(store)
 
+    def test_link_description(self):
+        '''Test that a linked description is found under the new aid, and survives clearing the original'''
+        store = Store("./tests/results")
+        store.store_description(np.arange(3), {}, "111", "test_desc", a=1)
+        store.link_description("111", "222", "test_desc", a=1)
+        assert np.array_equal(store.get_description("222", "test_desc", a=1), np.arange(3))
+        assert store.get_description_info("222", "test_desc", a=1)["linked_from"] == "111"
+        store.clear_description_result("111", "test_desc", a=1)
+        assert np.array_equal(store.get_description("222", "test_desc", a=1), np.arange(3))
+        assert store.get_description_info("111", "test_desc", a=1) is None
+        try:
+            store.link_description("111", "333", "test_desc", a=1)
+            assert False, "Exception should be raised."
+        except FileNotFoundError:
+            assert True
+        _delete_store(store)
+
     def test_store_description_with_info(self):
         # called in describe()
         # result, descriptor, aid, argmuments
@@ -0,0 +1,55 @@
+from pyrelate import transport
+from ase import Atoms
+from ase.calculators.singlepoint import SinglePointCalculator
+from ase.constraints import FixAtoms
+import numpy as np
+import pickle
+
+
+def _atoms(n):
+    atoms = Atoms("Ni" * n, positions=np.arange(3 * n, dtype=float).reshape(n, 3), cell=[5, 6, 7], pbc=[1, 1, 0],
+                  celldisp=[1, 2, 3])
+    atoms.new_array("mask", np.arange(n) % 2)
+    atoms.new_array("flag", np.arange(n) % 3 == 0)
+    return atoms
+
+
+def _assert_same_atoms(a, b):
+    assert a == b
+    assert np.array_equal(a.get_celldisp(), b.get_celldisp())
+    assert sorted(a.arrays) == sorted(b.arrays)
+    for name in a.arrays:
+        assert a.arrays[name].dtype == b.arrays[name].dtype
+        assert np.array_equal(a.arrays[name], b.arrays[name])
+
+
+class TestTransport():
+    def test_pack(self):
+        '''Test that packed Atoms are rebuilt with their info, without their calculator and constraints'''
+        atoms = _atoms(10)
+        atoms.calc = SinglePointCalculator(atoms, energy=1.0)
+        atoms.set_constraint(FixAtoms(indices=[0]))
+        atoms.info["step"] = 3
+        unpacked = transport.unpack(pickle.loads(pickle.dumps(transport.pack(atoms))))
+        _assert_same_atoms(unpacked, atoms)
+        assert unpacked.calc is None and unpacked.constraints == []
+        assert unpacked.info == {"step": 3}
+
+    def test_shared_slots(self):
+        '''Test that slots are reused once released, and grow to fit larger Atoms objects'''
+        with transport.SharedSlots() as slots:
+            for n in [10, 5, 1000, 0]:
+                atoms = _atoms(n)
+                slot, packed = slots.put(atoms)
+                assert slot == 0
+                _assert_same_atoms(transport.unpack(pickle.loads(pickle.dumps(packed))), atoms)
+                slots.release(slot)
+            first, _ = slots.put(_atoms(3))
+            second, _ = slots.put(_atoms(3))
+            assert first != second
+            # the block attached for a slot is closed once the slot gets a larger block
+            attached = transport._attached[0]
+            slots.release(first)
+            _, packed = slots.put(_atoms(10000))
+            transport.unpack(packed)
+            assert transport._attached[0] is not attached and attached.buf is None